@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+import argparse
+import io
+import json
+import os
+import subprocess
+import time
+import tracemalloc
+from urllib.parse import urlencode
+
+import dicebot
+import dicebot_wsgi
+
+'''
+Benchmarks for the parse -> roll -> format -> respond pipeline.
+
+Each stage is timed on its own, and full requests go through Flask's test client.
+Inputs run from a single 1d20 up to the largest roll dicebot accepts.
+
+The same requests are also passed straight to the two WSGI apps, the Flask one
+and the bare one in dicebot_wsgi.py, with no server in between. --apps prints
+how many requests a second each answers on one core.
+
+For every benchmark the latency percentiles (in microseconds) and the peak
+memory allocated during one call are reported. Results can be saved under a
+commit id and later runs compared against them to catch regressions.
+
+Examples:
+    python benchmark.py
+    python benchmark.py --save
+    python benchmark.py --compare benchmark_results/<commit>.json
+    python benchmark.py --filter format_ --iterations 200
+    python benchmark.py --apps
+'''
+
+# Where --save puts results, one file per commit
+RESULTS_DIRECTORY = "benchmark_results"
+
+# A benchmark is flagged when its median is this much slower than the baseline
+REGRESSION_THRESHOLD = 1.25
+
+PERCENTILES = (50, 90, 99)
+
+# Roll strings from the most common to the largest allowed
+ROLL_INPUTS = ["1d20", "2d6+3", "8d12 - 2", "99d100+100", "1000d6", str(dicebot.MAX_NUM_DICE) + "d6"]
+
+# The WSGI apps compared by --apps
+APPS = (("flask", dicebot.app), ("minimal", dicebot_wsgi.app))
+
+# Requests posted to each of APPS
+APP_REQUESTS = [("/roll", "1d20"), ("/roll", "2d6+3"), ("/roll", "1000d6"), ("/adv", "+5"), ("/character", "")]
+
+
+def slack_form(command, text):
+    return {"token": "benchmark",
+            "team_id": "T0000000",
+            "team_domain": "benchmark",
+            "channel_id": "C0000000",
+            "channel_name": "benchmark",
+            "user_id": "U0000000",
+            "user_name": "benchmark",
+            "command": command,
+            "text": text,
+            "response_url": "http://127.0.0.1/commands/benchmark"}
+
+
+def build_benchmarks():
+    '''
+    Returns a list of (name, function) pairs. Each function runs one operation.
+
+    Inputs are parsed and rolled up front, so each benchmark only times its own stage.
+    '''
+
+    benchmarks = []
+
+    for text in ROLL_INPUTS:
+        parsed_roll = dicebot.parse_roll(text)
+        rolled_dice = dicebot.generate_roll(parsed_roll)
+
+        benchmarks.append(("parse_roll " + text, lambda text=text: dicebot.parse_roll(text)))
+        benchmarks.append(("generate_roll " + text,
+                           lambda parsed_roll=parsed_roll: dicebot.generate_roll(parsed_roll)))
+        benchmarks.append(("format_standard_roll " + text,
+                           lambda rolled_dice=rolled_dice, parsed_roll=parsed_roll:
+                           dicebot.format_standard_roll(rolled_dice, "benchmark", parsed_roll)))
+
+    adv_roll = dicebot.parse_roll("+5", adv_or_dis=True)
+    adv_dice = dicebot.generate_roll(adv_roll)
+    benchmarks.append(("format_adv_dis_roll adv",
+                       lambda: dicebot.format_adv_dis_roll(adv_dice, "benchmark", adv_roll, adv=True)))
+    benchmarks.append(("format_adv_dis_roll dis",
+                       lambda: dicebot.format_adv_dis_roll(adv_dice, "benchmark", adv_roll, dis=True)))
+
+    character_roll = dicebot.parse_roll("", character=True)
+    character_dice = dicebot.generate_rolls([character_roll] * 6)
+    benchmarks.append(("format_character_roll",
+                       lambda: dicebot.format_character_roll(character_dice, "benchmark")))
+
+    plan = dicebot.compile_roll("4d6kh3 + 2d8 - 1d4 + 5")
+    rolled_plan = dicebot.generate_plan_roll(plan)
+    benchmarks.append(("format_expression_roll 4d6kh3 + 2d8 - 1d4 + 5",
+                       lambda: dicebot.format_expression_roll(rolled_plan, "benchmark", plan)))
+
+    plans = dicebot.parse_batch("1d20+5; 2d6+3; 1d20+5; 2d6+3")
+    benchmarks.append(("generate_batch_roll 1d20+5; 2d6+3; 1d20+5; 2d6+3",
+                       lambda: dicebot.generate_batch_roll(plans)))
+
+    client = dicebot.app.test_client()
+    requests = [("/roll", text) for text in ROLL_INPUTS]
+    requests += [("/adv", "+5"), ("/dis", "-1"), ("/character", ""), ("/odds", "3d8+2 >= 15")]
+    for command, text in requests:
+        form = slack_form(command, text)
+        benchmarks.append(("request " + command + " " + text,
+                           lambda command=command, form=form: client.post(command, data=form)))
+
+    # Every command can also be sent to the root URL
+    form = slack_form("/roll", "1d20")
+    benchmarks.append(("request / 1d20", lambda: client.post("/", data=form)))
+
+    return benchmarks + build_app_benchmarks()
+
+
+def wsgi_environ(path, form, headers=None):
+    '''
+    Returns the WSGI environ of a form posted to path, like a server would pass it.
+    Its body can only be read once, make one per request. headers is a dict of HTTP headers.
+    '''
+
+    body = urlencode(form).encode("utf-8")
+    environ = {"REQUEST_METHOD": "POST",
+               "SCRIPT_NAME": "",
+               "PATH_INFO": path,
+               "QUERY_STRING": "",
+               "SERVER_NAME": "127.0.0.1",
+               "SERVER_PORT": "5000",
+               "SERVER_PROTOCOL": "HTTP/1.1",
+               "CONTENT_TYPE": "application/x-www-form-urlencoded",
+               "CONTENT_LENGTH": str(len(body)),
+               "wsgi.version": (1, 0),
+               "wsgi.url_scheme": "http",
+               "wsgi.input": io.BytesIO(body),
+               "wsgi.errors": io.StringIO(),
+               "wsgi.multithread": False,
+               "wsgi.multiprocess": False,
+               "wsgi.run_once": False}
+    for name, value in (headers or {}).items():
+        environ["HTTP_" + name.upper().replace("-", "_")] = value
+    return environ
+
+
+def call_wsgi(app, environ):
+    '''
+    Calls a WSGI app and returns a tuple of (status, headers, body) of its response.
+    '''
+
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started.append((status, headers))
+
+    result = app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+    return (started[0][0], started[0][1], body)
+
+
+def build_app_benchmarks():
+    '''
+    Returns a list of (name, function) pairs, each posting one of APP_REQUESTS
+    straight to one of APPS.
+    '''
+
+    benchmarks = []
+    for command, text in APP_REQUESTS:
+        form = slack_form(command, text)
+        for app_name, app in APPS:
+            benchmarks.append(("wsgi " + app_name + " " + command + " " + text,
+                               lambda app=app, command=command, form=form: call_wsgi(app, wsgi_environ(command, form))))
+    return benchmarks
+
+
+def percentile(sorted_values, percent):
+    '''
+    Returns the nearest-rank percentile of an already sorted list.
+    '''
+
+    index = max(int(round(percent / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def measure(function, iterations, warmup):
+    '''
+    Times function and measures the most memory one call holds at once.
+
+    Memory is measured in a separate pass since tracemalloc slows every call down.
+
+    Returns a dict of latency percentiles in microseconds, the mean, and peak bytes.
+    '''
+
+    for count in range(warmup):
+        function()
+
+    timings = []
+    for count in range(iterations):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000000)
+    timings.sort()
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        function()
+        peak = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+    result = {"mean_us": sum(timings) / len(timings),
+              "peak_bytes": peak}
+    for percent in PERCENTILES:
+        result["p" + str(percent) + "_us"] = percentile(timings, percent)
+
+    return result
+
+
+def run_benchmarks(iterations=1000, warmup=50, name_filter=None):
+    '''
+    Runs every benchmark whose name contains name_filter and returns {name: result}.
+    '''
+
+    results = {}
+    for name, function in build_benchmarks():
+        if name_filter is not None and name_filter not in name:
+            continue
+        results[name] = measure(function, iterations, warmup)
+    return results
+
+
+def compare_apps(iterations=1000, warmup=50):
+    '''
+    Runs every request of APP_REQUESTS through each of APPS. Requests run one
+    after the other, so the rate is for one core.
+
+    Returns {request: {app name: requests per second}}.
+    '''
+
+    results = {}
+    for name, function in build_app_benchmarks():
+        app_name, request = name.split(" ", 2)[1:]
+        result = measure(function, iterations, warmup)
+        results.setdefault(request, {})[app_name] = 1000000 / result["mean_us"]
+    return results
+
+
+def print_app_comparison(results):
+    names = [app_name for app_name, app in APPS]
+    print("%-24s %s %8s" % ("request per core", " ".join("%12s" % name for name in names), "speedup"))
+    for request in sorted(results):
+        rates = results[request]
+        print("%-24s %s %7.2fx" % (request, " ".join("%10.0f/s" % rates[name] for name in names),
+                                   rates[names[-1]] / rates[names[0]]))
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results, baseline=None):
+    '''
+    Prints a table of results. With a baseline, adds the change in median and
+    flags anything slower than REGRESSION_THRESHOLD.
+    '''
+
+    columns = ["p" + str(percent) + "_us" for percent in PERCENTILES]
+    print("%-52s %10s %10s %10s %12s %s" % ("benchmark", columns[0], columns[1], columns[2], "peak_bytes",
+                                            "vs baseline" if baseline else ""))
+
+    for name in sorted(results):
+        result = results[name]
+        line = "%-52s %10.1f %10.1f %10.1f %12d" % (name, result[columns[0]], result[columns[1]],
+                                                    result[columns[2]], result["peak_bytes"])
+
+        if baseline and name in baseline:
+            ratio = result["p50_us"] / max(baseline[name]["p50_us"], 0.001)
+            line += " %6.2fx" % ratio
+            if ratio > REGRESSION_THRESHOLD:
+                line += " REGRESSION"
+
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the dicebot pipeline")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--filter", default=None, help="only run benchmarks with this in their name")
+    parser.add_argument("--save", action="store_true", help="save results under the current commit")
+    parser.add_argument("--compare", default=None, help="a saved results file to compare against")
+    parser.add_argument("--apps", action="store_true",
+                        help="only compare the requests a second of the Flask and bare WSGI apps")
+    args = parser.parse_args()
+
+    if args.apps:
+        print_app_comparison(compare_apps(args.iterations, args.warmup))
+        return 0
+
+    results = run_benchmarks(args.iterations, args.warmup, args.filter)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+
+    print_results(results, baseline)
+
+    if args.save:
+        commit = current_commit()
+        if not os.path.isdir(RESULTS_DIRECTORY):
+            os.makedirs(RESULTS_DIRECTORY)
+        path = os.path.join(RESULTS_DIRECTORY, commit + ".json")
+        with open(path, "w") as results_file:
+            json.dump({"commit": commit,
+                       "iterations": args.iterations,
+                       "results": results}, results_file, indent=2, sort_keys=True)
+        print("Saved " + path)
+
+    if baseline and any(name in baseline and
+                        results[name]["p50_us"] / max(baseline[name]["p50_us"], 0.001) > REGRESSION_THRESHOLD
+                        for name in results):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
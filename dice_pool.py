@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+from collections import Counter
+
+'''
+Counting for dice pools: keeping the highest or lowest dice, dropping the rest
+and adding them up or counting successes, without sorting the dice.
+
+A pool is counted once into a histogram of {face: number of dice}. Dice only
+show a handful of faces, so finding where the kept dice stop walks the distinct
+faces instead of every die, and finding the dropped dice takes a pass or two
+over the dice. A 500d10 success pool costs one Counter and a walk over ten faces.
+
+Keeping is given like a DiceTerm: keep is "high", "low" or None and keep_count
+is how many dice count. Ties are broken like a stable sort of the dice: keeping
+the highest drops the earliest of the tied dice first, keeping the lowest drops
+the latest first.
+'''
+
+# The most extra dice an exploding die can chain. It is kept here so rolling
+# exploding dice doesn't import simulate.py and NumPy
+MAX_EXPLODE_ROUNDS = 100
+
+
+def count_faces(dice):
+    '''
+    Returns the histogram of a pool, a Counter of {face: number of dice}.
+    '''
+
+    return Counter(dice)
+
+
+def kept_counts(counts, keep, keep_count):
+    '''
+    Returns the histogram of the dice that are kept, from the histogram of the whole pool.
+    '''
+
+    if keep is None or keep_count >= sum(counts.values()):
+        return counts
+
+    kept = {}
+    remaining = keep_count
+    for face in sorted(counts, reverse=(keep == "high")):
+        if remaining <= 0:
+            break
+        taken = min(counts[face], remaining)
+        kept[face] = taken
+        remaining -= taken
+    return kept
+
+
+def dropped_positions(dice, counts, kept, keep):
+    '''
+    Returns the set of positions in dice that are not kept, given the histograms
+    of the pool and of its kept dice.
+    '''
+
+    if not kept:
+        return set(range(len(dice)))
+
+    # Every die past the last face kept is dropped, and ties of dice showing it
+    if keep == "high":
+        last = min(kept)
+        ties = counts[last] - kept[last]
+        if ties == counts[last]:
+            return set([position for position, face in enumerate(dice) if face <= last])
+        dropped = set([position for position, face in enumerate(dice) if face < last])
+    else:
+        last = max(kept)
+        ties = counts[last] - kept[last]
+        if ties == counts[last]:
+            return set([position for position, face in enumerate(dice) if face >= last])
+        dropped = set([position for position, face in enumerate(dice) if face > last])
+
+    if ties:
+        tied = [position for position, face in enumerate(dice) if face == last]
+        dropped.update(tied[:ties] if keep == "high" else tied[-ties:])
+    return dropped
+
+
+def pool_value(counts, target=0):
+    '''
+    Adds up the dice in a histogram, or counts the dice showing target or more if a target is given.
+    '''
+
+    if target:
+        return sum(count for face, count in counts.items() if face >= target)
+    return sum(face * count for face, count in counts.items())
+
+
+def count_pool(dice, keep=None, keep_count=0, target=0):
+    '''
+    Counts a pool. Returns a tuple of (value, dropped), the unsigned total or
+    number of successes of the kept dice and the set of positions that were dropped.
+    '''
+
+    if keep is None and not target:
+        return (sum(dice), set())
+
+    counts = count_faces(dice)
+    kept = kept_counts(counts, keep, keep_count)
+    return (pool_value(kept, target), dropped_positions(dice, counts, kept, keep) if kept is not counts else set())
+
+
+def split_kept(dice, keep, keep_count):
+    '''
+    Returns a tuple of (dropped faces, kept faces), each from lowest to highest.
+    For example split_kept([3, 6, 1, 4], "high", 3) is ([1], [3, 4, 6]).
+    '''
+
+    counts = count_faces(dice)
+    kept = kept_counts(counts, keep, keep_count)
+    dropped = []
+    kept_faces = []
+    for face in sorted(counts):
+        taken = kept.get(face, 0)
+        dropped.extend([face] * (counts[face] - taken))
+        kept_faces.extend([face] * taken)
+    return (dropped, kept_faces)
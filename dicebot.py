@@ -1,9 +1,27 @@
 #!/usr/bin/env python3
 from flask import Flask
 from flask import request
-from flask import jsonify
-import random
+from array import array
+from collections import Counter, namedtuple
+from functools import lru_cache
+from itertools import chain, islice
+import importlib
+import json
+import os
+import re
+import time
 import traceback
+from urllib.parse import parse_qsl
+
+import dice_pool
+import metrics
+from random_pool import RandomPool
+import rng_backends
+import rate_limit
+import roll_journal
+import roll_macros
+import roll_stats
+import slack_signature
 
 '''
 This is a slack slash command dicebot.
@@ -25,12 +43,226 @@ The following options exist:
  - /character - this rolls 4x 6 sided dice, dropping the lowest value. This is done 6 times.
  This is useful for one command character creation.
  For example, /character will return 6 values
+
+ - /simulate - this rolls a roll many times and reports how the totals came out.
+ For example, /simulate 6d10t8 >= 3 works out how often 6d10 gets 3 or more 8s.
 '''
 
+
+
+class LazyModule(object):
+    '''
+    Stands in for a module until one of its attributes is first used, then imports it.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+# odds and simulate import NumPy, which takes longer than the rest of dicebot.
+# Only /odds and /simulate need them, so a cold start skips them.
+odds = LazyModule("odds")
+simulate = LazyModule("simulate")
+
 app = Flask(__name__)
 
 debug = False
 
+# Limits on what a single roll expression may ask for
+MAX_NUM_DICE = 10000
+MAX_DIE_VALUE = 1000
+MAX_ROLL_STRING_LENGTH = 100
+# The journal packs totals as signed 64 bit ints and /simulate sums them in int64
+MAX_MODIFIER = 10 ** 6
+
+# How many rolls one /roll may ask for, like "1d20+5; 2d6+3" or "6x 4d6". See parse_batch()
+MAX_BATCH_ROLLS = 20
+
+# How many compiled roll expressions to keep. See compile_roll()
+ROLL_CACHE_SIZE = 512
+
+# What an /odds costs in rate limit tokens, see odds_cost()
+ODDS_BASE_COST = 10
+ODDS_WORK_PER_TOKEN = 50000
+
+# What a /simulate costs, see simulate_cost()
+SIMULATE_BASE_COST = 10
+SIMULATE_TRIALS_PER_TOKEN = 1000
+
+# Modifiers whose 400 /adv or /dis outcomes are kept rendered, for each of /adv and /dis
+ADV_DIS_TABLE_CACHE_SIZE = 64
+
+# Worker processes /simulate spreads its trials over. 1 runs them in the request
+SIMULATE_WORKERS = int(os.environ.get("DICEBOT_SIMULATE_WORKERS", "1"))
+
+# The most trials a /simulate may ask for
+MAX_SIMULATE_TRIALS = 10000000
+
+# /simulate lists every total when there are at most this many of them
+SIMULATE_HISTOGRAM_ROWS = 20
+
+# Rolls with more dice than this are summarized instead of listing every die
+COMPACT_ROLL_THRESHOLD = 100
+
+# Summaries count each face for dice up to this size. Bigger dice get low/high/average
+COMPACT_FACE_LIMIT = 20
+
+# A full listing (/roll 10000d6 full) is rendered this many dice at a time
+FACE_CHUNK = 500
+
+# Slack shows about this many characters of a message, longer listings are split
+# into several messages when they are posted to the response_url
+MESSAGE_CHARS = 4000
+
+# A response_url takes at most this many messages
+MAX_FOLLOW_UPS = 5
+
+# Replaces the dice that didn't fit in MAX_FOLLOW_UPS messages
+CUT_TEXT = "... (too many dice to list, cut short)"
+
+# Pieces of a long message rendered before anything is sent: the header and the
+# first FACE_CHUNK dice. A problem with them is still answered as an error.
+EAGER_PIECES = 2
+
+# Ends a long message that failed after the first pieces were sent
+STREAM_ERROR_TEXT = "... Hmm....something went wrong. Try again?"
+
+# str() of every number a die can show, so formatting never re-renders them
+NUMBER_STRINGS = dict((number, str(number)) for number in range(MAX_DIE_VALUE + 1))
+
+# The fixed parts of each message. See the format_* functions
+STANDARD_HEADER = "%s rolled %sd%s:\n"
+ADV_HEADER = "%s rolled at Advantage:\n"
+DIS_HEADER = "%s rolled at Disadvantage:\n"
+CHARACTER_HEADER = "%s rolled a stat block:\n"
+CHARACTER_LINE_TEMPLATE = "~%s~ %s + %s + %s = *%s*\n"
+KEPT_FIRST_TEMPLATE = "*%s* ~%s~"
+KEPT_SECOND_TEMPLATE = "~%s~ *%s*"
+TOTAL_TEMPLATE = " = *%s*\n"
+
+# Counters and timings served at /metrics. Set DICEBOT_METRICS_DIR to add up
+# every gunicorn worker. See metrics.py
+metrics_registry = metrics.Registry(os.environ.get("DICEBOT_METRICS_DIR"))
+metrics_registry.describe("dicebot_requests_total", "counter", "Slash commands received, by command.")
+metrics_registry.describe("dicebot_errors_total", "counter",
+                          "Failed commands, by command and kind (dicebot or unhandled).")
+metrics_registry.describe("dicebot_request_seconds", "histogram", "Time to answer a slash command, by command.")
+metrics_registry.describe("dicebot_stage_seconds", "histogram", "Time spent in each stage of a command.")
+metrics_registry.describe("dicebot_dice_drawn_total", "counter", "Dice rolled.")
+metrics_registry.describe("dicebot_rejected_requests_total", "counter",
+                          "Requests refused by signature verification, by reason.")
+metrics_registry.describe("dicebot_rate_limited_total", "counter",
+                          "Commands refused by the rate limit, by the bucket that ran out (user or channel).")
+metrics_registry.describe("dicebot_boot_seconds", "histogram",
+                          "Time this process took to get ready, by phase (import, warm and first_response).")
+metrics_registry.describe("dicebot_journal_dropped_total", "counter",
+                          "Rolls left out of the roll journal because its writer fell behind.")
+metrics_registry.describe("dicebot_random_pool_hits_total", "counter", "Dice served from the random pool.")
+metrics_registry.describe("dicebot_random_pool_misses_total", "counter",
+                          "Dice the random pool couldn't serve, drawn as normal.")
+
+# Label tuples are built once so timing a stage doesn't allocate them
+STAGE_LABELS = dict((stage, (("stage", stage),))
+                    for stage in ("slack_parse", "roll_parse", "roll", "format", "serialize"))
+
+# The JSON around the text of every slack message. See render_slack_payload()
+PAYLOAD_PREFIX = {True: b'{"response_type":"in_channel","text":',
+                  False: b'{"response_type":"ephemeral","text":'}
+PAYLOAD_SUFFIX = b',"attachments":[]}'
+
+# Where dice come from. Set DICEBOT_RNG to shake, mersenne, system, splitmix or philox. See rng_backends.py
+rng_backend = rng_backends.create_backend(os.environ.get("DICEBOT_RNG", "shake"))
+
+# Set SLACK_SIGNING_SECRET to refuse requests that were not signed by slack. See slack_signature.py
+signature_verifier = (slack_signature.SignatureVerifier(os.environ["SLACK_SIGNING_SECRET"])
+                      if os.environ.get("SLACK_SIGNING_SECRET") else None)
+
+# Token bucket limits, in dice. Most commands cost one token plus the dice they roll.
+# See rate_limit.py and register_command()
+USER_RATE_CAPACITY = 20000
+USER_RATE_REFILL = 200
+CHANNEL_RATE_CAPACITY = 50000
+CHANNEL_RATE_REFILL = 500
+
+# Each user and channel is limited in this process. Set DICEBOT_RATE_LIMIT=0 to turn that off, or set
+# DICEBOT_RATE_LIMIT_REDIS_URL to share the limits between every worker through redis
+if os.environ.get("DICEBOT_RATE_LIMIT_REDIS_URL"):
+    rate_limiter = rate_limit.RateLimiter(rate_limit.RedisStore.from_url(os.environ["DICEBOT_RATE_LIMIT_REDIS_URL"]),
+                                          USER_RATE_CAPACITY, USER_RATE_REFILL,
+                                          CHANNEL_RATE_CAPACITY, CHANNEL_RATE_REFILL)
+elif os.environ.get("DICEBOT_RATE_LIMIT") == "0":
+    rate_limiter = None
+else:
+    rate_limiter = rate_limit.RateLimiter(rate_limit.MemoryStore(),
+                                          USER_RATE_CAPACITY, USER_RATE_REFILL,
+                                          CHANNEL_RATE_CAPACITY, CHANNEL_RATE_REFILL)
+
+# Set DICEBOT_JOURNAL_DIR to keep every roll for /history. See roll_journal.py
+journal = roll_journal.RollJournal(os.environ["DICEBOT_JOURNAL_DIR"]) if os.environ.get("DICEBOT_JOURNAL_DIR") else None
+journal_reader = None
+
+# How many rolls /history shows
+HISTORY_LIMIT = 10
+
+# Running statistics of every roll for /stats. Set DICEBOT_STATS_FILE to keep them
+# over restarts, every worker adds to the same file. See roll_stats.py
+roll_statistics = roll_stats.RollStats(os.environ.get("DICEBOT_STATS_FILE") or None)
+
+# /history lists the dice of rolls with at most this many
+HISTORY_FACE_LIMIT = 20
+
+# Rolls compiled by warm_up(), so the first requests find them cached
+WARM_ROLLS = ("1d20", "1d20+5", "2d6", "2d6+3", "1d8+4", "3d6", "4d6", "4d6kh3", "1d100", "8d6", "2d20kh1", "2d20kl1")
+
+# How long this process took to get ready, in seconds. See boot()
+boot_timings = {"import_seconds": None, "warm_seconds": None, "first_response_seconds": None}
+boot_started = None
+
+# Set DICEBOT_RANDOM_POOL=1 to serve common dice from a pre-drawn pool. See random_pool.py
+random_pool = RandomPool() if os.environ.get("DICEBOT_RANDOM_POOL") == "1" else None
+
+
+def time_stage(stage):
+    '''
+    Returns a context manager that records how long a stage of a command took.
+    Stages are slack_parse, roll_parse, roll, format and serialize.
+    '''
+
+    return metrics_registry.time("dicebot_stage_seconds", STAGE_LABELS[stage])
+
+
+def verify_request(timestamp, signature, body):
+    '''
+    Checks the X-Slack-Request-Timestamp and X-Slack-Signature headers against the raw
+    request body. Returns True if the request may be answered.
+
+    Always True when no signing secret is configured. Refused requests are counted by reason.
+    '''
+
+    if signature_verifier is None:
+        return True
+
+    reason = signature_verifier.verify(timestamp, signature, body)
+    if reason is None:
+        return True
+
+    metrics_registry.inc("dicebot_rejected_requests_total", (("reason", reason),))
+    return False
+
+
+def count_error(command, kind):
+    '''
+    Counts a failed command. kind is "dicebot" for a DicebotException or "unhandled" for anything else.
+    '''
+
+    metrics_registry.inc("dicebot_errors_total", (("command", command), ("kind", kind)))
+
 
 class DicebotException(Exception):
     '''
@@ -47,537 +279,2320 @@ class DicebotException(Exception):
         return str(self.value)
 
 
-def parse_roll(input_string, adv_or_dis=False, character=False):
-    '''
-    Takes in a roll_string from the slack command.
-    Expected format is <num_dice>d<die_value>.
-    Examples: 1d4, 2d6, 3d8, 99d100
+# A single dice term in a compiled roll, like the "4d6kh3" in "4d6kh3 + 2d8 + 5".
+# sign is 1 or -1. keep is "high", "low" or None and keep_count is how many dice count.
+# reroll is the highest face rerolled once (0 for none), explode is True if dice showing
+# their highest face add another die, and target is the face a die needs to count as a
+# success (0 to add the dice up instead).
+DiceTerm = namedtuple("DiceTerm", ["sign", "num_dice", "die", "keep", "keep_count", "reroll", "explode", "target"])
+DiceTerm.__new__.__defaults__ = (0, False, 0)
 
-    A valid roll can also include "+<num>" or "-<num>"
-    Spaces are allowed on either side of the +/-
+# A compiled roll. dice is a tuple of DiceTerms and every constant is folded into modifier.
+RollPlan = namedtuple("RollPlan", ["text", "dice", "modifier"])
 
-    Examples: 4d4 + 2, 2d6+1, 8d12 +11
+# Tokens are numbers, dice suffixes, the "d" separator and +/- operators.
+# Longer suffixes are listed first so "dl" is not read as "d" followed by "l".
+ROLL_TOKEN_RE = re.compile(r"(\d+)|(kh|kl|dh|dl|k|r|t|!)|(d)|([+-])")
 
-    Valid numbers are between 1d1 and 99d100
+# Everything that can follow <num>d<num>. See compile_normalized_roll()
+ROLL_SUFFIXES = ("k", "kh", "kl", "dh", "dl", "r", "t", "!")
 
-    adv_or_dis = True means that the roll will be set to 2d20
-    character = True means the roll will be set to 4d6
 
-    returns a dict of:
-    {"num_dice": int(number_of_dice),
-     "die": int(die),
-     "modifier": modifier}
+def tokenize_roll(roll_string):
     '''
-    try:
-        if adv_or_dis:
-            if debug:
-                print("Rolling adv/dis")
-            # Need to append the input_string in case there are modifiers
-            # Let the rest of the function determine if the input_string is valid
-            input_roll_string = "2d20" + str(input_string)
+    Splits a normalized roll string (no whitespace, lower case) into a list of tokens.
 
-        elif character:
-            if debug:
-                print("Rolling character")
-            # Stat blocks do not have modifiers, so ignore any input.
-            input_roll_string = "4d6"
+    Numbers are converted to ints once here so the parser never re-casts substrings.
+    Any character that is not part of a roll raises a DicebotException.
+    '''
 
+    tokens = []
+    position = 0
+    while position < len(roll_string):
+        match = ROLL_TOKEN_RE.match(roll_string, position)
+        if match is None:
+            raise DicebotException("Unexpected character '" + roll_string[position] +
+                                   "' in roll. Given " + roll_string)
+
+        if match.group(1) is not None:
+            tokens.append(int(match.group(1)))
         else:
-            if debug:
-                print("normal roll")
-            input_roll_string = str(input_string)
-    except:
-        print(input_string)  # capture the input string if it's invalid
-        raise DicebotException("Invalid roll or modifier")
+            tokens.append(match.group(0))
+        position = match.end()
 
-    # Remove the whitespace
-    roll_string = input_roll_string.replace(" ", "")
+    return tokens
 
-    # 1d6 is minimum roll string length
-    # 100d100+100 is the maximum roll string
-    if len(roll_string) < 3 or len(roll_string) > 11:
-        raise DicebotException("Roll string too short. Given " + roll_string)
 
-    d_position = roll_string.find("d")
+def render_roll_plan(dice, modifier):
+    '''
+    Builds the canonical text of a roll, like "4d6kh3 + 2d8 - 1d4 + 5"
+    '''
+
+    output_text = []
+    for term in dice:
+        if output_text:
+            output_text.append(" + " if term.sign > 0 else " - ")
+        elif term.sign < 0:
+            output_text.append("-")
+
+        output_text.append(str(term.num_dice) + "d" + str(term.die))
+        if term.reroll:
+            output_text.append("r" + str(term.reroll))
+        if term.explode:
+            output_text.append("!")
+        if term.keep is not None and term.keep_count != term.num_dice:
+            output_text.append(("kh" if term.keep == "high" else "kl") + str(term.keep_count))
+        if term.target:
+            output_text.append("t" + str(term.target))
+
+    if modifier > 0:
+        output_text.append(" + " + str(modifier))
+    if modifier < 0:
+        output_text.append(" - " + str(-modifier))
 
-    if d_position < 0:
-        raise DicebotException("'d' found in incorrect position. Given " + input_roll_string)
+    return "".join(output_text)
 
-    num_dice = roll_string[:d_position]
 
-    # Because I'm not above giving StackOverflow some credit
-    # https://stackoverflow.com/questions/27050570/how-would-i-account-for-negative-values-in-python
-    try:
-        int(num_dice)
-    except:
-        raise DicebotException("Non digit found in the number of dice provided. Given " + input_roll_string)
+# How /adv, /dis and /character rolls are written in the roll journal
+ADV_TERM = DiceTerm(1, 2, 20, "high", 1)
+DIS_TERM = DiceTerm(1, 2, 20, "low", 1)
+CHARACTER_EXPRESSION = render_roll_plan((DiceTerm(1, 4, 6, "high", 3),), 0)
 
-    plus_pos = roll_string.find("+")
-    minus_pos = roll_string.find("-")
+# The dice of /adv, /dis and /character, as passed to draw_dice()
+ADV_DIS_DICE = ((2, 20),)
+CHARACTER_DICE = ((4, 6),) * 6
 
-    if plus_pos > 0:  # We have a + modifier
-        die_value = roll_string[d_position + 1:plus_pos]
-        if len(die_value) == 0:
-            raise DicebotException("No dice value provided. Given " + input_roll_string)
 
-        roll_modifier = roll_string[plus_pos + 1:]
+@lru_cache(maxsize=ROLL_CACHE_SIZE)
+def compile_normalized_roll(roll_string):
+    '''
+    Parses a normalized roll string into a RollPlan.
 
-    elif minus_pos > 0:  # We have a - modifier
-        die_value = roll_string[d_position + 1:minus_pos]
-        if len(die_value) == 0:
-            raise DicebotException("No dice value provided. Given " + input_roll_string)
+    The grammar is:
+        roll := term (("+" | "-") term)*
+        term := <num> | <num> "d" <num> suffix*
+        suffix := ("k" | "kh" | "kl" | "dh" | "dl" | "r" | "t") <num> | "!"
 
-        roll_modifier = roll_string[minus_pos:]
+    "kh3" keeps the highest 3 dice, "kl1" keeps the lowest, "dl1" drops the lowest
+    and "dh1" drops the highest. A bare "k" is the same as "kh".
+    "r1" rerolls any die showing 1 or less, once.
+    "!" explodes dice, every die showing its highest face adds another die.
+    "t8" counts the dice showing 8 or more instead of adding them up.
+    Each suffix may be used once per term, in any order.
 
-    else:  # No modifier exists. Mark it zero dude.
-        die_value = roll_string[d_position + 1:]
-        if len(die_value) == 0:
-            raise DicebotException("No dice value provided. Given " + input_roll_string)
+    Results are cached, so callers must go through compile_roll().
+    '''
 
-        roll_modifier = 0
+    if len(roll_string) > MAX_ROLL_STRING_LENGTH:
+        raise DicebotException("Roll string too long. Given " + roll_string)
 
-    try:
-        int(die_value)
-    except:
-        raise DicebotException("Non digit found in the dice value. Given " + input_roll_string)
+    tokens = tokenize_roll(roll_string)
+    if not tokens:
+        raise DicebotException("Roll string too short. Given " + roll_string)
 
-    if int(die_value) <= 0:
-        raise DicebotException("Die value can not be 0 or less. Given " + input_roll_string)
+    dice = []
+    modifier = 0
+    total_dice = 0
+    sign = 1
+    position = 0
+
+    while True:
+        # Every term starts with a number, either a constant or the number of dice
+        if position >= len(tokens) or not isinstance(tokens[position], int):
+            raise DicebotException("Expected a number in roll. Given " + roll_string)
+        value = tokens[position]
+        position += 1
+
+        if position < len(tokens) and tokens[position] == "d":
+            position += 1
+            if position >= len(tokens) or not isinstance(tokens[position], int):
+                raise DicebotException("No dice value provided. Given " + roll_string)
+            die_value = tokens[position]
+            position += 1
+
+            if value <= 0:
+                raise DicebotException("Number of dice can not be 0 or less. Given " + roll_string)
+            if die_value <= 0:
+                raise DicebotException("Die value can not be 0 or less. Given " + roll_string)
+            if die_value > MAX_DIE_VALUE:
+                raise DicebotException("Die value can not be more than " + str(MAX_DIE_VALUE) +
+                                       ". Given " + roll_string)
+
+            suffixes = {}
+            while position < len(tokens) and tokens[position] in ROLL_SUFFIXES:
+                suffix = tokens[position]
+                position += 1
+
+                # Every spelling of keep/drop is one suffix
+                name = "k" if suffix in ("k", "kh", "kl", "dh", "dl") else suffix
+                if name in suffixes:
+                    raise DicebotException("'" + suffix + "' can only be used once per dice. Given " + roll_string)
+
+                if suffix == "!":
+                    suffixes[name] = (suffix, None)
+                    continue
+
+                if position >= len(tokens) or not isinstance(tokens[position], int):
+                    raise DicebotException("'" + suffix + "' needs a number. Given " + roll_string)
+                suffixes[name] = (suffix, tokens[position])
+                position += 1
+
+            keep = None
+            keep_count = value
+            if "k" in suffixes:
+                suffix, count = suffixes["k"]
+
+                # Dropping dice is the same as keeping the rest from the other end
+                if suffix in ("k", "kh"):
+                    keep, keep_count = "high", count
+                elif suffix == "kl":
+                    keep, keep_count = "low", count
+                elif suffix == "dl":
+                    keep, keep_count = "high", value - count
+                else:
+                    keep, keep_count = "low", value - count
+
+                if keep_count <= 0 or keep_count > value:
+                    raise DicebotException("Can not keep " + str(keep_count) + " of " + str(value) +
+                                           " dice. Given " + roll_string)
+
+            reroll = suffixes["r"][1] if "r" in suffixes else 0
+            if reroll < 0 or reroll >= die_value:
+                raise DicebotException("Can only reroll dice below " + str(die_value) + ". Given " + roll_string)
+
+            explode = "!" in suffixes
+            if explode and die_value < 2:
+                raise DicebotException("A d1 can not explode. Given " + roll_string)
+
+            target = suffixes["t"][1] if "t" in suffixes else 0
+            if "t" in suffixes and (target < 1 or target > die_value):
+                raise DicebotException("Target must be between 1 and " + str(die_value) + ". Given " + roll_string)
+
+            total_dice += value
+            dice.append(DiceTerm(sign, value, die_value, keep, keep_count, reroll, explode, target))
+        else:
+            modifier += sign * value
+            if abs(modifier) > MAX_MODIFIER:
+                raise DicebotException("Modifier can not be more than " + str(MAX_MODIFIER) + ". Given " + roll_string)
 
-    if int(num_dice) <= 0:
-        raise DicebotException("Number of dice can not be 0 or less. Given " + input_roll_string)
+        if position >= len(tokens):
+            break
 
-    # This will accept modifiers like "2-3" (and consider it -1)
-    try:
-        int(roll_modifier)
-    except:
-        raise DicebotException("Invalid roll modifer. Given " + str(input_roll_string))
+        operator = tokens[position]
+        if operator not in ("+", "-"):
+            raise DicebotException("Invalid roll modifer. Given " + roll_string)
+        sign = 1 if operator == "+" else -1
+        position += 1
 
-    return {"num_dice": int(num_dice),
-            "die": int(die_value),
-            "modifier": int(roll_modifier)}
+    if not dice:
+        raise DicebotException("No dice found in roll. Given " + roll_string)
 
+    if total_dice > MAX_NUM_DICE:
+        raise DicebotException("Can not roll more than " + str(MAX_NUM_DICE) + " dice. Given " + roll_string)
 
-def generate_roll(roll_dict):
-    '''
-    Takes in a valid roll string and returns the sum of the roll with modifiers.
-    Assumes roll_list is a dict containing:
-    {"num_dice": <int>, "die": <int>, "modifier": <int>}
+    return RollPlan(render_roll_plan(dice, modifier), tuple(dice), modifier)
 
-    The input is assumed to have been passed from parse_roll()
 
-    Returns dict containing {"total": <int>, "modifer": <modifer_int>, "rolls": [roll_int]}
+def compile_roll(input_string):
     '''
+    Takes in any roll expression, like "1d20+5" or "4d6kh3 + 2d8 - 1d4 + 5",
+    and returns a RollPlan that can be rolled any number of times.
 
-    if not isinstance(roll_dict, dict):
-        print(roll_dict)
-        raise DicebotException("generate_roll was not passed a dict()")
-
-    # Check the fields we need in roll_dict exist
-    if "num_dice" not in roll_dict or "die" not in roll_dict or "modifier" not in roll_dict:
-        print(roll_dict)
-        raise DicebotException("Missing dictionary key in roll_dict.")
+    Whitespace and case are ignored, so "1d20 + 5" and "1D20+5" share one cached plan.
+    '''
 
     try:
-        num_dice = int(roll_dict["num_dice"])
-        die_value = int(roll_dict["die"])
-        modifier = int(roll_dict["modifier"])
+        roll_string = "".join(str(input_string).split()).lower()
     except:
-        print(roll_dict)
-        raise DicebotException("Roll dict contains non-numbers.")
+        print(input_string)  # capture the input string if it's invalid
+        raise DicebotException("Invalid roll or modifier")
 
-    if num_dice <= 0:
-        raise DicebotException("Invalid number of dice. Passed " + str(roll_dict))
+    return compile_normalized_roll(roll_string)
 
-    if die_value <= 0:
-        raise DicebotException("Invalid die value. Passed " + str(roll_dict))
 
-    rolls = []
-    for x in range(0, num_dice):
-        roll_result = random.randint(1, die_value)
-        rolls.append(roll_result)
+# Splits "6x 4d6" into the number of repeats and the roll
+BATCH_REPEAT_RE = re.compile(r"^\s*(\d+)\s*x\s*(.*)$", re.IGNORECASE)
 
-    return {"total": sum(rolls) + modifier,
-            "rolls": rolls,
-            "modifier": modifier}
+# A roll that lists every die, like "10000d6 full"
+FULL_LISTING_RE = re.compile(r"^(.*\S)\s+full\s*$", re.IGNORECASE)
 
 
-def parse_slack_message(slack_message):
+def split_full_listing(input_string):
     '''
-    Consumes a slack POST message that was sent in JSON format.
-
-    Validates the fields and passes back a simplified dict containing:
-    {
-    "username":<slack_username>,
-    "command":<slash_command>,
-    "text":<slash_command_arguments>,
-    "channel_name":<slack_channel_command_issued_in>
-    }
-
-    Slack POST messages send JSON that looks like the following:
-    {"token": "uto4ItLoT82ceQoBpIvgtzzz",
-              "team_id": "T0C3TFAGL",
-              "team_domain": "my_team_name",
-              "channel_id": "D0C3VQDAS",
-              "channel_name": "directmessage",
-              "user_id": "U0C3TFAQ4",
-              "user_name": "my_username",
-              "command": "/weather",
-              "text": "2d6",
-              "response_url": "https://hooks.slack.com/commands/T0C3TFAGL/112373954929/8k4mT8sMpIRdslA0IOMKvWSS"}
+    Returns a tuple of (roll text, full). full is True if the roll ends in "full",
+    asking for every die to be listed instead of a summary.
     '''
 
-    if "user_name" not in slack_message:
-        raise DicebotException("Invalid Slack message, no user_name in slack message: " + slack_message)
-
-    if "command" not in slack_message:
-        raise DicebotException("No command in slack message: " + slack_message)
-
-    if "text" not in slack_message:
-        raise DicebotException("No text in slack message: " + slack_message)
-
-    if "channel_name" not in slack_message:
-        raise DicebotException("No channel in slack message: " + slack_message)
-
-    return {"username": slack_message["user_name"],
-            "command": slack_message["command"],
-            "text": slack_message["text"],
-            "channel_name": slack_message["channel_name"]}
+    match = FULL_LISTING_RE.match(input_string)
+    if match is None:
+        return (input_string, False)
+    return (match.group(1), True)
 
 
-def generate_slack_response(text, in_channel=True):
+def is_batch(input_string):
     '''
-    Consumes a string message to send to slack in a public format.
-
-    If the message should be sent only to the user set in_channel=False
+    True if a /roll asks for more than one roll, like "1d20+5; 2d6+3" or "6x 4d6".
     '''
 
-    # If you wish to add slack token validation without putting the values in source
-    # Heroku env variables can be set on the heroku console
-    # and checked with this code
-    #
-    # if SLACK_WEBHOOK in os.environ:
-    #      webhook = os.environ["SLACK_WEBHOOK"]
-    #      token = os.environ["SLACK_TOKEN"]
-
-    if in_channel:
-        where = "in_channel"
-    else:
-        where = "ephemeral"
-    response = dict()
-    response["response_type"] = where
-    response["text"] = text
-    response["attachments"] = []
-
-    if debug:
-        print("Slack Response: " + str(response))
-
-    return jsonify(response)
+    return ";" in input_string or BATCH_REPEAT_RE.match(input_string) is not None
 
 
-def format_standard_roll(rolled_dice, username, roll):
+def parse_batch(input_string):
     '''
-    Takes in a rolled_dice dict, slack username and the original parsed roll
-    and returns a string.
-
-    rolled_dice is the output from generate_roll
-    roll is the output from parse_roll
-
-    This assumes the output should be for a standard dice roll (e.g., 2d6 +2).
-    Other roll formats require their own formatting methods.
-
-    Format returned is
-        <username> rolled <num>d<die> (+)<modifier>
-        <roll> + <roll> + <roll> (+)<modifier> = *<total>*
+    Takes in a list of roll expressions separated by ";". Any of them may start with
+    "<num>x" to repeat it, like "1d20+5; 1d20+5; 2x 2d6+3" or "6x 4d6kh3".
+    One ";" may end the list, other empty rolls are refused.
 
+    Returns a list of RollPlans, one per roll with repeats expanded.
+    The whole batch is held to MAX_BATCH_ROLLS rolls and MAX_NUM_DICE dice.
     '''
-    try:
-        # This is done to make output easier and to validate the inputs are strings
-        string_number_list = list(map(str, rolled_dice["rolls"]))
-    except:
-        print(rolled_dice)
-        raise DicebotException("format_standard_roll passed values that can't be cast to string")
 
-    output_text = []
     try:
-        output_text.append(str(username) + " rolled " + str(roll["num_dice"]) + "d" + str(roll["die"]) + ":")
+        batch_string = str(input_string)
     except:
-        raise DicebotException("format_standard_roll could not cast roll values to string.")
-
-    output_text.append("\n")
+        print(input_string)
+        raise DicebotException("Invalid roll or modifier")
 
-    printed_first_roll = False
+    items = batch_string.split(";")
+    if len(items) > 1 and not items[-1].strip():
+        # Allow "1d20+5; 2d6+3;"
+        items.pop()
 
-    for roll in string_number_list:
+    plans = []
+    for item in items:
+        if not item.strip():
+            raise DicebotException("Empty roll in batch. Given " + batch_string)
 
-        # Only put a "+" after the first roll
-        if printed_first_roll:
-            output_text.append(" + ")
+        repeats = 1
+        match = BATCH_REPEAT_RE.match(item)
+        if match is not None:
+            repeats = int(match.group(1))
+            item = match.group(2)
+            if repeats <= 0:
+                raise DicebotException("Can not repeat a roll 0 times. Given " + batch_string)
 
-        output_text.append(roll)
-        printed_first_roll = True
+        if len(plans) + repeats > MAX_BATCH_ROLLS:
+            raise DicebotException("Can not roll more than " + str(MAX_BATCH_ROLLS) + " rolls at once. Given " +
+                                   batch_string)
 
-    if rolled_dice["modifier"] > 0:
-        output_text.append(" (+" + str(rolled_dice["modifier"]) + ")")
+        plans.extend([compile_roll(item)] * repeats)
 
-    if rolled_dice["modifier"] < 0:
-        # Negative modifiers are "-2" so no need to prepend "-"
-        output_text.append(" (" + str(rolled_dice["modifier"]) + ")")
+    if not plans:
+        raise DicebotException("No rolls found. Given " + batch_string)
 
-    output_text.append(" = ")
-    output_text.append("*" + str(rolled_dice["total"]) + "*")
-    output_text.append("\n")
+    if sum(term.num_dice for plan in plans for term in plan.dice) > MAX_NUM_DICE:
+        raise DicebotException("Can not roll more than " + str(MAX_NUM_DICE) + " dice. Given " + batch_string)
 
-    return "".join(output_text)
+    return plans
 
 
-def format_adv_dis_roll(rolled_dice, username, roll, adv=False, dis=False):
+def is_simple_plan(plan):
+    '''
+    True if the RollPlan is a plain <num>d<die> +/- <num> roll that parse_roll() can
+    represent as a dict.
     '''
-    Takes in a generate_roll dict, slack username, and original parsed roll.
-    Set adv=True or dis=True based on what formatting to return.
 
-    Returns a string ready to be passed to the slack message builder.
+    if len(plan.dice) != 1:
+        return False
 
-    Format is
-        <username> rolled at [advantage | disadvantage] (+) <modifier>
-        <roll> ~<roll>~ ((+)<modifier>) = *<total>*
+    term = plan.dice[0]
+    return term.sign > 0 and term.keep is None and not term.reroll and not term.explode and not term.target
 
-    The ignored roll is printed with strikethrough.
+
+class RollSpec(object):
     '''
+    A plain <num_dice>d<die> +/- <modifier> roll, what parse_roll_spec() returns.
 
-    output_text = []
-    try:
-        if adv:
-            output_text.append(str(username) + " rolled at Advantage:")
-        if dis:
-            output_text.append(str(username) + " rolled at Disadvantage:")
-    except:
-        print(username)
-        raise DicebotException("format_adv_dis_roll could not cast roll values to string.")
+    The constructor trusts its arguments, it is for code that has checked them
+    already, like parse_roll_spec() after compile_roll(). Anything else builds
+    one with create() or from_dict(), which raise a DicebotException for bad
+    values. A RollSpec is always valid, so generate_roll_results() doesn't check again.
 
-    output_text.append("\n")
+    spec["die"] works like it does on the parse_roll() dict.
+    '''
 
-    if roll["num_dice"] != 2:
-        print(roll)
-        raise DicebotException("Trying to format adv/dis roll with more than 2d20")
+    __slots__ = ("num_dice", "die", "modifier")
 
-    if adv:
-        try:
-            if rolled_dice["rolls"][0] >= rolled_dice["rolls"][1]:
-                output_text.append("*" + str(rolled_dice["rolls"][0]) + "*")
-                output_text.append(" ")
-                output_text.append("~" + str(rolled_dice["rolls"][1]) + "~")
-                result = rolled_dice["rolls"][0]
-            if rolled_dice["rolls"][1] > rolled_dice["rolls"][0]:
-                output_text.append("~" + str(rolled_dice["rolls"][0]) + "~")
-                output_text.append(" ")
-                output_text.append("*" + str(rolled_dice["rolls"][1]) + "*")
-                result = rolled_dice["rolls"][1]
-        except:
-            print(traceback.format_exc())
-            raise DicebotException("format_adv_dis_roll had a problem rolling at advantage")
+    def __init__(self, num_dice, die, modifier):
+        self.num_dice = num_dice
+        self.die = die
+        self.modifier = modifier
 
-    if dis:
+    @classmethod
+    def create(cls, num_dice, die, modifier):
         try:
-            if rolled_dice["rolls"][0] <= rolled_dice["rolls"][1]:
-                output_text.append("*" + str(rolled_dice["rolls"][0]) + "*")
-                output_text.append(" ")
-                output_text.append("~" + str(rolled_dice["rolls"][1]) + "~")
-                result = rolled_dice["rolls"][0]
-            if rolled_dice["rolls"][1] < rolled_dice["rolls"][0]:
-                output_text.append("~" + str(rolled_dice["rolls"][0]) + "~")
-                output_text.append(" ")
-                output_text.append("*" + str(rolled_dice["rolls"][1]) + "*")
-                result = rolled_dice["rolls"][1]
+            num_dice = int(num_dice)
+            die_value = int(die)
+            modifier = int(modifier)
         except:
-            print(traceback.format_exc())
-            raise DicebotException("format_adv_dis_roll had a problem rolling at disadvantage")
+            print((num_dice, die, modifier))
+            raise DicebotException("Roll contains non-numbers.")
 
-    if rolled_dice["modifier"] > 0:
-        output_text.append(" (+" + str(rolled_dice["modifier"]) + ")")
-    if rolled_dice["modifier"] < 0:
-        output_text.append(" (" + str(rolled_dice["modifier"]) + ")")
+        if num_dice <= 0 or num_dice > MAX_NUM_DICE:
+            raise DicebotException("Invalid number of dice. Passed " + str(num_dice))
 
-    output_text.append(" = ")
-    output_text.append("*" + str((result + rolled_dice["modifier"])) + "*")
-    output_text.append("\n")
+        # The faces are stored as unsigned 16 bit ints, see RollResult
+        if die_value <= 0 or die_value > MAX_DIE_VALUE:
+            raise DicebotException("Invalid die value. Passed " + str(die_value))
 
-    return "".join(output_text)
+        if abs(modifier) > MAX_MODIFIER:
+            raise DicebotException("Invalid modifier. Passed " + str(modifier))
 
+        return cls(num_dice, die_value, modifier)
 
-def format_character_roll(roll_list, username):
-    '''
-    Takes in a a list of 6 generate_roll dicts and the slack username
-    Indicates the low and total for each roll dict.
-    Returns a string ready to be passed to the slack message builder.
+    @classmethod
+    def from_dict(cls, roll_dict):
+        '''
+        Checks a roll dict from parse_roll() and returns its RollSpec.
+        '''
 
-    Format is:
-    <username> rolled a stat block:
-    ~<low>~ <num> + <num> + <num> = *<total>*
-    ~<low>~ <num> + <num> + <num> = *<total>*
-    ~<low>~ <num> + <num> + <num> = *<total>*
-    ~<low>~ <num> + <num> + <num> = *<total>*
-    ~<low>~ <num> + <num> + <num> = *<total>*
-    ~<low>~ <num> + <num> + <num> = *<total>*
-    '''
+        if not isinstance(roll_dict, dict):
+            print(roll_dict)
+            raise DicebotException("generate_roll was not passed a dict()")
 
-    output_text = []
-    try:
-        output_text.append(str(username) + " rolled a stat block:")
-    except:
-        print(username)
-        raise DicebotException("format_character_roll username is not a string")
+        # Check the fields we need in roll_dict exist
+        if "num_dice" not in roll_dict or "die" not in roll_dict or "modifier" not in roll_dict:
+            print(roll_dict)
+            raise DicebotException("Missing dictionary key in roll_dict.")
 
-    output_text.append("\n")
+        return cls.create(roll_dict["num_dice"], roll_dict["die"], roll_dict["modifier"])
 
-    if len(roll_list) != 6:
-        print(roll_list)
-        raise DicebotException("Incorrect number of rolls in the stat block")
+    def to_dict(self):
+        return {"num_dice": self.num_dice, "die": self.die, "modifier": self.modifier}
 
-    # {"total": <int>, "modifer": <modifer_int>, "rolls": [roll_int]}
-    for roll in roll_list:
-        try:
-            sorted_rolls = sorted(roll["rolls"], key=int)
-            output_text.append("~" + str(sorted_rolls[0]) + "~ ")
-            output_text.append(str(sorted_rolls[1]) + " + ")
-            output_text.append(str(sorted_rolls[2]) + " + ")
-            output_text.append(str(sorted_rolls[3]) + " = ")
-            output_text.append("*" + str(sorted_rolls[1] + sorted_rolls[2] + sorted_rolls[3]) + "*")
-        except:
-            print(traceback.format_exc())
-            raise DicebotException("Unable to print statblock")
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
 
-        output_text.append("\n")
+    def __eq__(self, other):
+        if not isinstance(other, RollSpec):
+            return NotImplemented
+        return (self.num_dice, self.die, self.modifier) == (other.num_dice, other.die, other.modifier)
 
-    return "".join(output_text)
+    def __repr__(self):
+        return "RollSpec(" + str(self.num_dice) + ", " + str(self.die) + ", " + str(self.modifier) + ")"
 
-# Handle standard rolls in the style 2d6 +3
-@app.route('/roll', methods=["GET", "POST"])
-def test_roll():
 
-    if debug:
-        print(request.form)
+class RollResult(object):
+    '''
+    The rolled dice of one RollSpec, what generate_roll_results() returns.
 
-    try:
-        # First parse the inbound slack message and get a simple dict
-        slack_dict = parse_slack_message(request.form)
+    rolls is an array of unsigned 16 bit ints (roll_journal.FACE_TYPE), 2 bytes a
+    die instead of a pointer to an int object, and goes into the journal as it is.
+    result["rolls"] works like it does on the generate_roll() dict, to_dict()
+    gives that dict with rolls as a list.
+    '''
 
-        # Next, parse and validate the roll from slack
-        parsed_roll = parse_roll(slack_dict["text"])
+    __slots__ = ("total", "rolls", "modifier", "rng")
 
-        # Roll all the dice we've been asked to roll
-        rolled_dice = generate_roll(parsed_roll)
+    def __init__(self, total, rolls, modifier, rng):
+        self.total = total
+        self.rolls = rolls
+        self.modifier = modifier
+        self.rng = rng
 
-        # Build the message to send back to slack based on the rolled dice,
-        # the user who asked and the original dice they asked to roll.
-        output = format_standard_roll(rolled_dice, slack_dict["username"], parsed_roll)
+    def to_dict(self):
+        return {"total": self.total, "rolls": self.rolls.tolist(), "modifier": self.modifier, "rng": self.rng}
 
-    # Any errors thrown will all be caught right here.
-    except DicebotException as dbe:
-        return generate_slack_response("error: " + str(dbe) + \
-                                       "\n Please use /roll <num>d<num> (+/-)<num>",
-                                       in_channel=False)
-    except:
-        # Ending up here means an exception was thrown that we didn't catch. A bug.
-        print("Unhandled traceback in /roll")
-        print(traceback.format_exc)
-        return generate_slack_response("Hmm....something went wrong. Try again?", in_channel=False)
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
 
-    return generate_slack_response(output)
+    def __repr__(self):
+        return ("RollResult(" + str(self.total) + ", " + str(self.rolls.tolist()) + ", " +
+                str(self.modifier) + ", " + str(self.rng) + ")")
 
 
-# Handle rolling at advantage
-# Roll 2d20 and drop the low
-@app.route('/adv', methods=["GET", "POST"])
-def adv_roll():
+# A macro name, like "attack" or "str-save". Rolls start with a number or a sign,
+# so a name never reads as a roll. Names like "d20" are left out too, so a roll
+# missing its number is never looked up in the macro store
+MACRO_NAME_RE = re.compile(r"^(?!d\d)[a-z][a-z0-9_-]{0,31}$")
 
-    if debug:
-        print(request.form)
+# A macro of only a modifier, like "+3", is a character modifier rolled with a d20
+MACRO_MODIFIER_RE = re.compile(r"^\s*[+-][\s\d+-]*$")
 
-    try:
-        # Parse the incoming slack JSON message
-        slack_dict = parse_slack_message(request.form)
+# /macro <name> = <roll> saves a macro and /macro remove <name> removes one
+MACRO_SAVE_RE = re.compile(r"^(\S+?)\s*=\s*(.*)$")
+MACRO_REMOVE_RE = re.compile(r"^(?:remove|delete)\s+(\S+)$", re.IGNORECASE)
 
-        # Parse the input, but set it to only roll 2d20
-        parsed_roll = parse_roll(slack_dict["text"], adv_or_dis=True)
 
-        # Roll the 2d20 and modifier
-        rolled_dice = generate_roll(parsed_roll)
+def compile_macro(expression):
+    '''
+    Compiles the text of a saved macro into a RollPlan. A macro of only a
+    modifier, like "+3", is rolled as 1d20 with that modifier.
+    '''
 
-        # Build the result of the rolls
-        output = format_adv_dis_roll(rolled_dice, slack_dict["username"], parsed_roll, adv=True)
+    if MACRO_MODIFIER_RE.match(expression):
+        return compile_roll("1d20" + expression)
+    return compile_roll(expression)
 
-    except DicebotException as dbe:
-        return generate_slack_response("error: " + str(dbe) + "\n Please use /adv (+/-)<num>", in_channel=False)
-    except:
-        print("Unhandled traceback in /adv")
-        print(traceback.format_exc())
-        return generate_slack_response("Hmm....something went wrong. Try again?", in_channel=False)
 
-    return generate_slack_response(output)
+# Saved macros of every user, in a SQLite file shared by every worker. It is kept in
+# DICEBOT_DATA_DIR, or next to this file, unless DICEBOT_MACROS_FILE names another path.
+# The tests set it to ":memory:". See roll_macros.py
+DATA_DIR = os.environ.get("DICEBOT_DATA_DIR") or os.path.dirname(os.path.abspath(__file__))
+MACROS_FILE = os.environ.get("DICEBOT_MACROS_FILE") or os.path.join(DATA_DIR, "dicebot_macros.db")
+macro_store = roll_macros.MacroStore(MACROS_FILE, compile_macro)
 
 
-# Handle rolling at disadvantage
-# Roll 2d20 and drop the high
-@app.route('/dis', methods=["GET", "POST"])
-def dis_roll():
+def find_macro(slack_dict, input_string):
+    '''
+    Returns the RollPlan of the user's macro called input_string, or None if it is
+    not the name of one of their macros. Text that can't be a name, like every
+    roll, returns before the macro store is touched. Saved macros are cached
+    compiled, so a name is a dict lookup after the user's first.
+    '''
 
-    if debug:
-        print(request.form)
+    name = input_string.strip().lower()
+    if MACRO_NAME_RE.match(name) is None:
+        return None
+    return macro_store.get(slack_dict["username"], name)
 
-    try:
-        #Parse the incoming slack JSON message
-        slack_dict = parse_slack_message(request.form)
 
-        # Parse the input, but set it to only roll 2d20
-        parsed_roll = parse_roll(slack_dict["text"], adv_or_dis=True)
+def parse_adv_dis(slack_dict):
+    '''
+    Returns the RollSpec of an /adv or /dis roll, 2d20 with the modifier given or
+    the modifier of the user's d20 macro named, like /adv str-save.
+    '''
 
-        # Roll 2d20 and modifiers
-        rolled_dice = generate_roll(parsed_roll)
+    plan = find_macro(slack_dict, slack_dict["text"])
+    if plan is None:
+        return adv_dis_spec(slack_dict["text"])
 
-        # Build the output
-        output = format_adv_dis_roll(rolled_dice, slack_dict["username"], parsed_roll, dis=True)
+    if not is_simple_plan(plan) or plan.dice[0].num_dice != 1 or plan.dice[0].die != 20:
+        raise DicebotException("Only a 1d20 macro can be rolled at advantage or disadvantage. " +
+                               slack_dict["text"].strip() + " is " + plan.text)
+    return RollSpec(2, 20, plan.modifier)
 
-    except DicebotException as dbe:
-        return generate_slack_response("error: " + str(dbe) + "\n Please use /dis (+/-)<num>", in_channel=False)
-    except:
-        print("Unhandled traceback in /dis")
-        print(traceback.format_exc())
-        return generate_slack_response("Hmm....something went wrong. Try again?", in_channel=False)
 
-    return generate_slack_response(output)
+@lru_cache(maxsize=ROLL_CACHE_SIZE)
+def adv_dis_spec(input_string):
+    '''
+    Returns parse_roll_spec(input_string, adv_or_dis=True), kept by text since
+    /adv and /dis are sent the same few modifiers over and over. The RollSpec
+    is shared, don't change it.
+    '''
 
+    return parse_roll_spec(input_string, adv_or_dis=True)
 
-# Build a new character stat block
-# Roll 4d6 and drop the low. Do it 6 times
-@app.route('/character', methods=["GET", "POST"])
-def character():
-    if debug:
-        print(request.form)
 
-    try:
-        # Parse the incoming Slack JSON
-        slack_dict = parse_slack_message(request.form)
+def parse_roll_spec(input_string, adv_or_dis=False, character=False):
+    '''
+    Takes in a roll_string from the slack command.
+    Expected format is <num_dice>d<die_value>.
+    Examples: 1d4, 2d6, 3d8, 99d100
 
-        # Build a roll dict, but ignore all inputs (dice or modifiers)
-        parsed_roll = parse_roll(slack_dict["text"], character=True)
+    A valid roll can also include "+<num>" or "-<num>"
+    Spaces are allowed on either side of the +/-
 
-        # This will hold the dict of the roll result.
-        roll = []
-        for x in range(6): # Roll 4d6, 6 times
-            roll.append(generate_roll(parsed_roll))
+    Examples: 4d4 + 2, 2d6+1, 8d12 +11
 
-        # Build the output
-        output = format_character_roll(roll, slack_dict["username"])
+    Longer expressions, like "4d6kh3 + 2d8", must go through compile_roll() instead.
 
-    except DicebotException as dbe:
-        return generate_slack_response("error: " + str(dbe) + "\n Please use /character", in_channel=False)
-    except:
-        print("Unhandled traceback in /character")
+    adv_or_dis = True means that the roll will be set to 2d20
+    character = True means the roll will be set to 4d6
+
+    Returns a RollSpec.
+    '''
+    try:
+        if adv_or_dis:
+            if debug:
+                print("Rolling adv/dis")
+            # Need to append the input_string in case there are modifiers
+            # Let the rest of the function determine if the input_string is valid
+            input_roll_string = "2d20" + str(input_string)
+
+        elif character:
+            if debug:
+                print("Rolling character")
+            # Stat blocks do not have modifiers, so ignore any input.
+            input_roll_string = "4d6"
+
+        else:
+            if debug:
+                print("normal roll")
+            input_roll_string = str(input_string)
+    except:
+        print(input_string)  # capture the input string if it's invalid
+        raise DicebotException("Invalid roll or modifier")
+
+    plan = compile_roll(input_roll_string)
+
+    if not is_simple_plan(plan):
+        raise DicebotException("Only one set of dice and a modifier is allowed. Given " + input_roll_string)
+
+    # compile_roll() checked the limits already
+    return RollSpec(plan.dice[0].num_dice, plan.dice[0].die, plan.modifier)
+
+
+def parse_roll(input_string, adv_or_dis=False, character=False):
+    '''
+    Same as parse_roll_spec(), but returns a dict of:
+    {"num_dice": int(number_of_dice),
+     "die": int(die),
+     "modifier": modifier}
+    '''
+
+    return parse_roll_spec(input_string, adv_or_dis, character).to_dict()
+
+
+def validate_roll_dict(roll_dict):
+    '''
+    Checks a roll dict from parse_roll() and returns a clean tuple of
+    (num_dice, die, modifier) as ints.
+
+    Raises a DicebotException if the dict is missing keys or holds bad values.
+    '''
+
+    spec = RollSpec.from_dict(roll_dict)
+    return (spec.num_dice, spec.die, spec.modifier)
+
+
+def bulk_draw_dice(spec_list):
+    '''
+    Draws the faces for a list of (num_dice, die) tuples from rng_backend in one call.
+
+    Returns a tuple of (rolls, record). rolls is a list of lists of ints, one list of
+    faces per spec, and record is what replay_dice() needs to roll the same faces again.
+    '''
+
+    return rng_backend.draw(spec_list)
+
+
+def replay_dice(spec_list, record):
+    '''
+    Rolls the same faces as the draw that returned record. Raises a DicebotException
+    if the roll can not be replayed, like rolls from the system backend or the random pool.
+    '''
+
+    if record is None:
+        raise DicebotException("This roll has no random number record and can not be replayed")
+
+    try:
+        return record_backend(record).replay(record, spec_list)
+    except ValueError as error:
+        raise DicebotException(str(error))
+
+
+def record_backend(record):
+    '''
+    Returns the backend that drew record. Raises ValueError for unknown backends.
+    '''
+
+    if record.get("backend") == rng_backend.name:
+        return rng_backend
+    return rng_backends.create_backend(record.get("backend"))
+
+
+def draw_dice(spec_list):
+    '''
+    Returns the faces for a list of (num_dice, die) tuples as a tuple of (rolls, record).
+    See bulk_draw_dice().
+
+    When the random pool is turned on, specs it can supply are popped from the pool
+    and only the rest are drawn with bulk_draw_dice(). Pool faces can't be replayed,
+    so the record is None if the pool supplied any of them.
+    '''
+
+    metrics_registry.inc("dicebot_dice_drawn_total", amount=sum(num_dice for num_dice, die in spec_list))
+
+    if random_pool is None:
+        return bulk_draw_dice(spec_list)
+
+    rolls = [random_pool.take(die, num_dice) for num_dice, die in spec_list]
+
+    missing = [position for position, faces in enumerate(rolls) if faces is None]
+    missed = sum(spec_list[position][0] for position in missing)
+    if missed:
+        metrics_registry.inc("dicebot_random_pool_misses_total", amount=missed)
+    if len(missing) < len(rolls):
+        metrics_registry.inc("dicebot_random_pool_hits_total",
+                             amount=sum(num_dice for num_dice, die in spec_list) - missed)
+
+    if len(missing) == len(rolls):
+        return bulk_draw_dice(spec_list)
+
+    if missing:
+        drawn, record = bulk_draw_dice([spec_list[position] for position in missing])
+        for position, faces in zip(missing, drawn):
+            rolls[position] = faces
+
+    return (rolls, None)
+
+
+def draw_more_dice(spec_list, record, step, replay=False):
+    '''
+    Draws follow up dice, like rerolls, for the draw that returned record.
+    Every step of one roll must use a different step number, starting at 1.
+
+    With replay=True the faces of an earlier roll are drawn again. A roll without
+    a record, like one from the random pool, just draws new dice.
+
+    Returns a list of lists of ints, one list of faces per spec.
+    '''
+
+    if record is None:
+        return draw_dice(spec_list)[0]
+
+    try:
+        backend = record_backend(record)
+        if replay:
+            return backend.replay_step(record, step, spec_list)
+        metrics_registry.inc("dicebot_dice_drawn_total", amount=sum(num_dice for num_dice, die in spec_list))
+        return backend.draw_step(record, step, spec_list)
+    except ValueError as error:
+        raise DicebotException(str(error))
+
+
+def generate_roll_results(spec_list, record=None):
+    '''
+    Rolls every RollSpec in spec_list with one bulk draw. They do not need to share
+    a die size, for example /character passes six 4d6 specs at once.
+
+    Pass the "rng" record from an earlier result to replay exactly the same roll.
+
+    Returns a list of RollResults in the same order.
+    '''
+
+    dice_list = [(spec.num_dice, spec.die) for spec in spec_list]
+
+    if record is None:
+        rolls, record = draw_dice(dice_list)
+    else:
+        rolls = replay_dice(dice_list, record)
+
+    return [RollResult(sum(dice) + spec.modifier, array(roll_journal.FACE_TYPE, dice), spec.modifier, record)
+            for spec, dice in zip(spec_list, rolls)]
+
+
+def generate_rolls(roll_list, record=None):
+    '''
+    Rolls every roll dict in roll_list with one bulk draw, see generate_roll_results().
+    Each entry is a dict from parse_roll().
+
+    Returns a list of dicts in the same order, each containing
+    {"total": <int>, "modifer": <modifer_int>, "rolls": [roll_int], "rng": <record>}
+    '''
+
+    spec_list = [RollSpec.from_dict(roll_dict) for roll_dict in roll_list]
+    return [result.to_dict() for result in generate_roll_results(spec_list, record)]
+
+
+def generate_roll(roll_dict):
+    '''
+    Takes in a valid roll string and returns the sum of the roll with modifiers.
+    Assumes roll_list is a dict containing:
+    {"num_dice": <int>, "die": <int>, "modifier": <int>}
+
+    The input is assumed to have been passed from parse_roll()
+
+    Returns dict containing {"total": <int>, "modifer": <modifer_int>, "rolls": [roll_int], "rng": <record>}
+    '''
+
+    return generate_rolls([roll_dict])[0]
+
+
+def find_dropped_dice(rolls, keep, keep_count):
+    '''
+    Returns the set of positions in rolls that do not count towards a keep-highest
+    or keep-lowest term. Ties drop the earliest roll first when keeping the highest
+    and the latest first when keeping the lowest. See dice_pool.py.
+    '''
+
+    return dice_pool.count_pool(rolls, keep, keep_count)[1]
+
+
+def reroll_dice(plan, rolls, record, replay):
+    '''
+    Rerolls, once, every die at or below its term's reroll value, in one draw.
+    rolls is changed in place.
+    '''
+
+    positions = [[position for position, face in enumerate(dice) if face <= term.reroll] if term.reroll else []
+                 for term, dice in zip(plan.dice, rolls)]
+    rerolled = [index for index, found in enumerate(positions) if found]
+    if not rerolled:
+        return
+
+    faces = draw_more_dice([(len(positions[index]), plan.dice[index].die) for index in rerolled],
+                           record, 1, replay)
+    for index, new_faces in zip(rerolled, faces):
+        for position, face in zip(positions[index], new_faces):
+            rolls[index][position] = face
+
+
+def explode_dice(plan, rolls, record, replay):
+    '''
+    Adds a die for every die showing its highest face on exploding terms, and
+    again for those new dice, up to dice_pool.MAX_EXPLODE_ROUNDS rounds.
+    Each round is one draw. rolls is changed in place.
+    '''
+
+    counts = [dice.count(term.die) if term.explode else 0 for term, dice in zip(plan.dice, rolls)]
+
+    # Step 1 is the reroll
+    for step in range(2, dice_pool.MAX_EXPLODE_ROUNDS + 2):
+        exploded = [index for index, count in enumerate(counts) if count]
+        if not exploded:
+            return
+
+        faces = draw_more_dice([(counts[index], plan.dice[index].die) for index in exploded], record, step, replay)
+        counts = [0] * len(counts)
+        for index, new_faces in zip(exploded, faces):
+            rolls[index].extend(new_faces)
+            counts[index] = new_faces.count(plan.dice[index].die)
+
+
+def generate_plan_roll(plan, record=None):
+    '''
+    Rolls a RollPlan from compile_roll(). Every dice term is drawn in one bulk call,
+    then rerolls and exploding dice are drawn in one call per round.
+    Pass the "rng" record from an earlier result to replay exactly the same roll.
+
+    Returns a dict containing
+    {"total": <int>, "modifier": <int>, "rng": <record>,
+     "terms": [{"rolls": [roll_int], "dropped": set(positions), "subtotal": <int>}]}
+
+    There is one entry in "terms" for each DiceTerm in the plan. The subtotal is signed,
+    and for terms with a target it is the number of successes.
+    '''
+
+    dice_list = [(term.num_dice, term.die) for term in plan.dice]
+    replay = record is not None
+    if replay:
+        rolls = replay_dice(dice_list, record)
+    else:
+        rolls, record = draw_dice(dice_list)
+
+    reroll_dice(plan, rolls, record, replay)
+    explode_dice(plan, rolls, record, replay)
+
+    terms = []
+    total = plan.modifier
+    for term, dice in zip(plan.dice, rolls):
+        # Counted from a histogram of the faces, big pools are never sorted
+        value, dropped = dice_pool.count_pool(dice, term.keep, term.keep_count, term.target)
+        subtotal = term.sign * value
+        total += subtotal
+        terms.append({"rolls": dice, "dropped": dropped, "subtotal": subtotal})
+
+    return {"total": total,
+            "modifier": plan.modifier,
+            "rng": record,
+            "terms": terms}
+
+
+def generate_batch_roll(plans, record=None):
+    '''
+    Rolls a list of RollPlans from parse_batch() with one bulk draw for all of them.
+    Pass the "rng" record from an earlier result to replay exactly the same rolls.
+
+    Returns a dict containing
+    {"rolls": [generate_plan_roll dict], "rng": <record>}
+    with one entry in "rolls" for each plan.
+    '''
+
+    # Roll every term of every plan as one plan, then split the terms back up
+    combined = RollPlan("; ".join(plan.text for plan in plans),
+                        tuple(term for plan in plans for term in plan.dice), 0)
+    rolled = generate_plan_roll(combined, record)
+
+    rolls = []
+    position = 0
+    for plan in plans:
+        terms = rolled["terms"][position:position + len(plan.dice)]
+        position += len(plan.dice)
+        rolls.append({"total": plan.modifier + sum(term["subtotal"] for term in terms),
+                      "modifier": plan.modifier,
+                      "rng": rolled["rng"],
+                      "terms": terms})
+
+    return {"rolls": rolls, "rng": rolled["rng"]}
+
+
+def record_roll(slack_dict, expression, total, groups, record):
+    '''
+    Adds a roll to the journal, if it is turned on, and to the /stats statistics.
+    groups is a list of (die, faces) pairs covering every die rolled and record is
+    the "rng" record of the roll. This never waits on the disk.
+    '''
+
+    if journal is not None:
+        if len(groups) == 1:
+            # Usually a RollResult's array, the journal packs it without a copy to a list
+            faces = groups[0][1]
+        else:
+            faces = [face for die, faces in groups for face in faces]
+        if not journal.append(slack_dict["username"], slack_dict["channel_name"], expression, total, faces, record):
+            metrics_registry.inc("dicebot_journal_dropped_total")
+    roll_statistics.record(slack_dict["channel_name"], slack_dict["username"], groups)
+
+
+def record_plan_roll(slack_dict, rolled_plan, plan):
+    record_roll(slack_dict, plan.text, rolled_plan["total"],
+                [(term.die, rolled_term["rolls"]) for term, rolled_term in zip(plan.dice, rolled_plan["terms"])],
+                rolled_plan["rng"])
+
+
+def get_journal_reader():
+    '''
+    Returns the JournalReader for the journal directory, made the first time it is needed.
+    '''
+
+    global journal_reader
+
+    if journal is None:
+        raise DicebotException("Roll history is not turned on")
+
+    if journal_reader is None:
+        journal_reader = roll_journal.JournalReader(journal.directory)
+    return journal_reader
+
+
+def parse_history(input_string, slack_dict):
+    '''
+    Takes in the text of a /history command, nothing or a username (with or without @).
+
+    Returns a dict of {"user": <username>, "channel": <channel_name>}
+    '''
+
+    try:
+        history_string = str(input_string).strip()
+    except:
+        print(input_string)
+        raise DicebotException("Invalid history request")
+
+    if not history_string:
+        user = slack_dict["username"]
+    elif len(history_string.split()) == 1:
+        user = history_string.lstrip("@")
+    else:
+        raise DicebotException("Only one username at a time. Given " + history_string)
+
+    return {"user": user, "channel": slack_dict["channel_name"]}
+
+
+def parse_macro(input_string):
+    '''
+    Takes in the text of a /macro command:
+        nothing to list the user's macros
+        <name> = <roll> to save one, like attack = 1d20+7 or str-save = +3
+        remove <name> to remove one
+
+    Returns a dict of {"action": "list" | "save" | "remove", "name": <name or None>,
+    "expression": <roll text or None>}
+    '''
+
+    try:
+        macro_string = str(input_string).strip()
+    except:
+        print(input_string)
+        raise DicebotException("Invalid macro request")
+
+    if not macro_string:
+        return {"action": "list", "name": None, "expression": None}
+
+    match = MACRO_SAVE_RE.match(macro_string)
+    if match is not None:
+        action, name, expression = "save", match.group(1).lower(), match.group(2).strip()
+        if not expression:
+            raise DicebotException("Give the roll to save, like /macro " + name + " = 1d20+5")
+    else:
+        match = MACRO_REMOVE_RE.match(macro_string)
+        if match is None:
+            raise DicebotException("Unable to read macro request. Given " + macro_string)
+        action, name, expression = "remove", match.group(1).lower(), None
+
+    if MACRO_NAME_RE.match(name) is None:
+        raise DicebotException("Macro names start with a letter and use letters, numbers, - and _, "
+                               "up to 32 characters, and can't look like a die such as d20. Given " + name)
+
+    return {"action": action, "name": name, "expression": expression}
+
+
+def generate_history(parsed_history):
+    '''
+    Takes in a parse_history dict and returns a dict of
+    {"rolls": [<JournalReader.history dict>], "stats": <JournalReader.user_stats dict>}
+    '''
+
+    reader = get_journal_reader()
+    try:
+        return {"rolls": reader.history(user=parsed_history["user"], channel=parsed_history["channel"],
+                                        limit=HISTORY_LIMIT),
+                "stats": reader.user_stats(parsed_history["user"])}
+    except (OSError, ValueError) as error:
+        print(traceback.format_exc())
+        raise DicebotException("Unable to read the roll history: " + str(error))
+
+
+def generate_stats(channel):
+    '''
+    Works out the /stats of a channel from the running statistics. Returns a dict of
+    {"players": [{"user": <str>, "d20s": <int>, "average": <float>, "nat20s": <int>, "nat1s": <int>,
+                  "best_high": <int>, "best_low": <int>}],
+     "luckiest": (<user>, <luck float>) or None}
+
+    Players are the users who have rolled a d20 here, most d20s first. The luckiest player
+    has the highest luck of this session, see roll_stats.Aggregate.luck().
+    '''
+
+    statistics = roll_statistics.current(channel)
+
+    players = []
+    for user, aggregate in statistics.totals.get(channel, {}).items():
+        d20 = aggregate.dies.get(20)
+        if d20 is None:
+            continue
+        players.append({"user": user,
+                        "d20s": d20.count,
+                        "average": d20.total / d20.count,
+                        "nat20s": d20.faces[20],
+                        "nat1s": d20.faces[1],
+                        "best_high": aggregate.best_high,
+                        "best_low": aggregate.best_low})
+    players.sort(key=lambda player: (-player["d20s"], player["user"]))
+
+    luckiest = None
+    for user, aggregate in statistics.sessions.get(channel, {}).items():
+        if sum(stats.count for stats in aggregate.dies.values()) < roll_stats.MIN_LUCK_DICE:
+            continue
+        luck = aggregate.luck()
+        if luck is not None and (luckiest is None or luck > luckiest[1]):
+            luckiest = (user, luck)
+
+    return {"players": players, "luckiest": luckiest}
+
+
+# Splits "/odds 3d8+2 >= 15" into the roll and the target
+ODDS_TARGET_RE = re.compile(r"^(.*?)(>=|<=|>|<|=)\s*(-?\d+)\s*$")
+
+
+def parse_odds(input_string):
+    '''
+    Takes in the text of an /odds command. Expected format is <roll> [<comparison> <target>].
+    Examples: 3d8+2 >= 15, 2d20kh1 + 5 > 12, 4d6dl1
+
+    The comparison is one of >=, >, <=, < or =
+
+    returns a dict of:
+    {"plan": RollPlan, "comparison": <comparison_string or None>, "target": <int or None>}
+    '''
+
+    try:
+        odds_string = str(input_string)
+    except:
+        print(input_string)
+        raise DicebotException("Invalid odds request")
+
+    match = ODDS_TARGET_RE.match(odds_string)
+    if match is None:
+        return {"plan": compile_roll(odds_string), "comparison": None, "target": None}
+
+    return {"plan": compile_roll(match.group(1)),
+            "comparison": match.group(2),
+            "target": int(match.group(3))}
+
+
+def generate_odds(parsed_odds):
+    '''
+    Takes in a parse_odds dict and works out the exact distribution of the roll.
+
+    Returns a dict containing
+    {"low": <int>, "high": <int>, "mean": <float>, "chance": <float or None>}
+    '''
+
+    plan = parsed_odds["plan"]
+    try:
+        distribution = odds.plan_distribution(plan.dice, plan.modifier)
+    except ValueError as error:
+        raise DicebotException(str(error) + ". Given " + plan.text)
+
+    result = {"low": distribution[0],
+              "high": distribution[0] + len(distribution[1]) - 1,
+              "mean": odds.mean(distribution),
+              "chance": None}
+
+    if parsed_odds["comparison"] is not None:
+        result["chance"] = odds.chance(distribution, parsed_odds["comparison"], parsed_odds["target"])
+
+    return result
+
+
+# Splits "/simulate 4d6! >= 20 500000 trials" into the rest and the number of trials
+SIMULATE_TRIALS_RE = re.compile(r"^(.*?)\s*(\d+)\s*trials\s*$")
+
+
+def parse_simulate(input_string):
+    '''
+    Takes in the text of a /simulate command. Expected format is
+    <roll> [<comparison> <target>] [<num> trials]
+    Examples: 4d6r1kh3, 6d10t8 >= 3, 2d6! > 10 100000 trials
+
+    returns a dict of:
+    {"plan": RollPlan, "comparison": <comparison_string or None>, "target": <int or None>,
+     "trials": <int>}
+    '''
+
+    try:
+        simulate_string = str(input_string)
+    except:
+        print(input_string)
+        raise DicebotException("Invalid simulate request")
+
+    trials = simulate.DEFAULT_TRIALS
+    match = SIMULATE_TRIALS_RE.match(simulate_string)
+    if match is not None:
+        simulate_string = match.group(1)
+        trials = int(match.group(2))
+        if trials <= 0 or trials > MAX_SIMULATE_TRIALS:
+            raise DicebotException("Number of trials must be between 1 and " + str(MAX_SIMULATE_TRIALS) +
+                                   ". Given " + str(input_string))
+
+    parsed_simulate = parse_odds(simulate_string)
+    parsed_simulate["trials"] = trials
+    return parsed_simulate
+
+
+def generate_simulation(parsed_simulate, seed=None):
+    '''
+    Takes in a parse_simulate dict and rolls it up to "trials" times, within
+    simulate.DEFAULT_TIME_BUDGET seconds. See simulate.simulate() for the dict returned.
+    '''
+
+    plan = parsed_simulate["plan"]
+    try:
+        return simulate.simulate(plan.dice, plan.modifier, trials=parsed_simulate["trials"],
+                                 comparison=parsed_simulate["comparison"], target=parsed_simulate["target"],
+                                 workers=SIMULATE_WORKERS, seed=seed)
+    except ValueError as error:
+        raise DicebotException(str(error) + ". Given " + plan.text)
+
+
+def parse_slack_message(slack_message):
+    '''
+    Consumes a slack POST message that was sent in JSON format.
+
+    Validates the fields and passes back a simplified dict containing:
+    {
+    "username":<slack_username>,
+    "command":<slash_command>,
+    "text":<slash_command_arguments>,
+    "channel_name":<slack_channel_command_issued_in>,
+    "response_url":<url_for_delayed_responses or None>
+    }
+
+    Slack POST messages send JSON that looks like the following:
+    {"token": "uto4ItLoT82ceQoBpIvgtzzz",
+              "team_id": "T0C3TFAGL",
+              "team_domain": "my_team_name",
+              "channel_id": "D0C3VQDAS",
+              "channel_name": "directmessage",
+              "user_id": "U0C3TFAQ4",
+              "user_name": "my_username",
+              "command": "/weather",
+              "text": "2d6",
+              "response_url": "https://hooks.slack.com/commands/T0C3TFAGL/112373954929/8k4mT8sMpIRdslA0IOMKvWSS"}
+    '''
+
+    if "user_name" not in slack_message:
+        raise DicebotException("Invalid Slack message, no user_name in slack message: " + str(slack_message))
+
+    if "command" not in slack_message:
+        raise DicebotException("No command in slack message: " + str(slack_message))
+
+    if "text" not in slack_message:
+        raise DicebotException("No text in slack message: " + str(slack_message))
+
+    if "channel_name" not in slack_message:
+        raise DicebotException("No channel in slack message: " + str(slack_message))
+
+    # response_url is optional. It is only needed to send a delayed response.
+    return {"username": slack_message["user_name"],
+            "command": slack_message["command"],
+            "text": slack_message["text"],
+            "channel_name": slack_message["channel_name"],
+            "response_url": slack_message.get("response_url")}
+
+
+def build_slack_payload(text, in_channel=True):
+    '''
+    Builds the dict that is sent back to slack for a message.
+
+    If the message should be sent only to the user set in_channel=False
+    '''
+
+    if in_channel:
+        where = "in_channel"
+    else:
+        where = "ephemeral"
+    response = dict()
+    response["response_type"] = where
+    response["text"] = text
+    response["attachments"] = []
+
+    return response
+
+
+def render_slack_payload(text, in_channel=True):
+    '''
+    Renders the same message as build_slack_payload() straight to JSON bytes.
+
+    Only the text changes between messages, so it is the only part that is encoded.
+
+    If the message should be sent only to the user set in_channel=False
+    '''
+
+    payload = b"".join((PAYLOAD_PREFIX[bool(in_channel)],
+                        json.dumps(text).encode("utf-8"),
+                        PAYLOAD_SUFFIX))
+
+    if debug:
+        print("Slack Response: " + payload.decode("utf-8"))
+
+    return payload
+
+
+def stream_slack_payload(pieces, in_channel=True):
+    '''
+    Yields the same bytes as render_slack_payload() for the text made of pieces,
+    encoding one piece at a time so the whole text is never held at once.
+    '''
+
+    yield PAYLOAD_PREFIX[bool(in_channel)] + b'"'
+    for piece in pieces:
+        yield json.dumps(piece)[1:-1].encode("utf-8")
+    yield b'"' + PAYLOAD_SUFFIX
+
+
+def split_slack_messages(pieces, limit=MESSAGE_CHARS, max_messages=MAX_FOLLOW_UPS):
+    '''
+    Groups text pieces into a list of messages of at most limit characters each,
+    splitting between pieces where it can.
+
+    Text that needs more than max_messages keeps the first max_messages - 1
+    messages, then CUT_TEXT and the last piece, so a roll still shows its total.
+    Only one message is held while the rest are skipped.
+    '''
+
+    messages = []
+    current = []
+    size = 0
+    last = ""
+    cut = False
+    for piece in pieces:
+        for start in range(0, len(piece), limit):
+            part = piece[start:start + limit]
+            if size + len(part) > limit:
+                if len(messages) < max_messages - 1:
+                    messages.append("".join(current))
+                else:
+                    cut = True
+                current = []
+                size = 0
+            current.append(part)
+            size += len(part)
+            last = part
+
+    if cut:
+        messages.append(CUT_TEXT + last)
+    elif current:
+        messages.append("".join(current))
+    return messages
+
+
+def generate_slack_response(text, in_channel=True):
+    '''
+    Consumes a string message to send to slack in a public format.
+
+    If the message should be sent only to the user set in_channel=False
+    '''
+
+    with time_stage("serialize"):
+        payload = render_slack_payload(text, in_channel)
+
+    return app.response_class(payload, mimetype="application/json")
+
+
+def join_faces(rolls, separator=" + "):
+    '''
+    Joins a list of faces into one string using the cached number strings.
+    '''
+
+    try:
+        return separator.join(map(NUMBER_STRINGS.__getitem__, rolls))
+    except (KeyError, TypeError):
+        # Something outside the cache, like a negative number
+        return separator.join(map(str, rolls))
+
+
+def stream_faces(rolls, separator=" + "):
+    '''
+    Yields join_faces(rolls) in pieces of FACE_CHUNK dice.
+    '''
+
+    for start in range(0, len(rolls), FACE_CHUNK):
+        faces = join_faces(rolls[start:start + FACE_CHUNK], separator)
+        yield faces if start == 0 else separator + faces
+
+
+def summarize_faces(rolls, die):
+    '''
+    Summarizes a long list of faces instead of printing every one.
+
+    Small dice list how many times each face came up, bigger dice give the low, high and average.
+
+    Format is
+        <num> dice: 1 x<count>, 2 x<count>, ...
+        <num> dice: lowest <low>, highest <high>, average <average>
+    '''
+
+    if not rolls:
+        return "0 dice"
+
+    if die <= COMPACT_FACE_LIMIT:
+        counts = Counter(rolls)
+        faces = ", ".join(number_string(face) + " x" + number_string(counts[face])
+                          for face in sorted(counts))
+        return number_string(len(rolls)) + " dice: " + faces
+
+    return (number_string(len(rolls)) + " dice: lowest " + number_string(min(rolls)) +
+            ", highest " + number_string(max(rolls)) +
+            ", average " + "{:.2f}".format(sum(rolls) / len(rolls)))
+
+
+def number_string(value):
+    '''
+    Returns str(value), from the cache for the numbers dice usually show.
+    '''
+
+    try:
+        return NUMBER_STRINGS[value]
+    except (KeyError, TypeError):
+        return str(value)
+
+
+def modifier_string(modifier):
+    '''
+    Returns the " (+2)" or " (-2)" shown after the dice, or "" for no modifier.
+    '''
+
+    if modifier > 0:
+        return " (+" + number_string(modifier) + ")"
+    if modifier < 0:
+        # Negative modifiers are "-2" so no need to prepend "-"
+        return " (" + str(modifier) + ")"
+    return ""
+
+
+def format_standard_roll(rolled_dice, username, roll, compact=None):
+    '''
+    Takes in a rolled_dice dict, slack username and the original parsed roll
+    and returns a string.
+
+    rolled_dice is the output from generate_roll
+    roll is the output from parse_roll
+
+    This assumes the output should be for a standard dice roll (e.g., 2d6 +2).
+    Other roll formats require their own formatting methods.
+
+    Rolls of more than COMPACT_ROLL_THRESHOLD dice are summarized instead of listing
+    every die. Set compact=True or compact=False to force either.
+
+    Format returned is
+        <username> rolled <num>d<die> (+)<modifier>
+        <roll> + <roll> + <roll> (+)<modifier> = *<total>*
+
+    '''
+    try:
+        rolls = rolled_dice["rolls"]
+        if compact is None:
+            compact = len(rolls) > COMPACT_ROLL_THRESHOLD
+
+        if compact:
+            dice_text = summarize_faces(rolls, roll["die"])
+        else:
+            dice_text = join_faces(rolls)
+    except:
+        print(rolled_dice)
+        raise DicebotException("format_standard_roll passed values that can't be cast to string")
+
+    try:
+        header = STANDARD_HEADER % (str(username), number_string(roll["num_dice"]), number_string(roll["die"]))
+    except:
+        raise DicebotException("format_standard_roll could not cast roll values to string.")
+
+    return "".join((header,
+                    dice_text,
+                    modifier_string(rolled_dice["modifier"]),
+                    TOTAL_TEMPLATE % number_string(rolled_dice["total"])))
+
+
+def stream_standard_roll(rolled_dice, username, roll):
+    '''
+    Returns the text of format_standard_roll() with every die listed as an
+    iterator of pieces, FACE_CHUNK dice at a time, so the full listing of a big
+    roll is never built as one string. See stream_slack_payload().
+    '''
+
+    try:
+        header = STANDARD_HEADER % (str(username), number_string(roll["num_dice"]), number_string(roll["die"]))
+        footer = modifier_string(rolled_dice["modifier"]) + TOTAL_TEMPLATE % number_string(rolled_dice["total"])
+    except:
+        print(rolled_dice)
+        raise DicebotException("stream_standard_roll could not cast roll values to string.")
+
+    return chain((header,), stream_faces(rolled_dice["rolls"]), (footer,))
+
+
+def format_expression_roll(rolled_plan, username, plan, compact=None):
+    '''
+    Takes in a generate_plan_roll dict, slack username and the RollPlan that was rolled
+    and returns a string.
+
+    Each dice term is wrapped in parenthesis and dropped dice are printed with strikethrough.
+    Terms with more than COMPACT_ROLL_THRESHOLD dice summarize their kept dice instead.
+    Set compact=True or compact=False to force either.
+
+    Terms with a target also show how many dice were successes.
+
+    Format returned is
+        <username> rolled <expression>:
+        (<roll> + ~<roll>~) - (<roll>) (+)<modifier> = *<total>*
+    '''
+
+    try:
+        header = str(username) + " rolled " + plan.text + ":\n"
+    except:
+        raise DicebotException("format_expression_roll could not cast roll values to string.")
+
+    return header + format_plan_line(rolled_plan, plan, compact)
+
+
+def format_plan_line(rolled_plan, plan, compact=None):
+    '''
+    Returns the line of dice and the total for one rolled plan. See format_expression_roll().
+    '''
+
+    output_text = []
+    for index, (term, rolled_term) in enumerate(zip(plan.dice, rolled_plan["terms"])):
+        if index > 0:
+            output_text.append(" + " if term.sign > 0 else " - ")
+        elif term.sign < 0:
+            output_text.append("-")
+
+        rolls = rolled_term["rolls"]
+        dropped = rolled_term["dropped"]
+        term_compact = len(rolls) > COMPACT_ROLL_THRESHOLD if compact is None else compact
+
+        if term_compact:
+            kept = [face for position, face in enumerate(rolls) if position not in dropped]
+            term_text = summarize_faces(kept, term.die)
+        elif dropped:
+            faces = []
+            for position, face in enumerate(rolls):
+                if position in dropped:
+                    faces.append("~" + number_string(face) + "~")
+                else:
+                    faces.append(number_string(face))
+            term_text = " + ".join(faces)
+        else:
+            term_text = join_faces(rolls)
+
+        if term.target:
+            successes = abs(rolled_term["subtotal"])
+            term_text += ": " + number_string(successes) + (" success" if successes == 1 else " successes")
+
+        output_text.append("(" + term_text + ")")
+
+    output_text.append(modifier_string(rolled_plan["modifier"]))
+    output_text.append(TOTAL_TEMPLATE % number_string(rolled_plan["total"]))
+
+    return "".join(output_text)
+
+
+def format_batch_roll(rolled_batch, username, plans, compact=None):
+    '''
+    Takes in a generate_batch_roll dict, slack username and the list of RollPlans
+    from parse_batch() and returns a string with one line per roll.
+
+    Format returned is
+        <username> rolled <num> rolls:
+        <expression>: (<roll> + <roll>) (+)<modifier> = *<total>*
+        <expression>: (<roll> + <roll>) (+)<modifier> = *<total>*
+
+    A batch of one, like "1d20+5;", says "1 roll".
+    '''
+
+    try:
+        output_text = [str(username) + " rolled " + number_string(len(plans)) +
+                       (" roll:\n" if len(plans) == 1 else " rolls:\n")]
+    except:
+        raise DicebotException("format_batch_roll could not cast roll values to string.")
+
+    for rolled_plan, plan in zip(rolled_batch["rolls"], plans):
+        output_text.append(plan.text + ": ")
+        output_text.append(format_plan_line(rolled_plan, plan, compact))
+
+    return "".join(output_text)
+
+
+def format_adv_dis_roll(rolled_dice, username, roll, adv=False, dis=False):
+    '''
+    Takes in a generate_roll dict, slack username, and original parsed roll.
+    Set adv=True or dis=True based on what formatting to return.
+
+    Returns a string ready to be passed to the slack message builder.
+
+    Format is
+        <username> rolled at [advantage | disadvantage] (+) <modifier>
+        <roll> ~<roll>~ ((+)<modifier>) = *<total>*
+
+    The ignored roll is printed with strikethrough.
+    '''
+
+    if not adv and not dis:
+        raise DicebotException("format_adv_dis_roll needs adv=True or dis=True")
+
+    try:
+        header = (ADV_HEADER if adv else DIS_HEADER) % str(username)
+    except:
+        print(username)
+        raise DicebotException("format_adv_dis_roll could not cast roll values to string.")
+
+    if roll["num_dice"] != 2:
+        print(roll)
+        raise DicebotException("Trying to format adv/dis roll with more than 2d20")
+
+    try:
+        return header + adv_dis_text(rolled_dice["rolls"][0], rolled_dice["rolls"][1], rolled_dice["modifier"], adv)
+    except:
+        print(traceback.format_exc())
+        raise DicebotException("format_adv_dis_roll had a problem rolling at " +
+                               ("advantage" if adv else "disadvantage"))
+
+
+def adv_dis_text(first, second, modifier, adv):
+    '''
+    Returns the line of an /adv or /dis roll after the header, like "*17* ~4~ + 1 = *18*\\n".
+    '''
+
+    # Advantage keeps the first roll on a tie or when it is higher,
+    # disadvantage keeps it on a tie or when it is lower.
+    if (adv and first >= second) or (not adv and first <= second):
+        dice_text = KEPT_FIRST_TEMPLATE % (number_string(first), number_string(second))
+        result = first
+    else:
+        dice_text = KEPT_SECOND_TEMPLATE % (number_string(first), number_string(second))
+        result = second
+
+    return "".join((dice_text, modifier_string(modifier), TOTAL_TEMPLATE % number_string(result + modifier)))
+
+
+@lru_cache(maxsize=ADV_DIS_TABLE_CACHE_SIZE)
+def adv_dis_table(modifier, adv):
+    '''
+    Returns everything an /adv (adv=True) or /dis roll with this modifier can
+    write or record, so a roll is a lookup instead of formatting.
+
+    This is a tuple of (expression, totals, texts). expression is how the roll is
+    written in the roll journal. totals and texts hold the total and the
+    adv_dis_text() of all 400 outcomes. Two dice showing first and second are at
+    (first - 1) * 20 + second - 1.
+    '''
+
+    outcomes = [(first, second) for first in range(1, 21) for second in range(1, 21)]
+    pick = max if adv else min
+    return (render_roll_plan((ADV_TERM if adv else DIS_TERM,), modifier),
+            tuple(pick(first, second) + modifier for first, second in outcomes),
+            tuple(adv_dis_text(first, second, modifier, adv) for first, second in outcomes))
+
+
+def format_character_roll(roll_list, username):
+    '''
+    Takes in a a list of 6 generate_roll dicts and the slack username
+    Indicates the low and total for each roll dict.
+    Returns a string ready to be passed to the slack message builder.
+
+    Format is:
+    <username> rolled a stat block:
+    ~<low>~ <num> + <num> + <num> = *<total>*
+    ~<low>~ <num> + <num> + <num> = *<total>*
+    ~<low>~ <num> + <num> + <num> = *<total>*
+    ~<low>~ <num> + <num> + <num> = *<total>*
+    ~<low>~ <num> + <num> + <num> = *<total>*
+    ~<low>~ <num> + <num> + <num> = *<total>*
+    '''
+
+    output_text = []
+    try:
+        output_text.append(CHARACTER_HEADER % str(username))
+    except:
+        print(username)
+        raise DicebotException("format_character_roll username is not a string")
+
+    if len(roll_list) != 6:
+        print(roll_list)
+        raise DicebotException("Incorrect number of rolls in the stat block")
+
+    # {"total": <int>, "modifer": <modifer_int>, "rolls": [roll_int]}
+    for roll in roll_list:
+        try:
+            output_text.append(character_line(roll["rolls"])[0])
+        except:
+            print(traceback.format_exc())
+            raise DicebotException("Unable to print statblock")
+
+    return "".join(output_text)
+
+
+def character_line(rolls):
+    '''
+    Returns a tuple of (line, total) for one 4d6 stat of a /character roll.
+    '''
+
+    # Keep the highest 3 of 4d6, like a 4d6kh3 /roll
+    (low,), (first, second, third) = dice_pool.split_kept(rolls, "high", 3)
+    total = first + second + third
+    return (CHARACTER_LINE_TEMPLATE % (number_string(low),
+                                       number_string(first),
+                                       number_string(second),
+                                       number_string(third),
+                                       number_string(total)),
+            total)
+
+
+@lru_cache(maxsize=None)
+def character_table():
+    '''
+    Returns the character_line() of all 1296 outcomes of 4d6, so a /character
+    stat is a lookup instead of formatting. Dice a, b, c and d are at
+    (a - 1) * 216 + (b - 1) * 36 + (c - 1) * 6 + d - 1.
+    '''
+
+    return tuple(character_line((a, b, c, d))
+                 for a in range(1, 7) for b in range(1, 7) for c in range(1, 7) for d in range(1, 7))
+
+
+def format_history(history, parsed_history):
+    '''
+    Takes in a generate_history dict and the parse_history dict and returns a string.
+
+    Format is
+        Last <num> rolls by <user> in <channel>:
+        <date> <expression>: <roll>, <roll> = *<total>*
+        <user> has rolled <num> times and <num> dice, average total <average>, highest <high>, lowest <low>
+    '''
+
+    user = parsed_history["user"]
+    rolls = history["rolls"]
+    if not rolls:
+        return "No rolls by " + user + " in " + parsed_history["channel"] + "\n"
+
+    output_text = ["Last " + number_string(len(rolls)) + " rolls by " + user + " in " +
+                   parsed_history["channel"] + ":\n"]
+    for roll in rolls:
+        output_text.append(time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(roll["timestamp"])) + " " +
+                           roll["expression"] + ": ")
+        if len(roll["faces"]) <= HISTORY_FACE_LIMIT:
+            output_text.append(join_faces(roll["faces"], ", "))
+        else:
+            output_text.append(number_string(len(roll["faces"])) + " dice")
+        output_text.append(TOTAL_TEMPLATE % number_string(roll["total"]))
+
+    stats = history["stats"]
+    output_text.append(user + " has rolled " + str(stats["rolls"]) + " times and " + str(stats["dice"]) +
+                       " dice, average total " + "{:.2f}".format(stats["average"]) +
+                       ", highest " + str(stats["highest"]) + ", lowest " + str(stats["lowest"]) + "\n")
+
+    return "".join(output_text)
+
+
+def format_macros(macros, username):
+    '''
+    Takes in the list of (name, expression) of a user's macros and returns a string.
+
+    Format is
+        <username>'s macros:
+        <name>: <roll>
+    '''
+
+    if not macros:
+        return username + " has no macros. Save one with /macro attack = 1d20+5\n"
+
+    output_text = [username + "'s macros:\n"]
+    for name, expression in macros:
+        output_text.append(name + ": " + expression + "\n")
+    return "".join(output_text)
+
+
+def format_stats(stats, channel):
+    '''
+    Takes in a generate_stats dict and returns a string.
+
+    Format is
+        d20 stats in <channel>:
+        <user>: <num> d20s, average *<average>*, <num> nat 20s, <num> nat 1s, best streaks <high> high, <low> low
+        Luckiest this session: <user> (<luck> standard deviations above average)
+    '''
+
+    if not stats["players"] and stats["luckiest"] is None:
+        return "No rolls in " + channel + " yet\n"
+
+    output_text = []
+    if stats["players"]:
+        output_text.append("d20 stats in " + channel + ":\n")
+    for player in stats["players"]:
+        output_text.append(player["user"] + ": " + str(player["d20s"]) + " d20s, average *" +
+                           "{:.2f}".format(player["average"]) + "*, " + str(player["nat20s"]) + " nat 20s, " +
+                           str(player["nat1s"]) + " nat 1s, best streaks " + str(player["best_high"]) +
+                           " high, " + str(player["best_low"]) + " low\n")
+
+    if stats["luckiest"] is not None:
+        user, luck = stats["luckiest"]
+        output_text.append("Luckiest this session: " + user + " (" + "{:.2f}".format(abs(luck)) +
+                           " standard deviations " + ("above" if luck >= 0 else "below") + " average)\n")
+
+    return "".join(output_text)
+
+
+def format_odds(odds_result, username, parsed_odds):
+    '''
+    Takes in a generate_odds dict, slack username and the parse_odds dict and returns a string.
+
+    Format is
+        <username> asked for the odds of <roll>:
+        Range <low> to <high>, average <mean>
+        Chance of <comparison> <target>: *<percent>%*
+    '''
+
+    output_text = []
+    try:
+        output_text.append(str(username) + " asked for the odds of " + parsed_odds["plan"].text + ":")
+    except:
+        print(username)
+        raise DicebotException("format_odds could not cast roll values to string.")
+
+    output_text.append("\n")
+    output_text.append("Range " + str(odds_result["low"]) + " to " + str(odds_result["high"]) +
+                       ", average " + "{:.2f}".format(round(odds_result["mean"], 2) + 0.0))
+    output_text.append("\n")
+
+    if odds_result["chance"] is not None:
+        output_text.append("Chance of " + parsed_odds["comparison"] + " " + str(parsed_odds["target"]) + ": ")
+        output_text.append("*" + "{:.2f}".format(odds_result["chance"] * 100) + "%*")
+        output_text.append("\n")
+
+    return "".join(output_text)
+
+
+def format_simulation(simulation, username, parsed_simulate):
+    '''
+    Takes in a generate_simulation dict, slack username and the parse_simulate dict and returns a string.
+
+    Rolls with few possible totals also list how often each total came up.
+
+    Format is
+        <username> simulated <roll> <trials> times:
+        Range <low> to <high>, average <mean>, standard deviation <std>
+        Percentiles 5%: <total>, 25%: <total>, 50%: <total>, 75%: <total>, 95%: <total>
+        <total>: <percent>%, ...
+        Chance of <comparison> <target>: *<percent>%*
+    '''
+
+    output_text = []
+    try:
+        output_text.append(str(username) + " simulated " + parsed_simulate["plan"].text + " " +
+                           "{:,}".format(simulation["trials"]) + " times:")
+    except:
+        print(username)
+        raise DicebotException("format_simulation could not cast roll values to string.")
+
+    output_text.append("\n")
+    output_text.append("Range " + str(simulation["low"]) + " to " + str(simulation["high"]) +
+                       ", average " + "{:.2f}".format(round(simulation["mean"], 2) + 0.0) +
+                       ", standard deviation " + "{:.2f}".format(simulation["std"]))
+    output_text.append("\n")
+    output_text.append("Percentiles " + ", ".join(str(percent) + "%: " + str(simulation["percentiles"][percent])
+                                                  for percent in simulate.PERCENTILES))
+    output_text.append("\n")
+
+    histogram = simulation["histogram"]
+    if len(histogram) <= SIMULATE_HISTOGRAM_ROWS:
+        output_text.append(", ".join(str(value) + ": " +
+                                     "{:.2f}".format(histogram[value] * 100.0 / simulation["trials"]) + "%"
+                                     for value in sorted(histogram)))
+        output_text.append("\n")
+
+    if simulation["chance"] is not None:
+        output_text.append("Chance of " + parsed_simulate["comparison"] + " " + str(parsed_simulate["target"]) + ": ")
+        output_text.append("*" + "{:.2f}".format(simulation["chance"] * 100) + "%*")
+        output_text.append("\n")
+
+    return "".join(output_text)
+
+
+def warm_up():
+    '''
+    Does the work the first requests would otherwise do: compiles the common rolls,
+    formats each kind of message once, builds the /adv, /dis and /character tables
+    and gets Flask to build its URL matcher and import its form parser. It can be called again, it is cheap once warm.
+
+    Returns the seconds it took.
+    '''
+
+    started = time.perf_counter()
+
+    for roll in WARM_ROLLS:
+        compile_roll(roll)
+    adv_roll = adv_dis_spec("+1")
+    adv_dis_table(0, True)
+    adv_dis_table(0, False)
+    character_table()
+    character_roll = parse_roll_spec("", character=True)
+
+    # Made up dice, nothing is rolled or recorded
+    format_standard_roll(RollResult(7, array(roll_journal.FACE_TYPE, [3, 4]), 0, None), "warmup",
+                         parse_roll_spec("2d6"))
+    format_adv_dis_roll(RollResult(18, array(roll_journal.FACE_TYPE, [17, 4]), 1, None), "warmup", adv_roll,
+                        adv=True)
+    format_character_roll([RollResult(18, array(roll_journal.FACE_TYPE, [6, 5, 4, 3]), 0, None)] * 6, "warmup")
+    render_slack_payload("warmup")
+
+    # Werkzeug loads its form parser the first time a form is parsed
+    with app.test_request_context("/roll", method="POST", data={"command": "/roll", "text": "1d20"}):
+        request.get_data(parse_form_data=True)
+
+    return time.perf_counter() - started
+
+
+def boot(started):
+    '''
+    Warms this process up at start, see dicebot_boot.py. started is the
+    time.perf_counter() from before dicebot was imported.
+    '''
+
+    global boot_started
+
+    boot_started = started
+    boot_timings["import_seconds"] = time.perf_counter() - started
+    boot_timings["warm_seconds"] = warm_up()
+
+    metrics_registry.observe("dicebot_boot_seconds", boot_timings["import_seconds"], (("phase", "import"),))
+    metrics_registry.observe("dicebot_boot_seconds", boot_timings["warm_seconds"], (("phase", "warm"),))
+
+
+# Every slash command dicebot answers, by name. See register_command()
+COMMANDS = {}
+
+# A registered command. handler takes a parse_slack_message dict and returns the
+# text to send back, help is shown after an error and labels are its metric labels.
+# cost is what one use takes from the rate limit, a number or a function of the
+# parse_slack_message dict.
+Command = namedtuple("Command", ["name", "handler", "help", "labels", "cost", "in_channel"])
+
+
+def register_command(name, help_text, cost=1, in_channel=True):
+    '''
+    Decorates a command function to register it under a slash command name, like "/roll".
+    help_text tells the user how to use the command when it fails and cost is what it
+    takes from the rate limit, see check_rate_limit(). Answers are posted in the channel
+    unless in_channel is False, then only the user sees them.
+
+    Registered commands are answered at the root URL, using the "command" field
+    slack sends, and at their own path.
+    '''
+
+    def decorator(function):
+        COMMANDS[name] = Command(name, function, help_text, (("command", name),), cost, in_channel)
+        return function
+
+    return decorator
+
+
+def check_rate_limit(command, slack_dict):
+    '''
+    Charges a command to the user's and channel's token buckets.
+
+    Returns None if the command may run, or the payload bytes telling the user to slow down.
+    '''
+
+    if rate_limiter is None:
+        return None
+
+    cost = command.cost(slack_dict) if callable(command.cost) else command.cost
+    allowed, retry_after, scope = rate_limiter.check(slack_dict["username"], slack_dict["channel_name"], cost)
+    if allowed:
+        return None
+
+    metrics_registry.inc("dicebot_rate_limited_total", (("scope", scope),))
+    return render_slack_payload("Slow down! " + ("You are" if scope == "user" else "This channel is") +
+                                " rolling too many dice. Try again in " + str(int(retry_after) + 1) + " seconds.",
+                                in_channel=False)
+
+
+def run_command(command, slack_dict, follow_ups=False):
+    '''
+    Runs a registered Command on a parse_slack_message dict and returns the rendered
+    slack payload bytes, including any error message.
+
+    A command can return an iterator of text pieces instead of a string, for a long
+    message like a full listing. The payload is then an iterator of bytes, see
+    stream_slack_payload(). The first EAGER_PIECES pieces are rendered before this
+    returns, so a roll that can't be listed is answered as an error. With
+    follow_ups=True a list of payloads is returned instead, the text split into
+    messages that fit in slack (split_slack_messages()), to post to the
+    response_url one after the other.
+    '''
+
+    try:
+        output = command.handler(slack_dict)
+        if not isinstance(output, str):
+            pieces = iter(output)
+            first = list(islice(pieces, EAGER_PIECES))
+            if not follow_ups:
+                return stream_slack_payload(chain(first, count_stream_errors(command, pieces)), command.in_channel)
+            with time_stage("serialize"):
+                payloads = [render_slack_payload(message, command.in_channel)
+                            for message in split_slack_messages(chain(first, pieces))]
+        else:
+            with time_stage("serialize"):
+                payloads = [render_slack_payload(output, command.in_channel)]
+    except DicebotException as dbe:
+        count_error(command.name, "dicebot")
+        payloads = [render_slack_payload("error: " + str(dbe) + "\n " + command.help, in_channel=False)]
+    except:
+        # Ending up here means an exception was thrown that we didn't catch. A bug.
+        count_error(command.name, "unhandled")
+        print("Unhandled traceback in " + command.name)
+        print(traceback.format_exc())
+        payloads = [render_slack_payload("Hmm....something went wrong. Try again?", in_channel=False)]
+
+    return payloads if follow_ups else payloads[0]
+
+
+def count_stream_errors(command, pieces):
+    '''
+    Yields the rest of a long message. The status was sent with the first pieces,
+    so an error here is counted and printed, and the message ends with
+    STREAM_ERROR_TEXT so it is still valid JSON.
+    '''
+
+    try:
+        for piece in pieces:
+            yield piece
+    except DicebotException:
+        count_error(command.name, "dicebot")
+        print(traceback.format_exc())
+        yield STREAM_ERROR_TEXT
+    except Exception:
+        count_error(command.name, "unhandled")
+        print("Unhandled traceback in " + command.name)
         print(traceback.format_exc())
-        return generate_slack_response("Hmm....something went wrong. Try again?", in_channel=False)
+        yield STREAM_ERROR_TEXT
+
+
+def parse_form(body):
+    '''
+    Decodes a urlencoded form body to a dict. A name given twice keeps its first
+    value, like Flask's request.form.
+    '''
+
+    form = {}
+    for name, value in parse_qsl(body.decode("utf-8", "replace"), keep_blank_values=True):
+        form.setdefault(name, value)
+    return form
+
+
+def dispatch(form, command_name=None, answer=None):
+    '''
+    Answers one slash command from the POSTed slack form. command_name is taken from
+    the URL, when the command has its own path, or else from the form's "command" field.
+
+    answer(command, slack_dict), if given, is called instead of run_command() once the
+    form is parsed and the rate limit checked, and returns the payload. The ASGI app
+    uses it to answer heavy commands later.
+
+    Returns a tuple of (HTTP status, payload bytes). The payload can be an iterator of
+    bytes for a long message, see run_command().
+    '''
+
+    if debug:
+        print(form)
+
+    if command_name is None:
+        command_name = form.get("command")
+
+    command = COMMANDS.get(command_name)
+    if command is None:
+        return (404, render_slack_payload("Unknown command " + str(command_name), in_channel=False))
+
+    metrics_registry.inc("dicebot_requests_total", command.labels)
+    with metrics_registry.time("dicebot_request_seconds", command.labels):
+        try:
+            # First parse the inbound slack message and get a simple dict
+            with time_stage("slack_parse"):
+                slack_dict = parse_slack_message(form)
+        except DicebotException as dbe:
+            count_error(command.name, "dicebot")
+            return (200, render_slack_payload("error: " + str(dbe) + "\n " + command.help, in_channel=False))
+
+        limited = check_rate_limit(command, slack_dict)
+        if limited is not None:
+            return (200, limited)
+
+        if answer is not None:
+            return (200, answer(command, slack_dict))
+        return (200, run_command(command, slack_dict))
+
+
+def roll_plans(slack_dict):
+    '''
+    Returns the list of RollPlans a /roll asks for, the user's macro or the rolls
+    of a batch, without rolling them. Raises DicebotException for a bad roll.
+    '''
+
+    text = split_full_listing(slack_dict["text"])[0]
+    plan = find_macro(slack_dict, text)
+    return parse_batch(text) if plan is None else [plan]
+
+
+def roll_cost(slack_dict):
+    '''
+    One token plus the number of dice in the roll. Bad rolls cost one token.
+    '''
+
+    try:
+        plans = roll_plans(slack_dict)
+    except DicebotException:
+        return 1
+    return 1 + sum(term.num_dice for plan in plans for term in plan.dice)
+
+
+@register_command("/roll", "Please use /roll <num>d<num> (+/-)<num> (full); <num>x <num>d<num>", cost=roll_cost)
+def roll_command(slack_dict):
+    '''
+    Handles standard rolls in the style 2d6 +3, longer expressions like 4d6kh3 + 2d8
+    and batches of rolls like 1d20+5; 2d6+3 or 6x 4d6.
+
+    A plain roll ending in "full", like 10000d6 full, lists every die instead of a
+    summary. Its text is returned as an iterator of pieces, see stream_standard_roll().
+
+    The name of one of the user's macros, like attack, rolls that macro. See /macro.
+
+    Takes in a parse_slack_message dict and returns the text to send back to slack.
+    '''
+
+    text, full = split_full_listing(slack_dict["text"])
+    macro = find_macro(slack_dict, text)
+
+    if macro is None and not full and is_batch(text):
+        # Several rolls, drawn together and answered in one message
+        with time_stage("roll_parse"):
+            plans = parse_batch(text)
+        with time_stage("roll"):
+            rolled_batch = generate_batch_roll(plans)
+        for rolled_plan, plan in zip(rolled_batch["rolls"], plans):
+            record_plan_roll(slack_dict, rolled_plan, plan)
+        with time_stage("format"):
+            return format_batch_roll(rolled_batch, slack_dict["username"], plans)
+
+    # Compile and validate the roll from slack.
+    # A plain 2d6+3 style roll also gets its RollSpec.
+    with time_stage("roll_parse"):
+        plan = compile_roll(text) if macro is None else macro
+        parsed_roll = None
+        if is_simple_plan(plan):
+            # compile_roll() checked the limits already
+            parsed_roll = RollSpec(plan.dice[0].num_dice, plan.dice[0].die, plan.modifier)
+
+    if full and parsed_roll is None:
+        raise DicebotException("Only a plain roll like 10000d6 can be listed in full. Given " + text)
+
+    if parsed_roll is not None:
+        # Roll all the dice we've been asked to roll
+        with time_stage("roll"):
+            rolled_dice = generate_roll_results([parsed_roll])[0]
+        record_roll(slack_dict, plan.text, rolled_dice.total, [(parsed_roll.die, rolled_dice.rolls)],
+                    rolled_dice.rng)
+
+        if full:
+            # Rendered while it is sent
+            return stream_standard_roll(rolled_dice, slack_dict["username"], parsed_roll)
+
+        # Build the message to send back to slack based on the rolled dice,
+        # the user who asked and the original dice they asked to roll.
+        with time_stage("format"):
+            return format_standard_roll(rolled_dice, slack_dict["username"], parsed_roll)
+
+    # A longer expression like 4d6kh3 + 2d8 - 1d4 + 5
+    with time_stage("roll"):
+        rolled_plan = generate_plan_roll(plan)
+    record_plan_roll(slack_dict, rolled_plan, plan)
+    with time_stage("format"):
+        return format_expression_roll(rolled_plan, slack_dict["username"], plan)
+
+
+@register_command("/adv", "Please use /adv (+/-)<num> or /adv <macro>", cost=3)
+def adv_command(slack_dict):
+    '''
+    Handles rolling at advantage. Roll 2d20 and drop the low.
+    '''
+
+    return roll_adv_dis(slack_dict, True)
+
+
+@register_command("/dis", "Please use /dis (+/-)<num> or /dis <macro>", cost=3)
+def dis_command(slack_dict):
+    '''
+    Handles rolling at disadvantage. Roll 2d20 and drop the high.
+    '''
+
+    return roll_adv_dis(slack_dict, False)
+
+
+def roll_adv_dis(slack_dict, adv):
+    '''
+    Rolls /adv (adv=True) or /dis. The output is the same as format_adv_dis_roll()
+    but looked up in adv_dis_table() rather than formatted.
+    '''
+
+    # Parse the input, but set it to only roll 2d20
+    with time_stage("roll_parse"):
+        parsed_roll = parse_adv_dis(slack_dict)
+        expression, totals, texts = adv_dis_table(parsed_roll.modifier, adv)
+
+    # Roll the 2d20
+    with time_stage("roll"):
+        rolls, record = draw_dice(ADV_DIS_DICE)
+        first, second = rolls[0]
+    outcome = (first - 1) * 20 + second - 1
+    record_roll(slack_dict, expression, totals[outcome], [(20, rolls[0])], record)
+
+    # Build the result of the rolls
+    with time_stage("format"):
+        return (ADV_HEADER if adv else DIS_HEADER) % str(slack_dict["username"]) + texts[outcome]
+
+
+@register_command("/character", "Please use /character", cost=25)
+def character_command(slack_dict):
+    '''
+    Builds a new character stat block. Roll 4d6 and drop the low. Do it 6 times.
+    '''
+
+    # Any dice or modifiers given are ignored, it is always 6 times 4d6
+    with time_stage("roll_parse"):
+        table = character_table()
+
+    # Roll 4d6, 6 times in a single bulk draw
+    with time_stage("roll"):
+        rolls, record = draw_dice(CHARACTER_DICE)
+    lines = []
+    for faces in rolls:
+        a, b, c, d = faces
+        line, total = table[(a - 1) * 216 + (b - 1) * 36 + (c - 1) * 6 + d - 1]
+        record_roll(slack_dict, CHARACTER_EXPRESSION, total, [(6, faces)], record)
+        lines.append(line)
+
+    # Build the output, the same as format_character_roll() would
+    with time_stage("format"):
+        return CHARACTER_HEADER % str(slack_dict["username"]) + "".join(lines)
+
+
+@register_command("/history", "Please use /history or /history <username>")
+def history_command(slack_dict):
+    '''
+    Lists the latest rolls of a user in this channel, from the roll journal.
+    '''
+
+    with time_stage("roll_parse"):
+        parsed_history = parse_history(slack_dict["text"], slack_dict)
+
+    with time_stage("roll"):
+        history = generate_history(parsed_history)
+
+    with time_stage("format"):
+        return format_history(history, parsed_history)
+
+
+@register_command("/macro", "Please use /macro, /macro <name> = <roll> or /macro remove <name>",
+                  in_channel=False)
+def macro_command(slack_dict):
+    '''
+    Lists, saves and removes the user's macros, rolls saved by name like /roll attack.
+    Only the user sees the answer, rolling a macro is what the channel sees.
+    '''
+
+    username = slack_dict["username"]
+    with time_stage("roll_parse"):
+        parsed_macro = parse_macro(slack_dict["text"])
+
+    if parsed_macro["action"] == "save":
+        try:
+            plan = macro_store.set(username, parsed_macro["name"], parsed_macro["expression"])
+        except ValueError as error:
+            raise DicebotException(str(error))
+        return "Saved " + parsed_macro["name"] + " for " + username + ": " + plan.text + "\n"
+
+    if parsed_macro["action"] == "remove":
+        if not macro_store.delete(username, parsed_macro["name"]):
+            raise DicebotException(username + " has no macro called " + parsed_macro["name"])
+        return "Removed " + parsed_macro["name"] + " for " + username + "\n"
+
+    with time_stage("format"):
+        return format_macros(macro_store.list(username), username)
+
+
+@register_command("/stats", "Please use /stats")
+def stats_command(slack_dict):
+    '''
+    Shows the d20 stats of every player in this channel and the luckiest player this session.
+    '''
+
+    with time_stage("roll_parse"):
+        if slack_dict["text"].strip():
+            raise DicebotException("/stats takes no options. Given " + slack_dict["text"].strip())
+
+    with time_stage("roll"):
+        stats = generate_stats(slack_dict["channel_name"])
+
+    with time_stage("format"):
+        return format_stats(stats, slack_dict["channel_name"])
+
+
+def odds_cost(slack_dict):
+    '''
+    Ten tokens plus one for every ODDS_WORK_PER_TOKEN steps the distribution is
+    estimated to take, see odds.plan_work(). Bad rolls cost ten.
+    '''
+
+    try:
+        plan = parse_odds(slack_dict["text"])["plan"]
+    except DicebotException:
+        return ODDS_BASE_COST
+    return ODDS_BASE_COST + odds.plan_work(plan.dice) // ODDS_WORK_PER_TOKEN
+
+
+# /odds and /simulate cost about what the work would cost in dice
+@register_command("/odds", "Please use /odds <roll> (>=, >, <=, <, =)<num>", cost=odds_cost)
+def odds_command(slack_dict):
+    '''
+    Works out the exact odds of a roll, like 3d8+2 >= 15
+    '''
+
+    # Split the roll from the target and compile the roll
+    with time_stage("roll_parse"):
+        parsed_odds = parse_odds(slack_dict["text"])
+
+    # Build the exact distribution of the roll
+    with time_stage("roll"):
+        odds_result = generate_odds(parsed_odds)
+
+    # Build the output
+    with time_stage("format"):
+        return format_odds(odds_result, slack_dict["username"], parsed_odds)
+
+
+def simulate_cost(slack_dict):
+    '''
+    Ten tokens plus one for every SIMULATE_TRIALS_PER_TOKEN trials asked for.
+    Bad requests cost ten.
+    '''
+
+    try:
+        trials = parse_simulate(slack_dict["text"])["trials"]
+    except DicebotException:
+        return SIMULATE_BASE_COST
+    return SIMULATE_BASE_COST + trials // SIMULATE_TRIALS_PER_TOKEN
+
+
+@register_command("/simulate", "Please use /simulate <roll> (>=, >, <=, <, =)<num> <num> trials", cost=simulate_cost)
+def simulate_command(slack_dict):
+    '''
+    Rolls a roll many times and reports how the totals came out, like 6d10t8 >= 3
+    '''
+
+    # Split off the target and number of trials and compile the roll
+    with time_stage("roll_parse"):
+        parsed_simulate = parse_simulate(slack_dict["text"])
+
+    # Run the trials
+    with time_stage("roll"):
+        simulation = generate_simulation(parsed_simulate)
+
+    # Build the output
+    with time_stage("format"):
+        return format_simulation(simulation, slack_dict["username"], parsed_simulate)
+
+
+# Refuse unsigned requests before the form is parsed or any dice are rolled
+@app.before_request
+def check_signature():
+    if request.endpoint not in ("slack_command", "slack_command_path"):
+        return None
+
+    if verify_request(request.headers.get("X-Slack-Request-Timestamp"),
+                      request.headers.get("X-Slack-Signature"),
+                      request.get_data(cache=True)):
+        return None
+
+    return app.response_class(b"Invalid signature", status=401, mimetype="text/plain")
+
+
+def note_first_response():
+    '''
+    Records the time to the first answered slash command after boot(). Call it after each one.
+    '''
+
+    if boot_started is not None and boot_timings["first_response_seconds"] is None:
+        boot_timings["first_response_seconds"] = time.perf_counter() - boot_started
+        metrics_registry.observe("dicebot_boot_seconds", boot_timings["first_response_seconds"],
+                                 (("phase", "first_response"),))
+
+
+# Time to the first answered slash command, see note_first_response()
+@app.after_request
+def note_flask_response(response):
+    if request.endpoint in ("slack_command", "slack_command_path"):
+        note_first_response()
+    return response
+
+
+# Every slash command can be pointed at the root URL, the "command" field picks the command
+@app.route('/', methods=["GET", "POST"])
+def slack_command():
+    status, payload = dispatch(request.form)
+    return app.response_class(payload, status=status, mimetype="application/json")
+
+
+# Each command also answers at its own path, like /roll
+@app.route('/<command_name>', methods=["GET", "POST"])
+def slack_command_path(command_name):
+    status, payload = dispatch(request.form, "/" + command_name)
+    return app.response_class(payload, status=status, mimetype="application/json")
+
+
+# A probe for the platform or an uptime check. Warms the process up if it isn't yet
+@app.route('/warmup', methods=["GET"])
+def warmup_endpoint():
+    return app.response_class(warmup_payload(), mimetype="application/json")
+
+
+def warmup_payload():
+    '''
+    Warms the process up and returns the JSON bytes /warmup answers with.
+    '''
+
+    warm_up()
+    return json.dumps({"warm": True, "boot": boot_timings}).encode("utf-8")
+
 
-    return generate_slack_response(output)
+# Serve the counters and timings for Prometheus
+@app.route('/metrics', methods=["GET"])
+def metrics_endpoint():
+    return app.response_class(metrics_registry.render(), mimetype="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import os
+import ssl
+import traceback
+from urllib.parse import urlsplit
+
+import dicebot
+from dicebot import DicebotException
+
+'''
+An asyncio (ASGI) front end for dicebot.
+
+This answers the same slash commands as the Flask app in dicebot.py, using the
+same command registry, but without tying up a worker while a heavy command runs.
+
+Cheap commands are answered right away in the HTTP response, like the Flask app.
+Heavy commands (big rolls, odds and simulations) are acknowledged right away and the result is
+posted to the slack response_url when it is ready. That keeps every reply inside
+slack's 3 second timeout. A full listing too long for one slack message is
+posted as several follow up messages.
+
+Commands can be posted to their own path (/roll, /adv, ...) or all to "/" where
+the "command" field picks the command.
+
+Commands, rate limit checks and streamed listings run in the default thread
+pool executor, so slow work like a big roll, a macro lookup or a Redis round
+trip never blocks the event loop.
+
+Delayed responses are only posted to a response_url on one of
+RESPONSE_URL_ORIGINS, slack's https://hooks.slack.com unless
+DICEBOT_RESPONSE_URL_ORIGINS says otherwise (a comma separated list like
+"https://hooks.slack.com,http://127.0.0.1:8000"). The form is not trusted
+unless SLACK_SIGNING_SECRET is set, so any other response_url is ignored and
+the command is answered in the HTTP response.
+
+Run it with any ASGI server, for example:
+    uvicorn dicebot_asgi:app --host 0.0.0.0 --port $PORT
+'''
+
+# Commands that are always answered later through the response_url
+DELAYED_COMMANDS = {"/odds", "/simulate"}
+
+# A /roll with more dice than this is answered later through the response_url
+DELAYED_DICE_THRESHOLD = 1000
+
+# What the user sees while a delayed command is running
+ACKNOWLEDGE_TEXT = "Rolling..."
+ACKNOWLEDGE_PAYLOAD = dicebot.render_slack_payload(ACKNOWLEDGE_TEXT, in_channel=False)
+
+# The answer to a request that failed signature verification
+REJECTED_PAYLOAD = dicebot.render_slack_payload("Invalid signature", in_channel=False)
+
+# How long to wait on slack when posting a delayed response, in seconds
+OUTBOUND_TIMEOUT = 10
+
+# How many idle keep-alive connections to hold open to each host
+MAX_IDLE_CONNECTIONS = 4
+
+# Where delayed responses may be posted, see the module docstring
+RESPONSE_URL_ORIGINS = os.environ.get("DICEBOT_RESPONSE_URL_ORIGINS", "https://hooks.slack.com")
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def url_origin(url):
+    '''
+    Returns the (scheme, host, port) a URL points at, or None if it isn't an http or https URL.
+    '''
+
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except (TypeError, ValueError):
+        return None
+
+    if parts.scheme not in DEFAULT_PORTS or not parts.hostname:
+        return None
+    return (parts.scheme, parts.hostname.lower(), port or DEFAULT_PORTS[parts.scheme])
+
+
+def parse_origins(text):
+    '''
+    Returns the set of origins in a comma separated list of URLs. Their paths are ignored.
+    '''
+
+    origins = set(url_origin(url.strip()) for url in text.split(",") if url.strip())
+    origins.discard(None)
+    return frozenset(origins)
+
+
+def is_delayed(command, slack_dict, origins=None):
+    '''
+    Decides if a command should be acknowledged now and answered through the response_url.
+    A /roll of a macro is decided by the dice of the macro.
+
+    Without a response_url on one of origins (RESPONSE_URL_ORIGINS by default)
+    there is no way to answer later, so everything is answered now.
+    '''
+
+    if origins is None:
+        origins = parse_origins(RESPONSE_URL_ORIGINS)
+    if url_origin(slack_dict.get("response_url")) not in origins:
+        return False
+
+    if command in DELAYED_COMMANDS:
+        return True
+
+    if command == "/roll":
+        try:
+            plans = dicebot.roll_plans(slack_dict)
+        except DicebotException:
+            # Bad rolls are cheap to answer, let the command report the error
+            return False
+        return sum(term.num_dice for plan in plans for term in plan.dice) > DELAYED_DICE_THRESHOLD
+
+    return False
+
+
+class ResponsePoster(object):
+    '''
+    Posts JSON to slack response_urls over pooled HTTP/1.1 keep-alive connections.
+
+    Idle connections are kept per (scheme, host, port) so a busy channel reuses
+    the same TLS connection instead of handshaking for every delayed response.
+
+    Only URLs on one of origins, a set of url_origin() tuples, are posted to.
+    '''
+
+    def __init__(self, max_idle=MAX_IDLE_CONNECTIONS, timeout=OUTBOUND_TIMEOUT, origins=None):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.origins = parse_origins(RESPONSE_URL_ORIGINS) if origins is None else origins
+        self.idle = {}
+        self.ssl_context = ssl.create_default_context()
+
+    async def open_connection(self, key):
+        scheme, host, port = key
+        if scheme == "https":
+            return await asyncio.open_connection(host, port, ssl=self.ssl_context)
+        return await asyncio.open_connection(host, port)
+
+    async def post_json(self, url, body):
+        '''
+        Posts body, JSON already encoded to bytes, to url and returns the HTTP status code.
+        Raises ValueError if url is not on one of the allowed origins.
+        '''
+
+        key = url_origin(url)
+        if key is None or key not in self.origins:
+            raise ValueError("Unsupported response_url " + str(url))
+
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        scheme, host, port = key
+        request = ("POST " + path + " HTTP/1.1\r\n" +
+                   "Host: " + host + ("" if port == DEFAULT_PORTS[scheme] else ":" + str(port)) + "\r\n" +
+                   "Content-Type: application/json\r\n" +
+                   "Content-Length: " + str(len(body)) + "\r\n" +
+                   "Connection: keep-alive\r\n\r\n").encode("latin-1") + body
+
+        idle = self.idle.setdefault(key, [])
+        while idle:
+            connection = idle.pop()
+            try:
+                return await asyncio.wait_for(self.send(key, connection, request), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # The server closed an idle connection, try the next one
+                connection[1].close()
+            except:
+                # Like a timeout, the connection is in an unknown state
+                connection[1].close()
+                raise
+
+        connection = await asyncio.wait_for(self.open_connection(key), self.timeout)
+        try:
+            return await asyncio.wait_for(self.send(key, connection, request), self.timeout)
+        except:
+            connection[1].close()
+            raise
+
+    async def send(self, key, connection, request):
+        '''
+        Sends one request on a connection, reads the response and puts the
+        connection back in the pool if it can be reused.
+        '''
+
+        reader, writer = connection
+        writer.write(request)
+        await writer.drain()
+
+        status_line = await reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip().lower()
+
+        keep_alive = headers.get("connection") != "close"
+        if "content-length" in headers:
+            await reader.readexactly(int(headers["content-length"]))
+        elif headers.get("transfer-encoding") == "chunked":
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        else:
+            # The body runs until the server closes the connection
+            await reader.read()
+            keep_alive = False
+
+        idle = self.idle.setdefault(key, [])
+        if keep_alive and len(idle) < self.max_idle:
+            idle.append(connection)
+        else:
+            writer.close()
+
+        return status
+
+    async def close(self):
+        for idle in self.idle.values():
+            for reader, writer in idle:
+                writer.close()
+        self.idle = {}
+
+
+class ResponseUrlStub(object):
+    '''
+    A local stand-in for slack's response_url, for tests and local runs.
+
+    Every JSON body posted to it is kept in received, in order, and every new
+    connection is counted so tests can check that connections are reused.
+    on_message, if given, is called with the path and JSON body of every post as
+    it arrives, and with keep=False the bodies are not kept, for long load tests.
+    '''
+
+    def __init__(self, host="127.0.0.1", port=0, on_message=None, keep=True):
+        self.host = host
+        self.port = port
+        self.on_message = on_message
+        self.keep = keep
+        self.server = None
+        self.received = []
+        self.connections = 0
+        self.messages = asyncio.Queue()
+
+    @property
+    def url(self):
+        return "http://" + self.host + ":" + str(self.port) + "/commands/stub"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def next_message(self, timeout=5):
+        '''
+        Waits for the next posted JSON body and returns it.
+        '''
+
+        return await asyncio.wait_for(self.messages.get(), timeout)
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                path = request_line.decode("latin-1").split(" ")[1]
+
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value)
+
+                message = json.loads((await reader.readexactly(length)).decode("utf-8"))
+                if self.on_message is not None:
+                    self.on_message(path, message)
+                if self.keep:
+                    self.received.append(message)
+                    self.messages.put_nowait(message)
+
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+class DicebotASGI(object):
+    '''
+    The ASGI application. See the module docstring.
+
+    response_url_origins is a comma separated list of where delayed responses
+    may be posted, RESPONSE_URL_ORIGINS by default.
+    '''
+
+    def __init__(self, response_url_origins=None):
+        self.origins = parse_origins(RESPONSE_URL_ORIGINS if response_url_origins is None else response_url_origins)
+        self.poster = None
+        self.tasks = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+
+        if scope["type"] != "http":
+            return
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        headers = dict((name.decode("latin-1").lower(), value.decode("latin-1"))
+                       for name, value in scope.get("headers", []))
+        status, response = await self.handle(scope["path"], body, headers)
+
+        if isinstance(response, bytes):
+            await send({"type": "http.response.start",
+                        "status": status,
+                        "headers": [(b"content-type", b"application/json"),
+                                    (b"content-length", str(len(response)).encode("latin-1"))]})
+            await send({"type": "http.response.body", "body": response})
+            return
+
+        # A long message, sent as it is rendered. Rendering runs in the executor
+        await send({"type": "http.response.start",
+                    "status": status,
+                    "headers": [(b"content-type", b"application/json")]})
+        loop = asyncio.get_event_loop()
+        while True:
+            chunk = await loop.run_in_executor(None, next, response, None)
+            if chunk is None:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.poster = ResponsePoster(origins=self.origins)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def handle(self, path, body, headers=None):
+        '''
+        Answers one slash command. headers is a dict with lower case names.
+        Returns a tuple of (HTTP status, payload bytes). The payload can be an iterator
+        of bytes for a long message, see dicebot.run_command().
+        '''
+
+        headers = headers or {}
+        if not dicebot.verify_request(headers.get("x-slack-request-timestamp"),
+                                      headers.get("x-slack-signature"), body):
+            return (401, REJECTED_PAYLOAD)
+
+        # Parsing, the rate limit and commands may wait on Redis, SQLite or the journal,
+        # so the whole dispatch runs in the executor. Heavy commands are handed back to
+        # the event loop to answer later
+        loop = asyncio.get_event_loop()
+
+        def answer(command, slack_dict):
+            if not is_delayed(command.name, slack_dict, self.origins):
+                return dicebot.run_command(command, slack_dict)
+            loop.call_soon_threadsafe(self.start_delivery, command, slack_dict)
+            return ACKNOWLEDGE_PAYLOAD
+
+        form = dicebot.parse_form(body)
+        result = await loop.run_in_executor(None, dicebot.dispatch, form, None if path == "/" else path, answer)
+        dicebot.note_first_response()
+        return result
+
+    def start_delivery(self, command, slack_dict):
+        '''
+        Starts answering a heavy command in the background. Called on the event loop.
+        '''
+
+        task = asyncio.ensure_future(self.deliver(command, slack_dict))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def deliver(self, command, slack_dict):
+        '''
+        Runs a heavy Command off the event loop and posts the result to the response_url,
+        as several messages in order if it is too long for one.
+        '''
+
+        loop = asyncio.get_event_loop()
+        payloads = await loop.run_in_executor(None, dicebot.run_command, command, slack_dict, True)
+
+        if self.poster is None:
+            self.poster = ResponsePoster(origins=self.origins)
+
+        try:
+            for payload in payloads:
+                await self.poster.post_json(slack_dict["response_url"], payload)
+        except:
+            print("Unable to post delayed response for " + command.name)
+            print(traceback.format_exc())
+
+    async def close(self):
+        '''
+        Waits for any delayed responses still running and closes pooled connections.
+        '''
+
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.poster is not None:
+            await self.poster.close()
+
+
+app = DicebotASGI()
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
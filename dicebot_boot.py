@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+import time
+
+# Taken before anything else is imported, so the import time covers Flask too
+boot_started = time.perf_counter()
+
+import dicebot
+
+'''
+The entry point for dynos that sleep, like Heroku's free tier.
+
+A sleeping dyno starts when the first slash command arrives, and slack gives up
+after 3 seconds. Serving dicebot:app leaves work for that first request: rolls
+to compile, Flask's URL matching to build, modules to import. This runs it all
+while the process starts instead, and records how long each phase took.
+
+    gunicorn dicebot_boot:app
+
+The timings are served at /warmup and as dicebot_boot_seconds at /metrics:
+ - import_seconds: importing dicebot, Flask and everything they need,
+ - warm_seconds: dicebot.warm_up(),
+ - first_response_seconds: from the start until the first slash command is answered.
+'''
+
+dicebot.boot(boot_started)
+
+app = dicebot.app
+
+
+if __name__ == "__main__":
+    # Reports the timings of a cold start, including one slash command
+    import json
+    app.test_client().post("/", data={"user_name": "boot", "command": "/roll", "text": "1d20", "channel_name": "boot"})
+    print(json.dumps(dicebot.boot_timings, indent=2))
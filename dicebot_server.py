@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+import atexit
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+import dicebot
+import rate_limit
+import shared_counters
+
+'''
+A preforking production server for the Flask app in dicebot.py.
+
+The parent process imports dicebot, warms it up, makes the shared memory
+counters and opens the listening socket, then forks one worker per CPU. Workers
+share the parent's warmed pages copy-on-write: compiled rolls, number strings,
+format templates and the command registry are built once, and the garbage
+collector is frozen before the fork so it doesn't touch (and copy) them.
+
+Every worker accepts connections on the same socket. Metrics are counted in a
+shared memory region (see shared_counters.py), so /metrics on any worker covers
+them all. Rate limit buckets kept in memory move to shared memory too (see
+rate_limit.SharedMemoryStore), so N workers don't allow N times the limit.
+
+Other state stays in each worker:
+ - /stats rolls are shared through DICEBOT_STATS_FILE, which every worker adds
+   to every roll_stats.SAVE_INTERVAL seconds. Without it each worker only
+   counts its own rolls.
+ - The compiled roll and odds caches only save work. Whatever warm_up() puts
+   in them is shared copy-on-write, the rest is built again by each worker.
+ - The random pool must not hand the same faces to two workers, so each
+   worker draws its own.
+
+Signals to the parent:
+ - TERM or INT stops every worker after its current request and exits.
+ - HUP reloads gracefully. The parent runs itself again with the same socket,
+   imports the new code and warms it up while the old workers keep serving,
+   then stops the old workers and forks new ones. Connections that arrive in
+   between wait in the socket's backlog, none are refused. The shared counters
+   and rate limit buckets are carried over, so totals and limits don't reset.
+   Their locks can't be carried over, so the new parent only attaches to them
+   once every old worker has exited.
+A worker that dies is replaced.
+
+Run it with:
+    python dicebot_server.py
+PORT sets the port (default 5000) and DICEBOT_WORKERS the number of workers.
+DICEBOT_WSGI=minimal serves dicebot_wsgi.py instead of Flask.
+'''
+
+# Connections the kernel queues while every worker is busy or reloading
+LISTEN_BACKLOG = 1024
+
+# How often workers check if they were asked to stop, and the parent for dead workers, in seconds
+POLL_INTERVAL = 0.5
+
+# How a reloading parent finds what the old one left behind
+LISTEN_FD_ENV = "DICEBOT_LISTEN_FD"
+OLD_WORKERS_ENV = "DICEBOT_OLD_WORKERS"
+SHARED_MEMORY_ENV = "DICEBOT_SHARED_MEMORY"
+RATE_LIMIT_MEMORY_ENV = "DICEBOT_RATE_LIMIT_MEMORY"
+
+
+def default_workers():
+    '''
+    One worker per CPU this process may run on.
+    '''
+
+    if os.environ.get("DICEBOT_WORKERS"):
+        return int(os.environ["DICEBOT_WORKERS"])
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class QuietHandler(WSGIRequestHandler):
+    '''
+    Doesn't log every request to stderr, like gunicorn's default.
+    '''
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PreforkServer(object):
+    '''
+    Runs app in workers forked from this process. serve() returns when the server is stopped.
+    '''
+
+    def __init__(self, app, host="0.0.0.0", port=5000, workers=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.worker_count = workers or default_workers()
+        self.workers = set()
+        self.socket = None
+        self.counters = None
+        self.buckets = None
+        self.stopping = False
+        self.reloading = False
+
+    def listen(self):
+        '''
+        Opens the listening socket, or takes over the one of the parent before a reload.
+        '''
+
+        if os.environ.get(LISTEN_FD_ENV):
+            self.socket = socket.socket(fileno=int(os.environ.pop(LISTEN_FD_ENV)))
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((self.host, self.port))
+            self.socket.listen(LISTEN_BACKLOG)
+
+        # A worker that loses the race for a connection only waits in accept() until
+        # its next check for a stop
+        self.socket.settimeout(POLL_INTERVAL)
+        self.port = self.socket.getsockname()[1]
+
+    def share_state(self):
+        '''
+        Moves dicebot's metrics, and its rate limit buckets if they are kept in
+        memory, into shared memory. After a reload these are the old parent's
+        regions, so this must only run once the old workers have exited: they
+        still hold the old locks.
+        '''
+
+        if os.environ.get(SHARED_MEMORY_ENV):
+            self.counters = shared_counters.SharedCounters(name=os.environ.pop(SHARED_MEMORY_ENV), create=False)
+        else:
+            self.counters = shared_counters.SharedCounters()
+
+        registry = shared_counters.SharedRegistry(self.counters, dicebot.metrics_registry.buckets)
+        registry.descriptions = dict(dicebot.metrics_registry.descriptions)
+        dicebot.metrics_registry = registry
+
+        limiter = dicebot.rate_limiter
+        if limiter is not None and isinstance(limiter.store, rate_limit.MemoryStore):
+            if os.environ.get(RATE_LIMIT_MEMORY_ENV):
+                self.buckets = rate_limit.SharedMemoryStore(idle_ttl=limiter.store.idle_ttl,
+                                                            name=os.environ.pop(RATE_LIMIT_MEMORY_ENV), create=False)
+            else:
+                self.buckets = rate_limit.SharedMemoryStore(idle_ttl=limiter.store.idle_ttl)
+            limiter.store = self.buckets
+
+    def stop_old_workers(self):
+        '''
+        Stops the workers of the parent this process replaced in a reload.
+        They finish the request they are on first.
+        '''
+
+        old_workers = [int(pid) for pid in os.environ.pop(OLD_WORKERS_ENV, "").split(",") if pid]
+        for pid in old_workers:
+            self.signal_worker(pid, signal.SIGTERM)
+        for pid in old_workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+    def serve(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        self.listen()
+        # Everything a first request would build is built once, for every worker
+        dicebot.warm_up()
+
+        # The new code is ready, swap the workers over. Only then is the shared
+        # memory safe to use with new locks
+        self.stop_old_workers()
+        self.share_state()
+
+        # Keep everything made so far out of the collector, so workers don't copy those pages
+        gc.collect()
+        gc.freeze()
+
+        while len(self.workers) < self.worker_count:
+            self.spawn()
+        print("dicebot listening on " + self.host + ":" + str(self.port) + " with " +
+              str(self.worker_count) + " workers", flush=True)
+
+        while not self.stopping and not self.reloading:
+            time.sleep(POLL_INTERVAL)
+            self.reap()
+            while not self.stopping and not self.reloading and len(self.workers) < self.worker_count:
+                self.spawn()
+
+        if self.reloading:
+            self.reload()
+
+        for pid in self.workers:
+            self.signal_worker(pid, signal.SIGTERM)
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            self.workers.discard(pid)
+
+        self.socket.close()
+        for region in (self.counters, self.buckets):
+            if region is not None:
+                region.close()
+                region.unlink()
+
+    def handle_stop(self, signal_number, frame):
+        self.stopping = True
+
+    def handle_reload(self, signal_number, frame):
+        self.reloading = True
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.workers:
+                self.workers.discard(pid)
+                print("dicebot worker " + str(pid) + " exited with status " + str(status), flush=True)
+
+    def signal_worker(self, pid, signal_number):
+        try:
+            os.kill(pid, signal_number)
+        except ProcessLookupError:
+            pass
+
+    def reload(self):
+        '''
+        Runs this program again in this process, handing over the socket, the
+        shared memory and the running workers. Does not return.
+        '''
+
+        print("dicebot reloading", flush=True)
+        self.socket.set_inheritable(True)
+        os.environ[LISTEN_FD_ENV] = str(self.socket.fileno())
+        os.environ[OLD_WORKERS_ENV] = ",".join(str(pid) for pid in self.workers)
+        os.environ[SHARED_MEMORY_ENV] = self.counters.name
+        if self.buckets is not None:
+            os.environ[RATE_LIMIT_MEMORY_ENV] = self.buckets.name
+        sys.stdout.flush()
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return
+
+        # In the worker. Never return into the parent's loop.
+        status = 0
+        try:
+            self.run_worker()
+        except:
+            print(traceback.format_exc())
+            status = 1
+        finally:
+            # Save the stats and metrics this worker holds, like a normal exit would
+            atexit._run_exitfuncs()
+            os._exit(status)
+
+    def run_worker(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        # Ctrl-C reaches the whole process group, the parent stops the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        server = WSGIServer((self.host, self.port), QuietHandler, bind_and_activate=False)
+        server.socket.close()
+        server.socket = self.socket
+        server.server_name = socket.getfqdn(self.host)
+        server.server_port = self.port
+        server.setup_environ()
+        server.set_app(self.app)
+        server.timeout = POLL_INTERVAL
+
+        while not self.stopping:
+            server.handle_request()
+
+
+def server_app():
+    '''
+    The WSGI app to serve, the Flask app or with DICEBOT_WSGI=minimal the one in dicebot_wsgi.py.
+    '''
+
+    if os.environ.get("DICEBOT_WSGI") == "minimal":
+        import dicebot_wsgi
+        return dicebot_wsgi.app
+    return dicebot.app
+
+
+if __name__ == "__main__":
+    PreforkServer(server_app(), port=int(os.environ.get("PORT", 5000))).serve()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+from http.client import responses
+
+import dicebot
+
+'''
+A bare WSGI front end for dicebot, with no framework between the server and the commands.
+
+It answers the same URLs as the Flask app in dicebot.py with the same status codes
+and payloads: slash commands at "/" (the "command" field picks the command) or
+at their own path like /roll, plus /warmup and /metrics. Slash commands are
+checked against the Slack signature and run through dicebot.dispatch(), the
+same as the Flask routes. What is left out is Flask and Werkzeug themselves:
+the form is decoded straight from the request body with parse_qsl and the
+payload bytes from render_slack_payload() are handed to the server as they are.
+That is most of the CPU time of a small roll, see "python benchmark.py --apps".
+
+Slack posts application/x-www-form-urlencoded forms. Other bodies, like
+multipart forms, are not decoded and the command sees an empty form.
+
+Run it with any WSGI server, for example:
+    gunicorn dicebot_wsgi:app
+    DICEBOT_WSGI=minimal python dicebot_server.py
+'''
+
+FORM_CONTENT_TYPE = "application/x-www-form-urlencoded"
+
+# Methods the slash command URLs answer, like the Flask routes
+ALLOWED_METHODS = "GET, HEAD, POST, OPTIONS"
+
+# Bodies that aren't slack payloads. Flask's 404 and 405 pages are HTML, these are plain text
+REJECTED_BODY = b"Invalid signature"
+NOT_FOUND_BODY = b"Not Found"
+METHOD_NOT_ALLOWED_BODY = b"Method Not Allowed"
+
+TEXT_CONTENT_TYPE = "text/plain; charset=utf-8"
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# "200 OK" and so on, built once
+STATUS_LINES = dict((status, str(status) + " " + responses[status]) for status in (200, 401, 404, 405))
+
+
+def read_body(environ):
+    '''
+    Returns the raw request body.
+    '''
+
+    try:
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    return environ["wsgi.input"].read(length) if length > 0 else b""
+
+
+def decode_form(environ, body):
+    '''
+    Returns the form fields of a request body as a dict. A field sent more than
+    once keeps its first value, like Flask's request.form.get().
+    '''
+
+    if environ.get("CONTENT_TYPE", "").startswith(FORM_CONTENT_TYPE):
+        return dicebot.parse_form(body)
+    return {}
+
+
+def respond(start_response, status, body, content_type="application/json", headers=()):
+    '''
+    Starts a response with body, bytes or an iterator of bytes for a long message,
+    and returns what the WSGI server should send.
+    '''
+
+    if isinstance(body, bytes):
+        start_response(STATUS_LINES[status], [("Content-Type", content_type),
+                                              ("Content-Length", str(len(body)))] + list(headers))
+        return [body]
+
+    start_response(STATUS_LINES[status], [("Content-Type", content_type)] + list(headers))
+    return body
+
+
+def app(environ, start_response):
+    '''
+    The WSGI application. See the module docstring.
+
+    A HEAD request gets the headers a GET would, like Flask, but no body.
+    '''
+
+    body = route(environ, start_response)
+    if environ.get("REQUEST_METHOD") == "HEAD":
+        if hasattr(body, "close"):
+            body.close()
+        return []
+    return body
+
+
+def route(environ, start_response):
+    '''
+    Answers a request with its body, whatever the method.
+    '''
+
+    path = environ.get("PATH_INFO") or "/"
+    method = environ.get("REQUEST_METHOD", "GET")
+
+    if method in ("GET", "HEAD"):
+        if path == "/metrics":
+            return respond(start_response, 200, dicebot.metrics_registry.render().encode("utf-8"),
+                           METRICS_CONTENT_TYPE)
+        if path == "/warmup":
+            return respond(start_response, 200, dicebot.warmup_payload())
+
+    # Slash commands are at "/" or one level down, like /roll
+    if path.find("/", 1) != -1:
+        return respond(start_response, 404, NOT_FOUND_BODY, TEXT_CONTENT_TYPE)
+    if method == "OPTIONS":
+        return respond(start_response, 200, b"", TEXT_CONTENT_TYPE, [("Allow", ALLOWED_METHODS)])
+    if method not in ("GET", "HEAD", "POST"):
+        return respond(start_response, 405, METHOD_NOT_ALLOWED_BODY, TEXT_CONTENT_TYPE, [("Allow", ALLOWED_METHODS)])
+
+    # Refuse unsigned requests before the form is parsed or any dice are rolled
+    body = read_body(environ)
+    if not dicebot.verify_request(environ.get("HTTP_X_SLACK_REQUEST_TIMESTAMP"),
+                                  environ.get("HTTP_X_SLACK_SIGNATURE"), body):
+        return respond(start_response, 401, REJECTED_BODY, TEXT_CONTENT_TYPE)
+
+    status, payload = dicebot.dispatch(decode_form(environ, body), None if path == "/" else path)
+    dicebot.note_first_response()
+    return respond(start_response, status, payload)
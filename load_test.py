@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+from urllib.parse import urlencode, urlsplit
+
+import benchmark
+import dicebot_asgi
+import slack_signature
+
+'''
+A load generator for dicebot, to find how many slash commands a second a server
+can answer.
+
+It starts a server locally (gunicorn like the Procfile, dicebot_server.py with
+Flask or with dicebot_wsgi.py, or uvicorn with dicebot_asgi.py) for each worker
+count asked for and sends it slash command forms shaped like the ones slack
+posts (see parse_slack_message()), from a mix of /roll, /adv, /dis, /character
+and a tail of big rolls.
+
+Load is open loop: requests are sent on a schedule of random (Poisson) arrivals
+at the target rate whether or not earlier ones were answered, like slack users
+who don't wait for each other. Latency is counted from when a request was due,
+so a server that falls behind shows it in the latency instead of slowing the
+load down.
+
+Every form carries a response_url pointing at a local ResponseUrlStub, so
+commands the ASGI front end answers later are counted too, with their latency
+up to the delayed post.
+
+For each worker count and rate it reports the throughput, latency percentiles
+and error rate. Examples:
+    python load_test.py --server prefork --workers 1,2,4 --rates 100,200,400
+    python load_test.py --url http://127.0.0.1:5000/ --rates 50 --duration 30
+    python load_test.py --mix roll=50,adv=20,dis=20,character=10,big=0
+'''
+
+# How often each kind of command is sent, by weight. "big" is a /roll of a lot of dice
+DEFAULT_MIX = (("roll", 60), ("adv", 12), ("dis", 8), ("character", 10), ("big", 10))
+
+COMMANDS = {"roll": "/roll", "adv": "/adv", "dis": "/dis", "character": "/character", "big": "/roll"}
+
+# The text sent with each kind of command, picked at random
+TEXTS = {"roll": ("1d20", "1d20+5", "1d20+7", "2d6+3", "1d8+4", "3d6", "4d6kh3", "1d100", "8d6",
+                  "2d20kh1+3", "1d20+5; 2d6+3"),
+         "adv": ("", "+1", "+3", "+5", "-1"),
+         "dis": ("", "+2", "-1", "+4"),
+         "character": ("",),
+         "big": ("500d10t8", "1000d6", "2000d6", "10000d6")}
+
+# Slack workspaces the forms come from
+USERS = 200
+CHANNELS = 20
+
+# Requests still waiting for an answer past this many are not sent, and counted as dropped
+MAX_IN_FLIGHT = 2000
+
+# How long to wait for a server to answer /warmup after starting it, in seconds
+START_TIMEOUT = 30
+
+# The ways to start a server. {port} and {workers} are filled in
+SERVERS = {"gunicorn": (["gunicorn", "--workers", "{workers}", "--bind", "127.0.0.1:{port}", "dicebot_boot:app"],
+                        {}),
+           "prefork": ([sys.executable, "dicebot_server.py"], {"PORT": "{port}", "DICEBOT_WORKERS": "{workers}"}),
+           "minimal": ([sys.executable, "dicebot_server.py"],
+                       {"PORT": "{port}", "DICEBOT_WORKERS": "{workers}", "DICEBOT_WSGI": "minimal"}),
+           "asgi": (["uvicorn", "dicebot_asgi:app", "--host", "127.0.0.1", "--port", "{port}",
+                     "--workers", "{workers}"], {})}
+
+
+def parse_mix(mix_string):
+    '''
+    Reads a mix like "roll=60,adv=12,big=5" into a tuple of (kind, weight).
+    Raises ValueError for unknown kinds or bad weights.
+    '''
+
+    mix = []
+    for part in mix_string.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in COMMANDS:
+            raise ValueError("Unknown command kind " + kind + ", use one of " + ", ".join(sorted(COMMANDS)))
+        mix.append((kind, float(weight)))
+
+    if not any(weight > 0 for kind, weight in mix):
+        raise ValueError("The mix needs a weight above 0")
+    return tuple(mix)
+
+
+class SlackSimulator(object):
+    '''
+    Makes slash command forms like slack posts them. form() returns the next one
+    as a tuple of (kind, form dict).
+    '''
+
+    def __init__(self, mix=DEFAULT_MIX, response_url=None, seed=None):
+        self.kinds = [kind for kind, weight in mix]
+        self.weights = [weight for kind, weight in mix]
+        self.response_url = response_url
+        self.random = random.Random(seed)
+        self.sequence = 0
+
+    def form(self):
+        self.sequence += 1
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        user = self.random.randrange(USERS)
+        channel = self.random.randrange(CHANNELS)
+
+        form = {"token": "loadtest",
+                "team_id": "T0LOADTST",
+                "team_domain": "loadtest",
+                "channel_id": "C%08d" % channel,
+                "channel_name": "channel-" + str(channel),
+                "user_id": "U%08d" % user,
+                "user_name": "player-" + str(user),
+                "command": COMMANDS[kind],
+                "text": self.random.choice(TEXTS[kind]),
+                # Unique per request, like slack's, so signed requests are never replays
+                "trigger_id": str(self.sequence)}
+        if self.response_url is not None:
+            form["response_url"] = self.response_url + "/" + str(self.sequence)
+        return (kind, form)
+
+
+async def post_form(host, port, path, body, headers):
+    '''
+    POSTs one form on a new connection, the way slack does. Returns a tuple of
+    (HTTP status, body bytes).
+    '''
+
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        request = ("POST " + path + " HTTP/1.1\r\n" +
+                   "Host: " + host + ":" + str(port) + "\r\n" +
+                   "Content-Type: application/x-www-form-urlencoded\r\n" +
+                   "Content-Length: " + str(len(body)) + "\r\n" +
+                   "".join(name + ": " + value + "\r\n" for name, value in headers) +
+                   "Connection: close\r\n\r\n")
+        writer.write(request.encode("latin-1") + body)
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+
+    head, _, content = response.partition(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ")[1])
+    if any(line.lower().replace(" ", "") == "transfer-encoding:chunked" for line in lines[1:]):
+        content = dechunk(content)
+    return (status, content)
+
+
+def dechunk(content):
+    chunks = []
+    position = 0
+    while True:
+        line_end = content.index(b"\r\n", position)
+        size = int(content[position:line_end].split(b";")[0], 16)
+        if size == 0:
+            return b"".join(chunks)
+        chunks.append(content[line_end + 2:line_end + 2 + size])
+        position = line_end + 2 + size + 2
+
+
+def classify(status, content):
+    '''
+    Sorts an answer into "ok", "delayed" (acknowledged, answered through the
+    response_url later), "rate_limited", "error_reply" or "http_<status>".
+    '''
+
+    if status != 200:
+        return "http_" + str(status)
+
+    try:
+        text = json.loads(content.decode("utf-8"))["text"]
+    except (ValueError, KeyError, TypeError):
+        return "bad_json"
+
+    if text == dicebot_asgi.ACKNOWLEDGE_TEXT:
+        return "delayed"
+    if text.startswith("Slow down!"):
+        return "rate_limited"
+    if text.startswith("error:") or text.startswith("Hmm...."):
+        return "error_reply"
+    return "ok"
+
+
+async def run_load(url, rate, duration, simulator, stub=None, timeout=10, signer=None):
+    '''
+    Sends rate requests a second to url for duration seconds, open loop, and
+    returns a report dict. See summarize().
+
+    stub is the running ResponseUrlStub of the simulator's response_url, to time
+    delayed answers. signer is a slack_signature.SignatureVerifier to sign the
+    requests with.
+    '''
+
+    parts = urlsplit(url)
+    host = parts.hostname
+    port = parts.port or 80
+    path = parts.path or "/"
+
+    loop = asyncio.get_event_loop()
+    latencies = []
+    outcomes = {}
+    delayed_due = {}
+    delayed_latencies = []
+    tasks = set()
+
+    def on_message(message_path, message):
+        due = delayed_due.pop(message_path.rsplit("/", 1)[-1], None)
+        if due is not None:
+            delayed_latencies.append(loop.time() - due)
+
+    if stub is not None:
+        stub.on_message = on_message
+
+    async def send(due, form):
+        # A delayed answer can reach the stub before the ack reaches us, so its
+        # due time is registered before the request is sent
+        delayed = "response_url" in form
+        if delayed:
+            delayed_due[form["trigger_id"]] = due
+
+        body = urlencode(form).encode("utf-8")
+        headers = []
+        if signer is not None:
+            timestamp = str(int(time.time()))
+            headers = [("X-Slack-Request-Timestamp", timestamp),
+                       ("X-Slack-Signature", signer.sign(timestamp, body))]
+
+        try:
+            status, content = await asyncio.wait_for(post_form(host, port, path, body, headers), timeout)
+            outcome = classify(status, content)
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+        except (OSError, ValueError, IndexError):
+            outcome = "connection"
+
+        latencies.append(loop.time() - due)
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        if delayed and outcome != "delayed":
+            # Answered in the response, no delayed answer is coming
+            delayed_due.pop(form["trigger_id"], None)
+
+    start = loop.time()
+    due = start
+    for count in range(int(rate * duration)):
+        due += simulator.random.expovariate(rate)
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        kind, form = simulator.form()
+        if len(tasks) >= MAX_IN_FLIGHT:
+            outcomes["dropped"] = outcomes.get("dropped", 0) + 1
+            continue
+        task = asyncio.ensure_future(send(due, form))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.gather(*tasks)
+    elapsed = loop.time() - start
+
+    # Give the delayed answers as long as a request to arrive
+    waited = 0
+    while delayed_due and waited < timeout:
+        await asyncio.sleep(0.05)
+        waited += 0.05
+
+    return summarize(rate, elapsed, latencies, outcomes, delayed_latencies, len(delayed_due))
+
+
+def summarize(rate, elapsed, latencies, outcomes, delayed_latencies, delayed_missing):
+    '''
+    Returns a report dict of
+    {"rate": <target per second>, "requests": <int>, "answered": <int>, "throughput": <answered per second>,
+     "error_rate": <fraction>, "outcomes": {<outcome>: <count>},
+     "p50_ms", "p90_ms", "p99_ms", "max_ms": <latency>,
+     "delayed": <int>, "delayed_missing": <int>, "delayed_p50_ms", "delayed_p99_ms": <latency or None>}
+
+    Answered requests are the ones that got a good answer, right away or acknowledged.
+    Everything else, including delayed answers that never arrived, is an error.
+    '''
+
+    requests = sum(outcomes.values())
+    answered = outcomes.get("ok", 0) + outcomes.get("delayed", 0)
+    errors = requests - answered + delayed_missing
+
+    report = {"rate": rate,
+              "requests": requests,
+              "answered": answered,
+              "throughput": answered / elapsed if elapsed else 0.0,
+              "error_rate": errors / requests if requests else 0.0,
+              "outcomes": dict(outcomes),
+              "delayed": len(delayed_latencies),
+              "delayed_missing": delayed_missing}
+
+    latencies = sorted(latencies)
+    for percent in benchmark.PERCENTILES:
+        report["p" + str(percent) + "_ms"] = benchmark.percentile(latencies, percent) * 1000 if latencies else None
+    report["max_ms"] = latencies[-1] * 1000 if latencies else None
+
+    delayed_latencies = sorted(delayed_latencies)
+    for percent in (50, 99):
+        report["delayed_p" + str(percent) + "_ms"] = (benchmark.percentile(delayed_latencies, percent) * 1000
+                                                      if delayed_latencies else None)
+    return report
+
+
+def free_port():
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+def start_server(kind, workers, port, env=None):
+    '''
+    Starts a server from SERVERS and waits until it answers /warmup.
+    Returns the process. Raises ValueError if it doesn't come up.
+    '''
+
+    command, server_env = SERVERS[kind]
+    fill = {"port": str(port), "workers": str(workers)}
+    process_env = dict(os.environ if env is None else env)
+    for name, value in server_env.items():
+        process_env[name] = value.format(**fill)
+
+    process = subprocess.Popen([part.format(**fill) for part in command], env=process_env,
+                               cwd=os.path.dirname(os.path.abspath(__file__)),
+                               stdout=subprocess.DEVNULL, start_new_session=True)
+
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise ValueError(kind + " server exited with status " + str(process.returncode))
+        try:
+            urllib.request.urlopen("http://127.0.0.1:" + str(port) + "/warmup", timeout=1).read()
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    stop_server(process)
+    raise ValueError(kind + " server did not start in " + str(START_TIMEOUT) + " seconds")
+
+
+def stop_server(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def print_report(workers, report):
+    def milliseconds(value):
+        return "%9.1f" % value if value is not None else "%9s" % "-"
+
+    print("%7s %7d %8d %9.1f %s %s %s %s %7.2f%% %7d %s" % (
+        workers, report["rate"], report["requests"], report["throughput"],
+        milliseconds(report["p50_ms"]), milliseconds(report["p90_ms"]), milliseconds(report["p99_ms"]),
+        milliseconds(report["max_ms"]), report["error_rate"] * 100, report["delayed"],
+        " ".join(outcome + "=" + str(count) for outcome, count in sorted(report["outcomes"].items())
+                 if outcome not in ("ok", "delayed"))))
+
+
+async def run_all(args):
+    stub = await dicebot_asgi.ResponseUrlStub(keep=False).start()
+    signer = slack_signature.SignatureVerifier(args.signing_secret) if args.signing_secret else None
+    env = dict(os.environ)
+    # Let the ASGI servers post delayed responses to the stub
+    env["DICEBOT_RESPONSE_URL_ORIGINS"] = stub.url
+    if args.signing_secret:
+        env["SLACK_SIGNING_SECRET"] = args.signing_secret
+
+    print("%7s %7s %8s %9s %9s %9s %9s %9s %8s %7s %s" % ("workers", "rate", "requests", "req/s", "p50_ms",
+                                                        "p90_ms", "p99_ms", "max_ms", "errors", "delayed",
+                                                        "problems"))
+    results = []
+    try:
+        for workers in ([None] if args.url else args.workers):
+            process = None
+            url = args.url
+            if url is None:
+                port = free_port()
+                process = start_server(args.server, workers, port, env)
+                url = "http://127.0.0.1:" + str(port) + "/"
+            try:
+                for rate in args.rates:
+                    simulator = SlackSimulator(args.mix, stub.url, args.seed)
+                    report = await run_load(url, rate, args.duration, simulator, stub, args.timeout, signer)
+                    report["workers"] = workers
+                    report["server"] = None if args.url else args.server
+                    results.append(report)
+                    print_report("-" if workers is None else workers, report)
+            finally:
+                if process is not None:
+                    stop_server(process)
+    finally:
+        await stub.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test dicebot with simulated slack commands")
+    parser.add_argument("--server", choices=sorted(SERVERS), default="gunicorn", help="the server to start")
+    parser.add_argument("--url", default=None, help="test a server that is already running instead")
+    parser.add_argument("--workers", default="1", help="worker counts to try, like 1,2,4")
+    parser.add_argument("--rates", default="50,100,200", help="target requests per second, like 50,100,200")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run each rate")
+    parser.add_argument("--mix", default=",".join(kind + "=" + str(weight) for kind, weight in DEFAULT_MIX),
+                        help="weights of roll, adv, dis, character and big rolls")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds before a request counts as failed")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--signing-secret", default=None, help="sign requests, and start servers with this secret")
+    parser.add_argument("--json", default=None, help="also write the reports to this file")
+    args = parser.parse_args()
+
+    args.workers = [int(workers) for workers in args.workers.split(",")]
+    args.rates = [float(rate) for rate in args.rates.split(",")]
+    args.mix = parse_mix(args.mix)
+
+    results = asyncio.run(run_all(args))
+
+    if args.json:
+        with open(args.json, "w") as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+    return 1 if any(report["error_rate"] > 0 for report in results) else 0
+
+
+if __name__ == "__main__":
+    exit(main())
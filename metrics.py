@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+import atexit
+import bisect
+import fcntl
+import json
+import os
+import threading
+import time
+
+'''
+Low overhead counters and histograms, rendered in the Prometheus text format.
+
+Each process counts in memory under one lock. Gunicorn runs several worker
+processes, and a scrape only reaches one of them, so when a directory is
+configured (DICEBOT_METRICS_DIR) every process writes its totals to its own
+file there every few seconds. render() adds up the live totals of this process
+and the files of every other process, so the numbers cover all workers.
+
+Each file is named metrics_<pid>_<token>.json, the token being made up when the
+process starts, so a new worker that is given an old worker's pid does not take
+over its file. The files of workers that have exited are added into
+metrics_retired.json and removed, so totals never go backwards when gunicorn
+replaces a worker and the directory does not keep growing.
+'''
+
+# Histogram buckets in seconds, from 50 microseconds to 1 second
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# How often each process writes its totals to the metrics directory, in seconds
+FLUSH_INTERVAL = 5
+
+# Where the totals of exited workers are kept, see Registry.retire()
+RETIRED_FILE = "metrics_retired.json"
+
+
+def format_labels(labels):
+    '''
+    Renders a tuple of (name, value) pairs as {name="value",...}
+    '''
+
+    if not labels:
+        return ""
+
+    return "{" + ",".join(name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+                          for name, value in labels) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def file_pid(file_name):
+    '''
+    Returns the pid a metrics file was written by, or None for the retired file
+    and anything else in the directory.
+    '''
+
+    if not file_name.startswith("metrics_") or not file_name.endswith(".json"):
+        return None
+    pid = file_name[len("metrics_"):-len(".json")].split("_")[0]
+    return int(pid) if pid.isdigit() else None
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def add_snapshot(counters, histograms, snapshot):
+    '''
+    Adds a snapshot() dict into counters and histograms dicts keyed by (name, labels).
+    '''
+
+    for name, labels, value in snapshot["counters"]:
+        key = (name, tuple(tuple(label) for label in labels))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, values in snapshot["histograms"]:
+        key = (name, tuple(tuple(label) for label in labels))
+        if key in histograms:
+            histograms[key] = [total + value for total, value in zip(histograms[key], values)]
+        else:
+            histograms[key] = list(values)
+
+
+class Registry(object):
+    '''
+    Holds every counter and histogram for one process.
+
+    Labels are passed as a tuple of (name, value) pairs, like (("command", "/roll"),).
+    '''
+
+    def __init__(self, directory=None, buckets=DEFAULT_BUCKETS, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.buckets = tuple(buckets)
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.descriptions = {}
+        self.counters = {}
+        self.histograms = {}
+        self.pid = None
+        self.thread = None
+        self.token_pid = None
+        self.token = None
+
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            atexit.register(self.flush)
+
+    def describe(self, name, kind, help_text):
+        '''
+        Registers the type ("counter" or "histogram") and help text of a metric.
+        '''
+
+        self.descriptions[name] = (kind, help_text)
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        self.check_flusher()
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # One count per bucket, then +Inf, then the running sum
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[position] += 1
+            histogram[-1] += value
+        self.check_flusher()
+
+    def time(self, name, labels=()):
+        '''
+        Returns a context manager that observes how long its block took.
+        '''
+
+        return Timer(self, name, labels)
+
+    def check_flusher(self):
+        '''
+        Starts the flush thread the first time this process counts something.
+        A forked worker gets its own thread.
+        '''
+
+        if self.directory is None or self.pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run_flusher, name="metrics-flush")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run_flusher(self):
+        pid = os.getpid()
+        while self.pid == pid:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def snapshot(self):
+        '''
+        Returns this process's totals as a JSON friendly dict.
+        '''
+
+        with self.lock:
+            return {"counters": [[name, [list(label) for label in labels], value]
+                                 for (name, labels), value in self.counters.items()],
+                    "histograms": [[name, [list(label) for label in labels], list(values)]
+                                   for (name, labels), values in self.histograms.items()]}
+
+    def path(self):
+        '''
+        Returns the file this process writes its totals to. A forked worker
+        makes up its own token.
+        '''
+
+        if self.token_pid != os.getpid():
+            self.token_pid = os.getpid()
+            self.token = "%x" % time.time_ns() + os.urandom(4).hex()
+        return os.path.join(self.directory, "metrics_" + str(self.token_pid) + "_" + self.token + ".json")
+
+    def flush(self):
+        '''
+        Writes this process's totals to its file. The file is replaced in one
+        rename so readers never see half of it.
+        '''
+
+        if self.directory is None:
+            return
+
+        path = self.path()
+        try:
+            with open(path + ".tmp", "w") as metrics_file:
+                json.dump(self.snapshot(), metrics_file)
+            os.replace(path + ".tmp", path)
+            self.retire()
+        except OSError as error:
+            print("Unable to write metrics to " + path + ": " + str(error))
+
+    def retire(self):
+        '''
+        Adds the files of workers that have exited into RETIRED_FILE and removes
+        them. The retired file lists the files it holds, so a file that is added
+        but not yet removed is not counted twice.
+        '''
+
+        dead = [file_name for file_name in os.listdir(self.directory)
+                if file_pid(file_name) is not None and not pid_exists(file_pid(file_name))]
+        if not dead:
+            return
+
+        retired_path = os.path.join(self.directory, RETIRED_FILE)
+        with open(retired_path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(retired_path) as retired_file:
+                    retired = json.load(retired_file)
+            except FileNotFoundError:
+                retired = {"counters": [], "histograms": [], "files": []}
+            except ValueError as error:
+                print("Unable to read " + retired_path + ": " + str(error))
+                return
+
+            counters = {}
+            histograms = {}
+            add_snapshot(counters, histograms, retired)
+            files = set(retired["files"])
+            for file_name in dead:
+                if file_name in files:
+                    continue
+                try:
+                    with open(os.path.join(self.directory, file_name)) as metrics_file:
+                        add_snapshot(counters, histograms, json.load(metrics_file))
+                except FileNotFoundError:
+                    # Another worker retired it first
+                    continue
+                except ValueError:
+                    # Left half written by a crash, its last numbers are lost
+                    pass
+                files.add(file_name)
+
+            # Only files still in the directory need to be remembered
+            present = set(os.listdir(self.directory))
+            retired = {"counters": [[name, [list(label) for label in labels], value]
+                                    for (name, labels), value in counters.items()],
+                       "histograms": [[name, [list(label) for label in labels], values]
+                                      for (name, labels), values in histograms.items()],
+                       "files": sorted(files & present)}
+            with open(retired_path + ".tmp", "w") as retired_file:
+                json.dump(retired, retired_file)
+            os.replace(retired_path + ".tmp", retired_path)
+
+            for file_name in retired["files"]:
+                try:
+                    os.remove(os.path.join(self.directory, file_name))
+                except FileNotFoundError:
+                    pass
+
+    def collect(self):
+        '''
+        Returns (counters, histograms) added up over this process and every
+        other process's file.
+        '''
+
+        snapshots = {None: self.snapshot()}
+        retired = set()
+
+        if self.directory is not None:
+            own_file = os.path.basename(self.path())
+            # The retired file last, so a file retired meanwhile is counted once, either way
+            for file_name in sorted(os.listdir(self.directory)) + [RETIRED_FILE]:
+                if file_name == own_file or (file_name != RETIRED_FILE and file_pid(file_name) is None):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, file_name)) as metrics_file:
+                        snapshots[file_name] = json.load(metrics_file)
+                except (OSError, ValueError):
+                    # The worker is writing it right now, its numbers arrive next scrape
+                    continue
+            retired = set(snapshots.get(RETIRED_FILE, {}).get("files", ()))
+
+        counters = {}
+        histograms = {}
+        for file_name, snapshot in snapshots.items():
+            if file_name not in retired:
+                add_snapshot(counters, histograms, snapshot)
+
+        return (counters, histograms)
+
+    def render(self):
+        '''
+        Returns every metric in the Prometheus text exposition format.
+        '''
+
+        counters, histograms = self.collect()
+        lines = []
+
+        names = sorted(set(name for name, labels in counters) | set(name for name, labels in histograms))
+        for name in names:
+            kind, help_text = self.descriptions.get(name, ("untyped", ""))
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + kind)
+
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(name + format_labels(labels) + " " + format_value(value))
+
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), values[:-1]):
+                    cumulative += count
+                    bound_text = bound if bound == "+Inf" else repr(bound)
+                    lines.append(name + "_bucket" + format_labels(labels + (("le", bound_text),)) +
+                                 " " + str(cumulative))
+                lines.append(name + "_sum" + format_labels(labels) + " " + format_value(values[-1]))
+                lines.append(name + "_count" + format_labels(labels) + " " + str(cumulative))
+
+        return "\n".join(lines) + "\n"
+
+
+class Timer(object):
+    '''
+    A context manager that observes the seconds its block took in a histogram.
+    '''
+
+    __slots__ = ("registry", "name", "labels", "start")
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception, exception_traceback):
+        self.registry.observe(self.name, time.perf_counter() - self.start, self.labels)
+        return False
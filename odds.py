@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+import threading
+from array import array
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import accumulate
+from math import comb
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+'''
+Exact probability distributions for dice rolls.
+
+A distribution is a tuple of (low, probabilities) where probabilities[0] is the
+chance of rolling exactly low, probabilities[1] the chance of low + 1 and so on.
+probabilities is an array of doubles, 8 bytes each.
+
+Sums of dice are built by convolving smaller sums together, with an FFT when
+NumPy is installed. Intermediate sums are memoized, so 100d100 only needs about
+7 convolutions and asking for 3d6 after 6d6 is free. The memo is bounded by the
+bytes it holds (MAX_CACHE_BYTES), not by the number of sums.
+
+Rolls are limited by how many totals they can have and, for keeping dice, by
+how much counting that takes. plan_work() estimates the work of a roll so the
+caller can charge for it.
+
+This module has no Slack or Flask code. dicebot.py turns a RollPlan into a
+distribution with plan_distribution() and formats the answer for /odds.
+'''
+
+# Above this many multiplications NumPy convolutions switch to an FFT
+FFT_THRESHOLD = 250000
+
+# Keep-highest and keep-lowest terms are counted exactly by walking every face
+# value, which grows quickly. Terms above these limits, or estimated to take
+# more than MAX_KEEP_WORK steps (see keep_work()), are rejected.
+MAX_KEEP_DICE = 20
+MAX_KEEP_FACES = 100
+MAX_KEEP_WORK = 100000000
+
+# The widest range of totals a roll may have, like 1000d100. The pure Python
+# fallback adds one die at a time, so it gets a much smaller budget.
+MAX_OUTCOMES = 100000 if numpy is not None else 20000
+
+# How many bytes of probabilities the memo of sums keeps
+MAX_CACHE_BYTES = 32 * 1024 * 1024
+
+
+class DistributionCache(object):
+    '''
+    Keeps distributions by key, dropping the least recently used past max_bytes
+    of probabilities. A distribution bigger than max_bytes is not kept.
+    '''
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            distribution = self.entries.get(key)
+            if distribution is not None:
+                self.entries.move_to_end(key)
+            return distribution
+
+    def put(self, key, distribution):
+        size = distribution_bytes(distribution)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = distribution
+            self.size += size
+            while self.size > self.max_bytes:
+                old_key, old_distribution = self.entries.popitem(last=False)
+                self.size -= distribution_bytes(old_distribution)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def distribution_bytes(distribution):
+    return len(distribution[1]) * distribution[1].itemsize
+
+
+def to_probabilities(values):
+    '''
+    Returns a list or NumPy array of probabilities as an array of doubles.
+    '''
+
+    if numpy is not None and isinstance(values, numpy.ndarray):
+        probabilities = array("d")
+        probabilities.frombytes(numpy.ascontiguousarray(values, dtype=numpy.float64).tobytes())
+        return probabilities
+    return array("d", values)
+
+
+def convolve(first, second):
+    '''
+    Returns the convolution of two sequences of probabilities, as a NumPy array
+    if NumPy is installed and a list if not.
+    '''
+
+    if numpy is not None:
+        if len(first) * len(second) > FFT_THRESHOLD:
+            size = len(first) + len(second) - 1
+            result = numpy.fft.irfft(numpy.fft.rfft(first, size) * numpy.fft.rfft(second, size), size)
+            # FFT round off can leave tiny negative values
+            return numpy.clip(result, 0.0, None)
+        return numpy.convolve(first, second)
+
+    result = [0.0] * (len(first) + len(second) - 1)
+    for first_position, first_value in enumerate(first):
+        if first_value == 0.0:
+            continue
+        for second_position, second_value in enumerate(second):
+            result[first_position + second_position] += first_value * second_value
+    return result
+
+
+def combine(first, second):
+    '''
+    Returns the distribution of the sum of two independent distributions.
+    '''
+
+    return (first[0] + second[0], to_probabilities(convolve(first[1], second[1])))
+
+
+def negate(distribution):
+    '''
+    Returns the distribution of minus the given distribution.
+    '''
+
+    low, probabilities = distribution
+    return (-(low + len(probabilities) - 1), probabilities[::-1])
+
+
+def shift(distribution, amount):
+    '''
+    Returns the distribution with amount added to every outcome.
+    '''
+
+    return (distribution[0] + amount, distribution[1])
+
+
+def add_die(distribution, die):
+    '''
+    Returns the distribution with one more die added, using a sliding window
+    over the running sum instead of a full convolution.
+    '''
+
+    low, probabilities = distribution
+    running = [0.0]
+    running.extend(accumulate(probabilities))
+    last = len(probabilities)
+
+    result = []
+    for position in range(last + die - 1):
+        result.append((running[min(position + 1, last)] - running[max(position + 1 - die, 0)]) / die)
+
+    return (low + 1, array("d", result))
+
+
+sum_cache = DistributionCache()
+
+
+def sum_distribution(num_dice, die):
+    '''
+    Returns the distribution of the sum of num_dice dice with die sides.
+
+    With NumPy this splits num_dice in half, so only O(log num_dice) convolutions
+    are needed and every half is cached for the next caller.
+    '''
+
+    distribution = sum_cache.get((num_dice, die))
+    if distribution is not None:
+        return distribution
+
+    if num_dice == 1:
+        distribution = (1, array("d", [1.0 / die]) * die)
+    elif numpy is None:
+        # Without NumPy, adding one die at a time with a running sum is far
+        # cheaper than a pure Python convolution of the two halves.
+        distribution = sum_distribution(1, die)
+        for count in range(num_dice - 1):
+            distribution = add_die(distribution, die)
+    else:
+        half = num_dice // 2
+        distribution = combine(sum_distribution(half, die), sum_distribution(num_dice - half, die))
+
+    sum_cache.put((num_dice, die), distribution)
+    return distribution
+
+
+def sum_work(num_dice, die):
+    '''
+    Estimates the steps sum_distribution() takes, when nothing is cached.
+    '''
+
+    outcomes = num_dice * (die - 1) + 1
+    if numpy is None:
+        return num_dice * outcomes // 2
+    # FFTs of halves, quarters and so on add up to about two of the whole
+    return 2 * outcomes * max(outcomes.bit_length(), 1)
+
+
+def keep_work(num_dice, die, keep_count):
+    '''
+    Estimates the steps keep_highest_distribution() takes: every face, for every
+    split of the dice used and kept, for every sum kept so far.
+    '''
+
+    return die * (num_dice + 1) ** 2 * keep_count * (keep_count * (die - 1) + 1)
+
+
+@lru_cache(maxsize=256)
+def keep_highest_distribution(num_dice, die, keep_count):
+    '''
+    Returns the distribution of the sum of the highest keep_count dice of num_dice.
+
+    Faces are walked from highest to lowest while counting the ways c dice can show
+    each face. Once keep_count dice are kept the rest only have to be lower,
+    which is counted in one step. Counts are exact integers until the final divide.
+    '''
+
+    if keep_count >= num_dice:
+        return sum_distribution(num_dice, die)
+
+    if num_dice > MAX_KEEP_DICE or die > MAX_KEEP_FACES:
+        raise ValueError("Keeping dice is limited to " + str(MAX_KEEP_DICE) + "d" + str(MAX_KEEP_FACES))
+    if keep_work(num_dice, die, keep_count) > MAX_KEEP_WORK:
+        raise ValueError("Too much counting to keep " + str(keep_count) + " of " + str(num_dice) + "d" + str(die))
+
+    # (dice used so far, dice kept so far) -> {kept sum: ways}
+    states = {(0, 0): {0: 1}}
+    finished = {}
+
+    for face in range(die, 0, -1):
+        next_states = {}
+        for (used, kept), sums in states.items():
+            remaining = num_dice - used
+            for count in range(remaining + 1):
+                # Every die left over has to show a 1
+                if face == 1 and count != remaining:
+                    continue
+
+                ways = comb(remaining, count)
+                take = min(count, keep_count - kept)
+
+                if kept + take == keep_count:
+                    # The dice left over can show any lower face
+                    ways *= (face - 1) ** (remaining - count)
+                    target = finished
+                else:
+                    target = next_states.setdefault((used + count, kept + take), {})
+
+                for total, total_ways in sums.items():
+                    new_total = total + take * face
+                    target[new_total] = target.get(new_total, 0) + total_ways * ways
+        states = next_states
+
+    low = min(finished)
+    outcomes = die ** num_dice
+    return (low, array("d", [finished.get(total, 0) / outcomes for total in range(low, max(finished) + 1)]))
+
+
+def keep_distribution(num_dice, die, keep, keep_count):
+    '''
+    Returns the distribution of a dice term. keep is "high", "low" or None, the
+    same as a DiceTerm from dicebot.compile_roll().
+
+    Keeping the lowest dice is keeping the highest of dice with every face flipped.
+    '''
+
+    if keep is None or keep_count >= num_dice:
+        return sum_distribution(num_dice, die)
+
+    highest = keep_highest_distribution(num_dice, die, keep_count)
+    if keep == "high":
+        return highest
+
+    # Each kept face v is die + 1 - v on the flipped dice
+    return shift(negate(highest), keep_count * (die + 1))
+
+
+def plan_work(dice):
+    '''
+    Estimates the steps plan_distribution() takes for a list of DiceTerms, when
+    nothing is cached. Only meaningful for rolls plan_distribution() accepts.
+    '''
+
+    work = sum(term.num_dice * (term.die - 1) for term in dice) + 1
+    for term in dice:
+        if term.keep is None or term.keep_count >= term.num_dice:
+            work += sum_work(term.num_dice, term.die)
+        else:
+            work += keep_work(term.num_dice, term.die, term.keep_count)
+    return work
+
+
+def plan_distribution(dice, modifier):
+    '''
+    Returns the distribution of a whole roll. dice is a list of DiceTerms and
+    modifier is the constant added at the end.
+    '''
+
+    for term in dice:
+        if term.reroll or term.explode or term.target:
+            raise ValueError("Rerolls, exploding dice and success counting can only be simulated. Try /simulate")
+
+    outcomes = sum(term.num_dice * (term.die - 1) for term in dice) + 1
+    if outcomes > MAX_OUTCOMES:
+        raise ValueError("Too many possible totals to work out exactly")
+
+    distribution = (modifier, array("d", [1.0]))
+    for term in dice:
+        term_distribution = keep_distribution(term.num_dice, term.die, term.keep, term.keep_count)
+        if term.sign < 0:
+            term_distribution = negate(term_distribution)
+        distribution = combine(distribution, term_distribution)
+
+    return distribution
+
+
+def chance(distribution, comparison, target):
+    '''
+    Returns the chance that a roll compares to target. comparison is one of
+    ">=", ">", "<=", "<" or "=".
+    '''
+
+    low, probabilities = distribution
+    position = target - low
+
+    if comparison == ">=":
+        return sum(probabilities[max(position, 0):])
+    if comparison == ">":
+        return sum(probabilities[max(position + 1, 0):])
+    if comparison == "<=":
+        return sum(probabilities[:max(position + 1, 0)])
+    if comparison == "<":
+        return sum(probabilities[:max(position, 0)])
+    if comparison == "=":
+        return probabilities[position] if 0 <= position < len(probabilities) else 0.0
+
+    raise ValueError("Unknown comparison " + str(comparison))
+
+
+def mean(distribution):
+    '''
+    Returns the average roll of a distribution.
+    '''
+
+    low, probabilities = distribution
+    return sum((low + position) * probability for position, probability in enumerate(probabilities))
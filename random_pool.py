@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+import os
+import random
+import threading
+
+'''
+A pool of pre-drawn dice for the common die sizes.
+
+Drawing dice one at a time on the request thread means argument checks and bit
+rejection for every die. RandomPool keeps a buffer of faces for each common die
+and a background thread keeps the buffers topped up, so a request only has to
+slice values off the end of a list.
+
+Faces are drawn in bulk from random bytes with rejection sampling, so every
+face is exactly as likely as the others. Every die in DEFAULT_DICE is at most
+256 sides, so one byte is enough for each face.
+
+Buffers are per process. A worker forked from a parent with a full pool throws
+the inherited faces away and starts its own thread, otherwise every worker
+would hand out the same rolls.
+'''
+
+# The die sizes kept in the pool
+DEFAULT_DICE = (4, 6, 8, 10, 12, 20, 100)
+
+# How many faces to keep for each die
+DEFAULT_CAPACITY = 4096
+
+# The refill thread wakes up when a buffer falls below this many faces
+DEFAULT_LOW_WATER = 1024
+
+
+def draw_faces(rng, die, count):
+    '''
+    Draws count unbiased faces of a die with at most 256 sides from rng.
+
+    Bytes at or above the largest multiple of die are thrown away so every
+    face has the same number of byte values mapped to it.
+    '''
+
+    limit = 256 - 256 % die
+    faces = []
+    while len(faces) < count:
+        # Ask for a few extra bytes to cover the ones that get rejected
+        needed = count - len(faces)
+        data = rng.randbytes(needed + needed * (256 - limit) // limit + 8)
+        faces.extend(byte % die + 1 for byte in data if byte < limit)
+
+    del faces[count:]
+    return faces
+
+
+class RandomPool(object):
+    '''
+    Per-process buffers of pre-drawn faces with a background refill thread.
+
+    take() returns a list of faces or None when the die is not pooled or the
+    buffer does not hold enough faces. hits and misses count dice, not calls,
+    and are only changed holding self.lock.
+    '''
+
+    def __init__(self, dice=DEFAULT_DICE, capacity=DEFAULT_CAPACITY, low_water=DEFAULT_LOW_WATER):
+        for die in dice:
+            if die > 256:
+                raise ValueError("RandomPool only holds dice with up to 256 sides. Given " + str(die))
+
+        self.dice = tuple(dice)
+        self.capacity = capacity
+        self.low_water = low_water
+        self.hits = 0
+        self.misses = 0
+        self.pid = None
+        self.start_lock = threading.Lock()
+        self.start()
+
+    def start(self):
+        '''
+        Sets up empty buffers, fills them and starts the refill thread for this process.
+        pid is set last, so other threads keep waiting on start_lock until it is done.
+        '''
+
+        self.rng = random.Random()
+        self.lock = threading.Lock()
+        self.locks = dict((die, threading.Lock()) for die in self.dice)
+        self.buffers = dict((die, []) for die in self.dice)
+        self.refill_wanted = threading.Event()
+        self.stopped = False
+
+        self.refill()
+
+        self.thread = threading.Thread(target=self.run, name="RandomPool-refill")
+        self.thread.daemon = True
+        self.thread.start()
+        self.pid = os.getpid()
+
+    def stop(self):
+        self.stopped = True
+        self.refill_wanted.set()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            self.refill_wanted.wait()
+            self.refill_wanted.clear()
+            if self.stopped:
+                return
+            self.refill()
+
+    def refill(self):
+        '''
+        Tops every buffer back up to capacity. Faces are drawn outside the lock,
+        and only as many as there is still room for are added.
+        '''
+
+        for die in self.dice:
+            with self.locks[die]:
+                needed = self.capacity - len(self.buffers[die])
+            if needed <= 0:
+                continue
+
+            faces = draw_faces(self.rng, die, needed)
+            with self.locks[die]:
+                buffer = self.buffers[die]
+                buffer.extend(faces[:max(self.capacity - len(buffer), 0)])
+
+    def take(self, die, count):
+        '''
+        Returns a list of count faces for die, or None if the pool can not supply them.
+        '''
+
+        if self.pid != os.getpid():
+            # This is a forked worker, never reuse the parent's faces
+            with self.start_lock:
+                if self.pid != os.getpid():
+                    self.start()
+
+        lock = self.locks.get(die)
+        if lock is None or count > self.capacity:
+            with self.lock:
+                self.misses += count
+            return None
+
+        with lock:
+            buffer = self.buffers[die]
+            if len(buffer) < count:
+                faces = None
+            else:
+                faces = buffer[-count:]
+                del buffer[-count:]
+            remaining = len(buffer)
+
+        with self.lock:
+            if faces is None:
+                self.misses += count
+            else:
+                self.hits += count
+
+        if remaining < self.low_water:
+            self.refill_wanted.set()
+
+        return faces
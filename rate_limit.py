@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+import hashlib
+import multiprocessing
+import struct
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+
+'''
+Token bucket rate limiting.
+
+Every key (a user or a channel) has a bucket that holds up to capacity tokens
+and refills at rate tokens a second. A request costs tokens, usually one plus the
+number of dice it rolls, so a flood of 99d100 runs out long before a table
+rolling 1d20s does. A request is let through only if every bucket it touches
+has enough tokens, and then it is charged to all of them.
+
+Buckets live in a store:
+ - MemoryStore keeps them in this process. Each check is O(1), and buckets idle
+   for longer than the TTL are dropped. A dropped bucket would have refilled
+   anyway.
+ - SharedMemoryStore keeps them in a shared memory region, so every worker
+   forked from one process shares one limit. dicebot_server.py uses it in
+   place of a MemoryStore.
+ - RedisStore keeps them in Redis so every worker and dyno shares one limit.
+   The check runs as one Lua script, so it is atomic. Needs the redis package.
+ - FakeRedis is a stand-in Redis client for tests. It runs the same bucket
+   math in Python in place of the Lua script.
+'''
+
+# Buckets idle this long are forgotten, in seconds
+DEFAULT_IDLE_TTL = 600
+
+# Buckets in a SharedMemoryStore, 24 bytes each
+DEFAULT_SHARED_BUCKETS = 65536
+
+# Places a SharedMemoryStore looks for a key before it takes over the stalest one
+PROBE_LIMIT = 8
+
+# A shared bucket: the 64 bit hash of its key (0 for a free bucket), tokens and last update
+SHARED_BUCKET = struct.Struct("<Qdd")
+
+
+def charge(states, buckets, cost, now):
+    '''
+    The token bucket math shared by every store.
+
+    states holds the (tokens, last_update) of each bucket, or None for a new
+    bucket. buckets holds the matching (key, capacity, rate) tuples.
+
+    Returns (allowed, retry_after, limited, new_states). limited is the position of
+    the bucket with the longest wait, and new_states is None, when the request is refused.
+    '''
+
+    levels = []
+    retry_after = 0.0
+    limited = None
+    for position, (state, (key, capacity, rate)) in enumerate(zip(states, buckets)):
+        if state is None:
+            tokens = capacity
+        else:
+            tokens = min(capacity, state[0] + max(now - state[1], 0) * rate)
+        levels.append(tokens)
+        if tokens < cost and (cost - tokens) / rate > retry_after:
+            retry_after = (cost - tokens) / rate
+            limited = position
+
+    if limited is not None:
+        return (False, retry_after, limited, None)
+
+    return (True, 0.0, None, [(tokens - cost, now) for tokens in levels])
+
+
+class MemoryStore(object):
+    '''
+    Buckets for this process only. Least recently used buckets are kept at the
+    front of an OrderedDict so idle ones can be dropped without a scan.
+    '''
+
+    def __init__(self, idle_ttl=DEFAULT_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, buckets, cost, now):
+        '''
+        Charges cost to every bucket in buckets, a list of (key, capacity, rate) tuples,
+        if they all have enough tokens. Returns a tuple of (allowed, retry_after seconds,
+        position of the bucket that ran out or None).
+        '''
+
+        with self.lock:
+            self.evict(now)
+            allowed, retry_after, limited, states = charge([self.buckets.get(key) for key, capacity, rate in buckets],
+                                                           buckets, cost, now)
+            if allowed:
+                for (key, capacity, rate), state in zip(buckets, states):
+                    self.buckets[key] = state
+                    self.buckets.move_to_end(key)
+
+        return (allowed, retry_after, limited)
+
+    def evict(self, now):
+        while self.buckets:
+            key, (tokens, last) = next(iter(self.buckets.items()))
+            if now - last < self.idle_ttl:
+                return
+            del self.buckets[key]
+
+
+class SharedMemoryStore(object):
+    '''
+    Buckets shared by every process forked from the one that made the store.
+
+    The buckets are a fixed size open addressing table in shared memory, keyed
+    by a 64 bit hash of the key, so two keys with the same hash would share a
+    bucket. A key is looked for in PROBE_LIMIT places. When it isn't there it
+    takes a free or idle bucket, or else the one idle the longest, which at
+    worst gives that key a full bucket again early. One lock covers the table,
+    a check holds it for a few microseconds.
+
+    Like SharedCounters, attach to an existing region by name with create=False,
+    but the lock can't be passed by name, so only processes forked from the
+    one that made the store can use it at the same time.
+    '''
+
+    def __init__(self, capacity=DEFAULT_SHARED_BUCKETS, idle_ttl=DEFAULT_IDLE_TTL, name=None, create=True):
+        size = capacity * SHARED_BUCKET.size
+        self.memory = shared_memory.SharedMemory(name=name, create=create, size=size if create else 0)
+        # The region outlives a graceful reload, so it is unlinked by hand, see unlink()
+        resource_tracker.unregister(self.memory._name, "shared_memory")
+
+        self.capacity = self.memory.size // SHARED_BUCKET.size
+        self.idle_ttl = idle_ttl
+        self.lock = multiprocessing.Lock()
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def find(self, key_hash, now, taken):
+        '''
+        Returns the offset of the bucket for key_hash and its (tokens, last_update),
+        or None as the state for a new bucket. Offsets in taken are skipped.
+        Must be called holding the lock.
+        '''
+
+        start = key_hash % self.capacity
+        reuse = None
+        reuse_last = None
+        for probe in range(min(PROBE_LIMIT, self.capacity)):
+            offset = (start + probe) % self.capacity * SHARED_BUCKET.size
+            if offset in taken:
+                continue
+            stored, tokens, last = SHARED_BUCKET.unpack_from(self.memory.buf, offset)
+            if stored == key_hash:
+                return (offset, (tokens, last))
+            if stored == 0 or now - last >= self.idle_ttl:
+                # Free, or idle long enough to have refilled, take it unless the key turns up
+                last = float("-inf")
+            if reuse is None or last < reuse_last:
+                reuse = offset
+                reuse_last = last
+
+        return (reuse, None)
+
+    def take(self, buckets, cost, now):
+        '''
+        See MemoryStore.take().
+        '''
+
+        hashes = [int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+                  for key, capacity, rate in buckets]
+
+        with self.lock:
+            offsets = []
+            states = []
+            for key_hash in hashes:
+                offset, state = self.find(key_hash, now, offsets)
+                offsets.append(offset)
+                states.append(state)
+
+            allowed, retry_after, limited, states = charge(states, buckets, cost, now)
+            if allowed:
+                for key_hash, offset, (tokens, last) in zip(hashes, offsets, states):
+                    SHARED_BUCKET.pack_into(self.memory.buf, offset, key_hash, tokens, last)
+
+        return (allowed, retry_after, limited)
+
+    def close(self):
+        self.memory.close()
+
+    def unlink(self):
+        # unlink() tells the resource tracker too, which expects to know the region
+        resource_tracker.register(self.memory._name, "shared_memory")
+        self.memory.unlink()
+
+
+# KEYS are the bucket keys. ARGV is cost, now, ttl, then capacity and rate for each key.
+# See charge() for the same math in Python.
+TOKEN_BUCKET_SCRIPT = """
+local cost = tonumber(ARGV[1])
+local now = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+local levels = {}
+local retry_after = 0
+local limited = 0
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 + i * 2])
+    local rate = tonumber(ARGV[3 + i * 2])
+    local state = redis.call("HMGET", key, "tokens", "last")
+    local tokens = capacity
+    if state[1] then
+        tokens = math.min(capacity, tonumber(state[1]) + math.max(now - tonumber(state[2]), 0) * rate)
+    end
+    levels[i] = tokens
+    if tokens < cost and (cost - tokens) / rate > retry_after then
+        retry_after = (cost - tokens) / rate
+        limited = i
+    end
+end
+if limited > 0 then
+    return {0, tostring(retry_after), limited - 1}
+end
+for i, key in ipairs(KEYS) do
+    redis.call("HSET", key, "tokens", tostring(levels[i] - cost), "last", tostring(now))
+    redis.call("EXPIRE", key, ttl)
+end
+return {1, "0", -1}
+"""
+
+
+class RedisStore(object):
+    '''
+    Buckets shared by every process through Redis. client is a redis.Redis, or a FakeRedis in tests.
+    '''
+
+    def __init__(self, client, idle_ttl=DEFAULT_IDLE_TTL, prefix="dicebot:rate:"):
+        self.client = client
+        self.idle_ttl = idle_ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, idle_ttl=DEFAULT_IDLE_TTL):
+        # Only imported when it is used, so the in-process limits don't load it
+        try:
+            import redis
+        except ImportError:
+            raise ValueError("A shared rate limit needs the redis package")
+        return cls(redis.Redis.from_url(url), idle_ttl)
+
+    def take(self, buckets, cost, now):
+        arguments = [cost, now, int(self.idle_ttl)]
+        for key, capacity, rate in buckets:
+            arguments.extend((capacity, rate))
+
+        allowed, retry_after, limited = self.client.eval(
+            TOKEN_BUCKET_SCRIPT, len(buckets), *([self.prefix + key for key, capacity, rate in buckets] + arguments))
+
+        if int(allowed):
+            return (True, 0.0, None)
+        return (False, float(retry_after), int(limited))
+
+
+class FakeRedis(object):
+    '''
+    Enough of a redis.Redis client to run RedisStore in tests. Only
+    TOKEN_BUCKET_SCRIPT can be evaluated. Keys expire like they would in Redis.
+    '''
+
+    def __init__(self):
+        self.hashes = {}
+        self.expires = {}
+
+    def eval(self, script, numkeys, *keys_and_args):
+        if script != TOKEN_BUCKET_SCRIPT:
+            raise ValueError("FakeRedis can only run the token bucket script")
+
+        keys = keys_and_args[:numkeys]
+        cost, now, ttl = [float(value) for value in keys_and_args[numkeys:numkeys + 3]]
+        limits = keys_and_args[numkeys + 3:]
+        buckets = [(key, float(limits[position * 2]), float(limits[position * 2 + 1]))
+                   for position, key in enumerate(keys)]
+
+        states = []
+        for key in keys:
+            if key in self.expires and self.expires[key] <= time.time():
+                del self.hashes[key]
+                del self.expires[key]
+            states.append(self.hashes.get(key))
+
+        allowed, retry_after, limited, states = charge(states, buckets, cost, now)
+        if not allowed:
+            return [0, str(retry_after), limited]
+
+        for key, state in zip(keys, states):
+            self.hashes[key] = state
+            self.expires[key] = time.time() + ttl
+        return [1, "0", -1]
+
+
+class RateLimiter(object):
+    '''
+    Limits each user and each channel with its own bucket.
+
+    check() returns a tuple of (allowed, retry_after seconds, scope), where scope
+    is "user" or "channel" for the bucket that ran out, or None when allowed.
+    '''
+
+    def __init__(self, store, user_capacity, user_rate, channel_capacity, channel_rate):
+        self.store = store
+        self.user_capacity = user_capacity
+        self.user_rate = user_rate
+        self.channel_capacity = channel_capacity
+        self.channel_rate = channel_rate
+
+    def check(self, username, channel, cost, now=None):
+        if now is None:
+            now = time.time()
+
+        # A request bigger than a bucket would never get through, charge it a full bucket instead
+        cost = min(cost, self.user_capacity, self.channel_capacity)
+
+        user_bucket = ("user:" + str(username), self.user_capacity, self.user_rate)
+        channel_bucket = ("channel:" + str(channel), self.channel_capacity, self.channel_rate)
+
+        allowed, retry_after, limited = self.store.take([user_bucket, channel_bucket], cost, now)
+        if allowed:
+            return (True, 0.0, None)
+        return (False, retry_after, ("user", "channel")[limited])
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+import hashlib
+import itertools
+import os
+import random
+import secrets
+import sys
+from array import array
+
+'''
+Seedable random number backends for rolling dice.
+
+Every draw gets its own key, derived from the backend's seed, a stream number
+and a per-stream request counter. The draw returns a record of those three
+numbers, and replay() with that record rolls exactly the same faces again, so
+a disputed roll can be checked.
+
+Rolls that need more dice after the first draw, like rerolls and exploding
+dice, draw them with draw_step() under the same record and a step number, so
+the whole roll still replays from one record.
+
+The request counter is a plain itertools.count(), so threads never take a lock.
+Each process gets its own stream (the process id unless one is given), so
+forked workers never produce the same sequence.
+
+The part of the key that comes from the seed and stream is worked out once per
+stream, so a draw only mixes in its request number.
+
+Backends:
+ - shake - the default. The key is hashed once with SHAKE-128 and the output
+   is read as one 64 bit value per face, so the whole draw is one C call plus
+   a modulo per face. Big draws turn the values into faces with NumPy and give
+   the same faces as without it.
+ - mersenne - Python's Mersenne Twister, seeded per draw. Seeding costs about
+   as much as the rest of a small roll together, use shake unless old
+   mersenne records must keep replaying.
+ - system - os.urandom through secrets.SystemRandom, for tournament play.
+   These rolls can not be predicted or replayed.
+ - splitmix - a counter-based generator (SplitMix64). Face n of a draw is a
+   hash of the key and n, so it vectorizes with NumPy and gives the same faces
+   with or without NumPy installed. Below VECTORIZE_THRESHOLD dice every face
+   is hashed in pure Python, so small draws are several times slower than shake.
+ - philox - NumPy's counter-based Philox generator. Needs NumPy. Every draw
+   builds a new Generator, which is slower than shake for small rolls.
+
+NumPy is only imported when a draw first needs it, so starting up doesn't wait on it.
+'''
+
+MASK64 = (1 << 64) - 1
+
+# SplitMix64 constants
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+MIX_MULTIPLIER_1 = 0xBF58476D1CE4E5B9
+MIX_MULTIPLIER_2 = 0x94D049BB133111EB
+
+# Below this many dice NumPy's call overhead costs more than hashing in pure Python
+VECTORIZE_THRESHOLD = 64
+
+# Bytes of SHAKE-128 output per face
+FACE_BYTES = 8
+
+# NumPy, once load_numpy() has imported it. None if it isn't installed
+numpy = None
+numpy_checked = False
+
+
+def load_numpy():
+    '''
+    Imports NumPy the first time it is needed. Returns the module, or None if it isn't installed.
+    '''
+
+    global numpy, numpy_checked
+
+    if not numpy_checked:
+        numpy_checked = True
+        try:
+            import numpy as numpy_module
+        except ImportError:
+            numpy_module = None
+        numpy = numpy_module
+
+    return numpy
+
+
+def mix64(value):
+    '''
+    The SplitMix64 finalizer. Scrambles a 64 bit int into another 64 bit int.
+    '''
+
+    value = ((value ^ (value >> 30)) * MIX_MULTIPLIER_1) & MASK64
+    value = ((value ^ (value >> 27)) * MIX_MULTIPLIER_2) & MASK64
+    return value ^ (value >> 31)
+
+
+def derive_stream_key(seed, stream):
+    '''
+    Returns the part of a draw's key that comes from the seed and stream.
+    '''
+
+    key = mix64((seed + GOLDEN_GAMMA) & MASK64)
+    return mix64(((key ^ stream) + GOLDEN_GAMMA) & MASK64)
+
+
+def derive_key(seed, stream, request, stream_key=None):
+    '''
+    Returns the 64 bit key for one draw from a seed, stream and request number.
+    Pass stream_key from derive_stream_key() to skip working it out again.
+    '''
+
+    if stream_key is None:
+        stream_key = derive_stream_key(seed, stream)
+    return mix64(((stream_key ^ request) + GOLDEN_GAMMA) & MASK64)
+
+
+def derive_step_key(record, step):
+    '''
+    Returns the key for follow up draw number step of the draw that returned record.
+    Step 0 is the draw itself.
+    '''
+
+    key = derive_key(record["seed"], record["stream"], record["request"])
+    if step == 0:
+        return key
+    return mix64(((key ^ step) + GOLDEN_GAMMA) & MASK64)
+
+
+def split_faces(faces, counts):
+    '''
+    Splits one flat list of faces into one list per spec.
+    '''
+
+    rolls = []
+    position = 0
+    for count in counts:
+        rolls.append(faces[position:position + count])
+        position += count
+    return rolls
+
+
+class RngBackend(object):
+    '''
+    The interface every backend follows.
+
+    draw(spec_list) takes a list of (num_dice, die) tuples and returns a tuple of
+    (rolls, record), where rolls holds one list of faces per spec. replay(record, spec_list)
+    returns the same rolls again. draw_step(record, step, spec_list) draws more dice
+    that belong to the same record. Subclasses only implement draw_key().
+    '''
+
+    name = None
+    replayable = True
+
+    def __init__(self, seed=None, stream=None):
+        if seed is None:
+            seed = int.from_bytes(os.urandom(8), "little")
+
+        self.seed = seed
+        self.fixed_stream = stream
+        self.pid = None
+        self.reset_stream()
+
+    def reset_stream(self):
+        self.pid = os.getpid()
+        self.stream = self.fixed_stream if self.fixed_stream is not None else self.pid
+        self.stream_key = derive_stream_key(self.seed, self.stream)
+        self.requests = itertools.count()
+
+    def draw(self, spec_list):
+        if self.pid != os.getpid() and self.fixed_stream is None:
+            # A forked worker must not repeat its parent's stream
+            self.reset_stream()
+
+        request = next(self.requests)
+        record = {"backend": self.name,
+                  "seed": self.seed,
+                  "stream": self.stream,
+                  "request": request}
+
+        return (self.draw_key(derive_key(self.seed, self.stream, request, self.stream_key), spec_list),
+                record)
+
+    def replay(self, record, spec_list):
+        return self.replay_step(record, 0, spec_list)
+
+    def draw_step(self, record, step, spec_list):
+        '''
+        Draws follow up dice for the draw that returned record, like rerolls.
+        Steps start at 1 and each step gives different faces.
+        '''
+
+        return self.draw_key(derive_step_key(record, step), spec_list)
+
+    def replay_step(self, record, step, spec_list):
+        if not self.replayable:
+            raise ValueError(self.name + " rolls can not be replayed")
+        if record.get("backend") != self.name:
+            raise ValueError("Can not replay a " + str(record.get("backend")) + " roll with " + self.name)
+
+        return self.draw_key(derive_step_key(record, step), spec_list)
+
+    def draw_key(self, key, spec_list):
+        raise NotImplementedError
+
+
+class MersenneBackend(RngBackend):
+    name = "mersenne"
+
+    def draw_key(self, key, spec_list):
+        rng = random.Random(key)
+        return [rng.choices(range(1, die + 1), k=num_dice) for num_dice, die in spec_list]
+
+
+class SystemBackend(RngBackend):
+    name = "system"
+    replayable = False
+
+    def __init__(self, seed=None, stream=None):
+        RngBackend.__init__(self, seed, stream)
+        self.rng = secrets.SystemRandom()
+
+    def draw_key(self, key, spec_list):
+        # The key is ignored, every face comes from the operating system
+        return [[self.rng.randrange(die) + 1 for count in range(num_dice)] for num_dice, die in spec_list]
+
+
+def splitmix_faces(key, spec_list):
+    '''
+    Returns the faces for spec_list from the SplitMix64 stream of key.
+
+    Face n uses counter value n. Values at or above the largest multiple of the die
+    are skipped and the next counter value is used instead, so faces are unbiased.
+    With NumPy the whole draw is one vectorized hash. Skips happen with a chance of
+    about die / 2**64, and when one does the draw is redone one face at a time, so
+    both paths always give the same faces.
+    '''
+
+    counts = [num_dice for num_dice, die in spec_list]
+    total = sum(counts)
+
+    if total >= VECTORIZE_THRESHOLD and load_numpy() is not None:
+        dice = numpy.repeat(numpy.array([die for num_dice, die in spec_list], dtype=numpy.uint64), counts)
+        counters = numpy.arange(1, total + 1, dtype=numpy.uint64)
+        values = numpy.uint64(key) + counters * numpy.uint64(GOLDEN_GAMMA)
+        values = (values ^ (values >> numpy.uint64(30))) * numpy.uint64(MIX_MULTIPLIER_1)
+        values = (values ^ (values >> numpy.uint64(27))) * numpy.uint64(MIX_MULTIPLIER_2)
+        values = values ^ (values >> numpy.uint64(31))
+
+        # 2**64 - (2**64 % die), written so it stays inside uint64
+        limits = numpy.uint64(MASK64) - (numpy.uint64(MASK64) - dice + numpy.uint64(1)) % dice
+        if bool((values <= limits).all()):
+            return split_faces((values % dice + numpy.uint64(1)).tolist(), counts)
+
+    rolls = []
+    counter = 0
+    for num_dice, die in spec_list:
+        limit = (1 << 64) - (1 << 64) % die
+        faces = []
+        while len(faces) < num_dice:
+            counter += 1
+            value = mix64((key + counter * GOLDEN_GAMMA) & MASK64)
+            if value < limit:
+                faces.append(value % die + 1)
+        rolls.append(faces)
+    return rolls
+
+
+class SplitMixBackend(RngBackend):
+    name = "splitmix"
+
+    def draw_key(self, key, spec_list):
+        return splitmix_faces(key, spec_list)
+
+
+class PhiloxBackend(RngBackend):
+    name = "philox"
+
+    def __init__(self, seed=None, stream=None):
+        if load_numpy() is None:
+            raise ValueError("The philox backend needs NumPy")
+        RngBackend.__init__(self, seed, stream)
+
+    def draw_key(self, key, spec_list):
+        rng = numpy.random.Generator(numpy.random.Philox(key=key))
+        counts = [num_dice for num_dice, die in spec_list]
+        faces = rng.integers(1, numpy.repeat([die + 1 for num_dice, die in spec_list], counts))
+        return split_faces(faces.tolist(), counts)
+
+
+def shake_faces(key, spec_list):
+    '''
+    Returns the faces for spec_list from the SHAKE-128 output of key.
+
+    Face n is read from bytes 8n to 8n + 8 of the output as a little endian value,
+    and is value % die + 1. Values at or above the largest multiple of the die
+    are skipped and the next value is used instead, so faces are unbiased. Skips
+    happen with a chance of about die / 2**64, and when one does the draw is
+    redone one face at a time from a longer output, which starts with the same
+    bytes. NumPy is only used for big draws and gives the same faces.
+    '''
+
+    counts = [num_dice for num_dice, die in spec_list]
+    total = sum(counts)
+    seed = key.to_bytes(8, "little")
+    data = hashlib.shake_128(seed).digest(total * FACE_BYTES)
+
+    if total >= VECTORIZE_THRESHOLD and load_numpy() is not None:
+        dice = numpy.repeat(numpy.array([die for num_dice, die in spec_list], dtype=numpy.uint64), counts)
+        values = numpy.frombuffer(data, dtype="<u8")
+
+        # 2**64 - (2**64 % die), written so it stays inside uint64
+        limits = numpy.uint64(MASK64) - (numpy.uint64(MASK64) - dice + numpy.uint64(1)) % dice
+        if bool((values <= limits).all()):
+            return split_faces((values % dice + numpy.uint64(1)).tolist(), counts)
+    else:
+        values = array("Q", data)
+        if sys.byteorder == "big":
+            values.byteswap()
+
+        rolls = []
+        position = 0
+        for num_dice, die in spec_list:
+            chunk = values[position:position + num_dice]
+            if num_dice and max(chunk) >= (1 << 64) - (1 << 64) % die:
+                break
+            rolls.append([value % die + 1 for value in chunk])
+            position += num_dice
+        else:
+            return rolls
+
+    rolls = []
+    position = 0
+    for num_dice, die in spec_list:
+        limit = (1 << 64) - (1 << 64) % die
+        faces = []
+        while len(faces) < num_dice:
+            if position + FACE_BYTES > len(data):
+                data = hashlib.shake_128(seed).digest(len(data) * 2 + FACE_BYTES)
+            value = int.from_bytes(data[position:position + FACE_BYTES], "little")
+            position += FACE_BYTES
+            if value < limit:
+                faces.append(value % die + 1)
+        rolls.append(faces)
+    return rolls
+
+
+class ShakeBackend(RngBackend):
+    name = "shake"
+
+    def draw_key(self, key, spec_list):
+        return shake_faces(key, spec_list)
+
+
+BACKENDS = {"shake": ShakeBackend,
+            "mersenne": MersenneBackend,
+            "system": SystemBackend,
+            "splitmix": SplitMixBackend,
+            "philox": PhiloxBackend}
+
+
+def create_backend(name, seed=None, stream=None):
+    '''
+    Returns a new backend by name. Raises ValueError for unknown names.
+    '''
+
+    if name not in BACKENDS:
+        raise ValueError("Unknown random backend " + str(name))
+
+    return BACKENDS[name](seed, stream)
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+import heapq
+import mmap
+import os
+import queue
+import re
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from operator import itemgetter
+
+'''
+An append-only journal of every roll, so old rolls can be looked up and checked.
+
+Rolls are written to segment files in a directory as binary records:
+ - A name record defines a string once per segment: the user, channel, roll
+   expression or random backend name. Roll records refer to names by id.
+ - A roll record is a fixed-width header (timestamp, user, channel, expression,
+   random backend, seed, stream, request number, total and number of dice)
+   followed by the faces packed as unsigned 16 bit ints.
+The seed, stream and request number are the "rng" record of the roll, so a roll
+from the journal can be replayed to check it.
+
+RollJournal.append() only puts the roll on a queue. A background thread packs
+and writes them, so a request never waits on the disk. When the queue is full
+rolls are dropped and counted rather than blocking.
+
+Every writer writes its own segments, named journal_<pid>_<token>_<number>.log,
+and starts a new segment once the current one reaches segment_bytes. The token
+is made from the time and random bytes when the writer starts, so a restarted
+process that is given an old pid never appends to an old segment, whose name
+ids would no longer match.
+
+JournalReader memory-maps the segments and keeps an in-memory index of the
+latest records by user and channel, and running totals for each user. It only
+reads the bytes added since it last looked, so queries stay cheap as the
+journal grows. Only the latest max_entries rolls of each user and channel are
+indexed and at most max_mapped segments are mapped at once.
+'''
+
+NAME_RECORD = 1
+ROLL_RECORD = 2
+
+# kind, name id, length of the utf-8 name that follows
+NAME_STRUCT = struct.Struct("<BIH")
+
+# kind, timestamp, user, channel, expression, backend, seed, stream, request, total, number of dice
+ROLL_STRUCT = struct.Struct("<BdIIIIQQQqI")
+
+# Faces are packed with this array type code, 2 bytes each
+FACE_TYPE = "H"
+FACE_SIZE = array(FACE_TYPE).itemsize
+
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+
+# How many rolls can wait for the writer before new ones are dropped
+DEFAULT_QUEUE_SIZE = 10000
+
+# How often the writer flushes to disk, in seconds
+FLUSH_INTERVAL = 1.0
+
+# How many of the latest rolls of each user, channel and user in a channel a reader indexes
+MAX_INDEXED_ROLLS = 1000
+
+# How many segments a reader keeps memory-mapped
+MAX_MAPPED_SEGMENTS = 16
+
+# Older journals were written without the token
+SEGMENT_RE = re.compile(r"^journal_(\d+)_(?:([0-9a-f]+)_)?(\d+)\.log$")
+
+
+class RollJournal(object):
+    '''
+    Writes rolls to the journal directory from a background thread.
+
+    append() takes the parts of one roll and never blocks. flush() waits until
+    every roll appended so far is on disk. dropped counts the rolls append()
+    dropped because the queue was full.
+    '''
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES, queue_size=DEFAULT_QUEUE_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.pid = None
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def start(self):
+        '''
+        Starts the writer thread for this process. A forked worker gets its own.
+        '''
+
+        self.pid = os.getpid()
+        self.token = "%x" % time.time_ns() + os.urandom(4).hex()
+        self.queue = queue.Queue(self.queue_size)
+        self.segment = None
+        self.segment_number = 0
+        self.names = {}
+        self.thread = threading.Thread(target=self.run, name="roll-journal")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, user, channel, expression, total, faces, record=None, timestamp=None):
+        '''
+        Queues one roll. faces is a flat list or array of every die rolled and record is the
+        roll's "rng" record, or None if it can't be replayed.
+
+        Returns False if the roll was dropped because the queue is full.
+        '''
+
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.start()
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        try:
+            self.queue.put_nowait((timestamp, user, channel, expression, total, faces, record))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+        return True
+
+    def flush(self):
+        if self.pid == os.getpid():
+            self.queue.join()
+
+    def run(self):
+        pending = 0
+        while True:
+            try:
+                roll = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                roll = None
+
+            if roll is not None:
+                try:
+                    self.write(roll)
+                except (OSError, ValueError, struct.error) as error:
+                    print("Unable to write roll to journal: " + str(error))
+                pending += 1
+
+            # Flush once the queue runs dry, so flush() callers see everything on disk
+            if pending and (roll is None or self.queue.empty()):
+                try:
+                    self.segment.flush()
+                except (OSError, AttributeError) as error:
+                    print("Unable to flush roll journal: " + str(error))
+                for count in range(pending):
+                    self.queue.task_done()
+                pending = 0
+
+    def open_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+
+        # Never append to a segment someone else wrote, its names would be redefined
+        while True:
+            self.segment_number += 1
+            path = os.path.join(self.directory, "journal_" + str(self.pid) + "_" + self.token + "_" +
+                                "%06d" % self.segment_number + ".log")
+            try:
+                self.segment = open(path, "xb")
+                break
+            except FileExistsError:
+                pass
+        # Names are defined again in every segment so each one can be read on its own
+        self.names = {}
+
+    def name_id(self, name):
+        name = "" if name is None else str(name)
+        name_id = self.names.get(name)
+        if name_id is None:
+            encoded = name.encode("utf-8")[:0xFFFF]
+            name_id = self.names[name] = len(self.names) + 1
+            self.segment.write(NAME_STRUCT.pack(NAME_RECORD, name_id, len(encoded)) + encoded)
+        return name_id
+
+    def write(self, roll):
+        timestamp, user, channel, expression, total, faces, record = roll
+
+        if self.segment is None or self.segment.tell() >= self.segment_bytes:
+            self.open_segment()
+
+        user_id = self.name_id(user)
+        channel_id = self.name_id(channel)
+        expression_id = self.name_id(expression)
+        if record is None:
+            backend_id, seed, stream, request = self.name_id(""), 0, 0, 0
+        else:
+            backend_id = self.name_id(record["backend"])
+            seed, stream, request = record["seed"], record["stream"], record["request"]
+
+        self.segment.write(ROLL_STRUCT.pack(ROLL_RECORD, timestamp, user_id, channel_id, expression_id, backend_id,
+                                            seed, stream, request, total, len(faces)))
+        self.segment.write(array(FACE_TYPE, faces).tobytes())
+
+
+class Segment(object):
+    '''
+    What a JournalReader knows about one segment file: how far it has been read,
+    the names defined in it and its current memory map.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.names = {}
+        self.data = None
+
+    def size(self):
+        return os.stat(self.path).st_size
+
+    def map(self):
+        '''
+        Maps the whole file, again if it has grown. Returns the size mapped.
+        '''
+
+        with open(self.path, "rb") as segment_file:
+            size = os.fstat(segment_file.fileno()).st_size
+            if size == 0:
+                return 0
+            if self.data is None or len(self.data) < size:
+                if self.data is not None:
+                    self.data.close()
+                self.data = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return len(self.data)
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+
+class JournalReader(object):
+    '''
+    Reads rolls back out of a journal directory.
+
+    Rolls are indexed by user, by channel and by both as (timestamp, segment, offset)
+    tuples, the latest max_entries of each. Call refresh() to index rolls written
+    since, the queries do it for you.
+    '''
+
+    def __init__(self, directory, max_entries=MAX_INDEXED_ROLLS, max_mapped=MAX_MAPPED_SEGMENTS):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_mapped = max_mapped
+        self.segments = {}
+        self.mapped = OrderedDict()
+        self.by_user = {}
+        self.by_channel = {}
+        self.by_user_channel = {}
+        # user -> [rolls, dice, sum of totals, highest, lowest], over every roll
+        self.totals = {}
+        # Held while reading too, refresh() may replace a segment's memory map
+        self.lock = threading.RLock()
+
+    def segment_paths(self):
+        found = []
+        for file_name in os.listdir(self.directory):
+            match = SEGMENT_RE.match(file_name)
+            if match is not None:
+                found.append((int(match.group(1)), match.group(2) or "", int(match.group(3)),
+                              os.path.join(self.directory, file_name)))
+        return [path for pid, token, number, path in sorted(found)]
+
+    def refresh(self):
+        with self.lock:
+            for path in self.segment_paths():
+                segment = self.segments.get(path)
+                if segment is None:
+                    segment = self.segments[path] = Segment(path)
+                self.scan(segment)
+
+    def open_map(self, segment):
+        '''
+        Maps a segment, closing the least recently used maps past max_mapped.
+        Returns the size mapped. Must be called holding the lock.
+        '''
+
+        size = segment.map()
+        self.mapped.pop(segment.path, None)
+        self.mapped[segment.path] = segment
+        while len(self.mapped) > self.max_mapped:
+            self.mapped.popitem(last=False)[1].close()
+        return size
+
+    def add_entry(self, index, key, entry):
+        '''
+        Adds an entry to an index, keeping the latest max_entries by timestamp.
+        '''
+
+        entries = index.get(key)
+        if entries is None:
+            entries = index[key] = []
+        entries.append(entry)
+        if len(entries) > 2 * self.max_entries:
+            entries.sort(key=itemgetter(0))
+            del entries[:-self.max_entries]
+
+    def scan(self, segment):
+        '''
+        Indexes the complete records added to a segment since it was last scanned.
+        A record the writer is half way through is left for the next scan.
+        '''
+
+        # A segment that hasn't grown isn't mapped again
+        if segment.size() <= segment.offset:
+            return
+
+        size = self.open_map(segment)
+        data = segment.data
+        offset = segment.offset
+
+        while offset < size:
+            kind = data[offset]
+            if kind == NAME_RECORD:
+                if offset + NAME_STRUCT.size > size:
+                    break
+                kind, name_id, length = NAME_STRUCT.unpack_from(data, offset)
+                end = offset + NAME_STRUCT.size + length
+                if end > size:
+                    break
+                segment.names[name_id] = data[offset + NAME_STRUCT.size:end].decode("utf-8", "replace")
+            elif kind == ROLL_RECORD:
+                if offset + ROLL_STRUCT.size > size:
+                    break
+                header = ROLL_STRUCT.unpack_from(data, offset)
+                end = offset + ROLL_STRUCT.size + header[10] * FACE_SIZE
+                if end > size:
+                    break
+                if any(name_id not in segment.names for name_id in header[2:6]):
+                    # Its names were never written, so read() could not show it
+                    print("Roll journal record with an unknown name in " + segment.path + " at " + str(offset))
+                    offset = end
+                    continue
+                entry = (header[1], segment, offset)
+                user = segment.names[header[2]]
+                channel = segment.names[header[3]]
+                self.add_entry(self.by_user, user, entry)
+                self.add_entry(self.by_channel, channel, entry)
+                self.add_entry(self.by_user_channel, (user, channel), entry)
+
+                total = header[9]
+                totals = self.totals.get(user)
+                if totals is None:
+                    self.totals[user] = [1, header[10], total, total, total]
+                else:
+                    totals[0] += 1
+                    totals[1] += header[10]
+                    totals[2] += total
+                    totals[3] = max(totals[3], total)
+                    totals[4] = min(totals[4], total)
+            else:
+                print("Corrupt roll journal record in " + segment.path + " at " + str(offset))
+                offset = size
+                break
+            offset = end
+
+        segment.offset = offset
+
+    def read(self, entry):
+        '''
+        Returns the roll for an index entry as a dict of
+        {"timestamp": <float>, "user": <str>, "channel": <str>, "expression": <str>,
+         "total": <int>, "faces": [<int>], "rng": <record or None>}
+        '''
+
+        timestamp, segment, offset = entry
+        self.open_map(segment)
+        (kind, timestamp, user_id, channel_id, expression_id, backend_id,
+         seed, stream, request, total, count) = ROLL_STRUCT.unpack_from(segment.data, offset)
+        start = offset + ROLL_STRUCT.size
+        faces = array(FACE_TYPE)
+        faces.frombytes(segment.data[start:start + count * FACE_SIZE])
+
+        names = segment.names
+        backend = names[backend_id]
+        record = {"backend": backend, "seed": seed, "stream": stream, "request": request} if backend else None
+        return {"timestamp": timestamp,
+                "user": names[user_id],
+                "channel": names[channel_id],
+                "expression": names[expression_id],
+                "total": total,
+                "faces": faces.tolist(),
+                "rng": record}
+
+    def entries(self, user=None, channel=None):
+        self.refresh()
+
+        if user is not None and channel is not None:
+            return self.by_user_channel.get((user, channel), [])
+        if user is not None:
+            return self.by_user.get(user, [])
+        if channel is not None:
+            return self.by_channel.get(channel, [])
+        raise ValueError("A user or a channel is needed")
+
+    def history(self, user=None, channel=None, limit=10):
+        '''
+        Returns up to limit of the latest rolls by a user, in a channel, or by a
+        user in a channel, newest first. Rolls written by different processes are
+        ordered by their timestamps.
+        '''
+
+        with self.lock:
+            entries = self.entries(user, channel)
+            latest = heapq.nlargest(limit, range(len(entries)),
+                                   key=lambda position: (entries[position][0], position))
+            return [self.read(entries[position]) for position in latest]
+
+    def user_stats(self, user):
+        '''
+        Returns a dict of {"rolls": <int>, "dice": <int>, "average": <float or None>,
+        "highest": <int or None>, "lowest": <int or None>} over every roll by user.
+        These are kept as rolls are indexed, nothing is read.
+        '''
+
+        with self.lock:
+            self.refresh()
+            totals = self.totals.get(user)
+
+        if totals is None:
+            return {"rolls": 0, "dice": 0, "average": None, "highest": None, "lowest": None}
+
+        rolls, dice, total, highest, lowest = totals
+        return {"rolls": rolls,
+                "dice": dice,
+                "average": total / rolls,
+                "highest": highest,
+                "lowest": lowest}
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.mapped.clear()
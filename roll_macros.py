@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import os
+import sqlite3
+import threading
+import time
+
+'''
+Saved rolls by name for each user, like "attack" for 1d20+7, kept in SQLite.
+
+MacroStore keeps a write-through cache of every macro it has looked up, with
+the roll already compiled, so looking a macro up is a dict hit rather than a
+query and a parse. Saving or removing a macro writes to the database and
+updates the cache at once.
+
+Other processes, like the other workers of a preforked server, may change the
+same database. Every check_interval seconds a lookup asks SQLite if anyone else
+has committed since (PRAGMA data_version) and, if so, the cache is dropped.
+
+The path ":memory:" keeps the macros only as long as the process runs, and each
+forked worker starts with none.
+'''
+
+SCHEMA = ("CREATE TABLE IF NOT EXISTS macros ("
+          "user TEXT NOT NULL, "
+          "name TEXT NOT NULL, "
+          "expression TEXT NOT NULL, "
+          "PRIMARY KEY (user, name))")
+
+# Saved macros a user can have
+MAX_MACROS = 50
+
+# How often a lookup checks for changes made by other processes, in seconds
+CHECK_INTERVAL = 1.0
+
+# The cache is dropped rather than growing past this many users
+MAX_CACHED_USERS = 10000
+
+# How long to wait for another process writing to the database, in seconds
+BUSY_TIMEOUT = 5.0
+
+
+class MacroStore(object):
+    '''
+    Named rolls per user in a SQLite database at path.
+
+    compile turns the text of a macro into what get() returns, like a compiled
+    roll. It is called when a macro is saved, so a bad roll is never stored, and
+    when macros are loaded into the cache. Anything it raises is passed on.
+    '''
+
+    def __init__(self, path=":memory:", compile=None, max_macros=MAX_MACROS, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.compile = compile or (lambda expression: expression)
+        self.max_macros = max_macros
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.connection = None
+        self.users = {}
+        self.version = None
+        self.checked = 0
+
+    def connect(self):
+        '''
+        Opens the database for this process. A forked worker opens its own.
+        Must be called holding the lock.
+        '''
+
+        self.pid = os.getpid()
+        self.connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        if self.path != ":memory:":
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+        self.users = {}
+        self.version = self.data_version()
+        self.checked = time.monotonic()
+
+    def data_version(self):
+        return self.connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def check(self):
+        '''
+        Connects if needed and drops the cache if another process changed the
+        database. Must be called holding the lock.
+        '''
+
+        if self.pid != os.getpid():
+            self.connect()
+            return
+
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+
+        version = self.data_version()
+        if version != self.version:
+            self.version = version
+            self.users = {}
+
+    def load(self, user):
+        '''
+        Returns the cached {name: (expression, compiled)} of user, reading them
+        from the database the first time. Must be called holding the lock.
+        '''
+
+        macros = self.users.get(user)
+        if macros is not None:
+            return macros
+
+        macros = {}
+        for name, expression in self.connection.execute("SELECT name, expression FROM macros WHERE user = ?",
+                                                        (user,)):
+            try:
+                macros[name] = (expression, self.compile(expression))
+            except Exception as error:
+                print("Unable to load macro " + name + " of " + user + ": " + str(error))
+
+        if len(self.users) >= MAX_CACHED_USERS:
+            self.users = {}
+        self.users[user] = macros
+        return macros
+
+    def get(self, user, name):
+        '''
+        Returns the compiled macro, or None if user has no macro called name.
+        '''
+
+        with self.lock:
+            self.check()
+            entry = self.load(user).get(name)
+        return None if entry is None else entry[1]
+
+    def expression(self, user, name):
+        '''
+        Returns the text of a macro, or None if user has no macro called name.
+        '''
+
+        with self.lock:
+            self.check()
+            entry = self.load(user).get(name)
+        return None if entry is None else entry[0]
+
+    def set(self, user, name, expression):
+        '''
+        Saves a macro, replacing any with the same name, and returns it compiled.
+        Raises ValueError if user already has max_macros others.
+        '''
+
+        compiled = self.compile(expression)
+
+        with self.lock:
+            self.check()
+            macros = self.load(user)
+            if name not in macros and len(macros) >= self.max_macros:
+                raise ValueError("Can not save more than " + str(self.max_macros) + " macros")
+
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO macros (user, name, expression) VALUES (?, ?, ?)",
+                                        (user, name, expression))
+            macros[name] = (expression, compiled)
+
+        return compiled
+
+    def delete(self, user, name):
+        '''
+        Removes a macro. Returns False if user had no macro called name.
+        '''
+
+        with self.lock:
+            self.check()
+            macros = self.load(user)
+            with self.connection:
+                removed = self.connection.execute("DELETE FROM macros WHERE user = ? AND name = ?",
+                                                  (user, name)).rowcount
+            macros.pop(name, None)
+
+        return removed > 0
+
+    def list(self, user):
+        '''
+        Returns a list of (name, expression) of every macro of user, by name.
+        '''
+
+        with self.lock:
+            self.check()
+            return sorted((name, entry[0]) for name, entry in self.load(user).items())
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None and self.pid == os.getpid():
+                self.connection.close()
+            self.connection = None
+            self.pid = None
+            self.users = {}
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+import atexit
+import fcntl
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter
+
+'''
+Running statistics of every roll, by channel and user, for /stats.
+
+Each user in each channel has an Aggregate: per die size the number of dice,
+their sum, their sum of squares and how often each face came up, plus d20
+streaks. Adding a roll only touches that user's Aggregate, so nothing is ever
+recomputed from the roll history.
+
+Luck is how far a user's dice are above or below what the dice should give on
+average, in standard deviations. It is worked out from the sums and the die
+sizes, so it compares a pile of d6s fairly against a few d20s.
+
+A session is a run of rolls in a channel without a gap of SESSION_GAP seconds.
+Every user also has an Aggregate for the channel's current session.
+
+Every Aggregate can be merged with another, so the statistics can be saved and
+restored, and several worker processes can share one snapshot file. Each process
+collects the rolls it has seen since it last saved. save() locks the file, adds
+those rolls to the totals in it and writes it back. /stats shows the saved totals
+plus this process's rolls not saved yet.
+'''
+
+# Rolls more than this many seconds apart are in different sessions
+SESSION_GAP = 3 * 60 * 60
+
+# How often the statistics are saved, in seconds
+SAVE_INTERVAL = 30
+
+# Users need to roll this many dice, of any size, in a session to be the luckiest player
+MIN_LUCK_DICE = 5
+
+# A d20 at or above this is a good roll for streaks
+STREAK_HIGH = 11
+
+
+class DieStats(object):
+    '''
+    Count, sum, sum of squares and face counts of every die of one size.
+    '''
+
+    __slots__ = ("count", "total", "squares", "faces")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.squares = 0
+        self.faces = Counter()
+
+    def add(self, faces):
+        self.count += len(faces)
+        self.total += sum(faces)
+        self.squares += sum(face * face for face in faces)
+        self.faces.update(faces)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.squares += other.squares
+        self.faces.update(other.faces)
+
+    def to_json(self):
+        return [self.count, self.total, self.squares, dict((str(face), count) for face, count in self.faces.items())]
+
+    @classmethod
+    def from_json(cls, value):
+        stats = cls()
+        stats.count, stats.total, stats.squares, faces = value
+        stats.faces = Counter(dict((int(face), count) for face, count in faces.items()))
+        return stats
+
+
+class Aggregate(object):
+    '''
+    Every statistic kept for one user in one channel.
+
+    d20 streaks are kept so two Aggregates can be joined end to end: the run of
+    good or bad d20s the rolls start with, the run they end with and the longest
+    good and bad runs anywhere. A run is "high" (STREAK_HIGH or more) or "low".
+    '''
+
+    __slots__ = ("dies", "first", "last", "d20s", "prefix_kind", "prefix", "suffix_kind", "suffix",
+                 "best_high", "best_low")
+
+    def __init__(self):
+        self.dies = {}
+        self.first = None
+        self.last = None
+        self.d20s = 0
+        self.prefix_kind = None
+        self.prefix = 0
+        self.suffix_kind = None
+        self.suffix = 0
+        self.best_high = 0
+        self.best_low = 0
+
+    def add(self, groups, timestamp):
+        '''
+        Adds one roll. groups is a list of (die, faces) pairs.
+        '''
+
+        for die, faces in groups:
+            stats = self.dies.get(die)
+            if stats is None:
+                stats = self.dies[die] = DieStats()
+            stats.add(faces)
+            if die == 20:
+                for face in faces:
+                    self.add_d20(face)
+
+        if self.first is None:
+            self.first = timestamp
+        self.last = timestamp
+
+    def add_d20(self, face):
+        kind = "high" if face >= STREAK_HIGH else "low"
+
+        if self.d20s == 0:
+            self.prefix_kind = kind
+        if self.prefix == self.d20s and kind == self.prefix_kind:
+            self.prefix += 1
+
+        if kind == self.suffix_kind:
+            self.suffix += 1
+        else:
+            self.suffix_kind = kind
+            self.suffix = 1
+
+        self.d20s += 1
+        self.note_run(kind, self.suffix)
+
+    def note_run(self, kind, length):
+        if kind == "high":
+            self.best_high = max(self.best_high, length)
+        elif kind == "low":
+            self.best_low = max(self.best_low, length)
+
+    def merge(self, other):
+        '''
+        Adds the rolls of other, which came after the rolls of this Aggregate.
+        '''
+
+        for die, stats in other.dies.items():
+            if die in self.dies:
+                self.dies[die].merge(stats)
+            else:
+                self.dies[die] = DieStats.from_json(stats.to_json())
+
+        if other.d20s:
+            if self.d20s == 0:
+                self.prefix_kind, self.prefix = other.prefix_kind, other.prefix
+                self.suffix_kind, self.suffix = other.suffix_kind, other.suffix
+            else:
+                # A run can carry on across the join
+                joined = self.suffix + other.prefix if self.suffix_kind == other.prefix_kind else 0
+                if self.prefix == self.d20s and self.prefix_kind == other.prefix_kind:
+                    self.prefix += other.prefix
+                if other.suffix == other.d20s and other.suffix_kind == self.suffix_kind:
+                    self.suffix += other.suffix
+                else:
+                    self.suffix_kind, self.suffix = other.suffix_kind, other.suffix
+                self.note_run(other.prefix_kind, joined)
+            self.d20s += other.d20s
+
+        self.best_high = max(self.best_high, other.best_high)
+        self.best_low = max(self.best_low, other.best_low)
+
+        if other.first is not None and (self.first is None or other.first < self.first):
+            self.first = other.first
+        if other.last is not None and (self.last is None or other.last > self.last):
+            self.last = other.last
+
+    def copy(self):
+        aggregate = Aggregate()
+        aggregate.merge(self)
+        return aggregate
+
+    def luck(self):
+        '''
+        Returns how many standard deviations the sum of every die is above its
+        expected sum, or None before any dice are rolled.
+        '''
+
+        difference = 0.0
+        variance = 0.0
+        for die, stats in self.dies.items():
+            difference += stats.total - stats.count * (die + 1) / 2.0
+            variance += stats.count * (die * die - 1) / 12.0
+
+        if variance == 0:
+            return None
+        return difference / math.sqrt(variance)
+
+    def to_json(self):
+        return {"dies": dict((str(die), stats.to_json()) for die, stats in self.dies.items()),
+                "first": self.first,
+                "last": self.last,
+                "streaks": [self.d20s, self.prefix_kind, self.prefix, self.suffix_kind, self.suffix,
+                            self.best_high, self.best_low]}
+
+    @classmethod
+    def from_json(cls, value):
+        aggregate = cls()
+        aggregate.dies = dict((int(die), DieStats.from_json(stats)) for die, stats in value["dies"].items())
+        aggregate.first = value["first"]
+        aggregate.last = value["last"]
+        (aggregate.d20s, aggregate.prefix_kind, aggregate.prefix, aggregate.suffix_kind, aggregate.suffix,
+         aggregate.best_high, aggregate.best_low) = value["streaks"]
+        return aggregate
+
+
+class Statistics(object):
+    '''
+    All time and current session Aggregates by channel and user.
+
+    totals and sessions map channel -> user -> Aggregate. session_starts and
+    last_rolls map channel -> when its current session started and when it last rolled.
+    '''
+
+    def __init__(self):
+        self.totals = {}
+        self.sessions = {}
+        self.session_starts = {}
+        self.last_rolls = {}
+
+    def add(self, channel, user, groups, timestamp, last_roll=None):
+        '''
+        Adds one roll. last_roll is when the channel last rolled, if this
+        Statistics doesn't hold every roll.
+        '''
+
+        if last_roll is None:
+            last_roll = self.last_rolls.get(channel)
+        if last_roll is None or timestamp - last_roll > SESSION_GAP:
+            self.sessions[channel] = {}
+            self.session_starts[channel] = timestamp
+
+        for table in (self.totals, self.sessions):
+            users = table.setdefault(channel, {})
+            aggregate = users.get(user)
+            if aggregate is None:
+                aggregate = users[user] = Aggregate()
+            aggregate.add(groups, timestamp)
+        self.last_rolls[channel] = max(timestamp, self.last_rolls.get(channel, timestamp))
+
+    def merge(self, other):
+        '''
+        Adds every roll of other, which came after the rolls of this Statistics.
+        '''
+
+        for channel, users in other.totals.items():
+            mine = self.totals.setdefault(channel, {})
+            for user, aggregate in users.items():
+                if user in mine:
+                    mine[user].merge(aggregate)
+                else:
+                    mine[user] = Aggregate.from_json(aggregate.to_json())
+
+        for channel, last_roll in other.last_rolls.items():
+            self.last_rolls[channel] = max(last_roll, self.last_rolls.get(channel, last_roll))
+
+        for channel, start in other.session_starts.items():
+            my_start = self.session_starts.get(channel)
+            if my_start is not None and abs(start - my_start) <= SESSION_GAP:
+                # Both saw the same session, keep the earliest start
+                start = min(start, my_start)
+                sessions = self.sessions.setdefault(channel, {})
+            elif my_start is not None and my_start > start:
+                # other only has rolls from an older session
+                continue
+            else:
+                sessions = self.sessions[channel] = {}
+
+            self.session_starts[channel] = start
+            for user, aggregate in other.sessions.get(channel, {}).items():
+                if user in sessions:
+                    sessions[user].merge(aggregate)
+                else:
+                    sessions[user] = Aggregate.from_json(aggregate.to_json())
+
+    def to_json(self):
+        def table_json(table):
+            return dict((channel, dict((user, aggregate.to_json()) for user, aggregate in users.items()))
+                        for channel, users in table.items())
+
+        return {"totals": table_json(self.totals),
+                "sessions": table_json(self.sessions),
+                "session_starts": self.session_starts,
+                "last_rolls": self.last_rolls}
+
+    @classmethod
+    def from_json(cls, value):
+        def table_from_json(table):
+            return dict((channel, dict((user, Aggregate.from_json(aggregate)) for user, aggregate in users.items()))
+                        for channel, users in table.items())
+
+        statistics = cls()
+        statistics.totals = table_from_json(value["totals"])
+        statistics.sessions = table_from_json(value["sessions"])
+        statistics.session_starts = dict(value["session_starts"])
+        statistics.last_rolls = dict(value["last_rolls"])
+        return statistics
+
+    def copy(self, channel=None):
+        '''
+        Returns a copy of every channel, or of only channel.
+        '''
+
+        if channel is None:
+            return Statistics.from_json(self.to_json())
+
+        statistics = Statistics()
+        for table, copied in ((self.totals, statistics.totals), (self.sessions, statistics.sessions)):
+            if channel in table:
+                copied[channel] = dict((user, aggregate.copy()) for user, aggregate in table[channel].items())
+        for times, copied in ((self.session_starts, statistics.session_starts),
+                              (self.last_rolls, statistics.last_rolls)):
+            if channel in times:
+                copied[channel] = times[channel]
+        return statistics
+
+
+class RollStats(object):
+    '''
+    The statistics of this process, optionally saved to and shared through a snapshot file.
+
+    base holds the totals from the file when this process last saved or loaded,
+    and pending the rolls this process has seen since. While save() writes the
+    file, the rolls it is adding are kept in saving, so current() still counts
+    them. base and saving are replaced, never changed, so they can be copied
+    without the lock.
+    '''
+
+    def __init__(self, path=None, save_interval=SAVE_INTERVAL):
+        self.path = path
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.base = Statistics()
+        self.pending = Statistics()
+        self.saving = None
+        self.pid = None
+
+        if path is not None:
+            self.restore()
+
+    def record(self, channel, user, groups, timestamp=None):
+        '''
+        Adds one roll. groups is a list of (die, faces) pairs, one for each kind of
+        die in the roll.
+        '''
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.lock:
+            saving = self.saving.last_rolls.get(channel) if self.saving is not None else None
+            lasts = [last for last in (self.pending.last_rolls.get(channel), saving, self.base.last_rolls.get(channel))
+                     if last is not None]
+            self.pending.add(channel, user, groups, timestamp, max(lasts) if lasts else None)
+
+        self.check_saver()
+
+    def current(self, channel=None):
+        '''
+        Returns a Statistics of every roll: the saved totals and the rolls since.
+        With channel only that channel is copied. record() only waits while the
+        unsaved rolls are copied.
+        '''
+
+        with self.lock:
+            base = self.base
+            saving = self.saving
+            pending = self.pending.copy(channel)
+
+        statistics = base.copy(channel)
+        if saving is not None:
+            statistics.merge(saving.copy(channel))
+        statistics.merge(pending)
+        return statistics
+
+    def check_saver(self):
+        if self.path is None or self.pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is None:
+                # Save what is left on the way out
+                atexit.register(self.save)
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self.run_saver, name="roll-stats-save")
+            thread.daemon = True
+            thread.start()
+
+    def run_saver(self):
+        pid = os.getpid()
+        while self.pid == pid:
+            time.sleep(self.save_interval)
+            self.save()
+
+    def close(self):
+        '''
+        Saves and stops saving in the background. Recording another roll starts again.
+        '''
+
+        if self.pid is not None:
+            atexit.unregister(self.save)
+            self.pid = None
+        self.save()
+
+    def restore(self):
+        '''
+        Loads the totals from the snapshot file, if there is one.
+        '''
+
+        try:
+            with open(self.path) as stats_file:
+                statistics = Statistics.from_json(json.load(stats_file))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            print("Unable to read roll statistics from " + self.path + ": " + str(error))
+            return
+
+        with self.lock:
+            self.base = statistics
+
+    def save(self):
+        '''
+        Adds the rolls since the last save to the snapshot file. The file is
+        locked while it is read and written, so workers never lose each other's
+        rolls, and replaced in one rename so readers never see half of it.
+        '''
+
+        if self.path is None:
+            return
+
+        # One save at a time, so there is only ever one set of rolls being saved
+        with self.save_lock:
+            self.save_pending()
+
+    def save_pending(self):
+        with self.lock:
+            pending = self.saving = self.pending
+            self.pending = Statistics()
+
+        try:
+            with open(self.path + ".lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    with open(self.path) as stats_file:
+                        statistics = Statistics.from_json(json.load(stats_file))
+                except FileNotFoundError:
+                    statistics = Statistics()
+
+                statistics.merge(pending)
+                with open(self.path + ".tmp", "w") as stats_file:
+                    json.dump(statistics.to_json(), stats_file)
+                os.replace(self.path + ".tmp", self.path)
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            print("Unable to save roll statistics to " + self.path + ": " + str(error))
+            # Keep the rolls for the next try
+            with self.lock:
+                pending = pending.copy()
+                pending.merge(self.pending)
+                self.pending = pending
+                self.saving = None
+            return
+
+        with self.lock:
+            self.base = statistics
+            self.saving = None
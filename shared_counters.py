@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+import bisect
+import json
+import multiprocessing
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+import metrics
+
+'''
+Counters shared by every worker process through one shared memory region.
+
+The region is made by the parent before it forks the workers, so they all map
+the same pages. It holds:
+ - a header with the number of slots handed out,
+ - a directory with the key of each slot, as padded utf-8,
+ - the values, one 8 byte slot each. A slot holds an int64 or a float64.
+
+Each process remembers the slots it has looked up. A new key takes the
+directory lock once to find or hand out its slot, after that an update only
+takes the lock of its stripe, so workers counting different things rarely wait
+on each other.
+
+SharedRegistry is a metrics.Registry that counts in a SharedCounters, so a
+scrape of any worker sees the totals of all of them without a metrics directory.
+'''
+
+# Slots in a region
+DEFAULT_CAPACITY = 4096
+
+# Bytes kept for each key in the directory
+KEY_BYTES = 160
+
+# Updates are spread over this many locks by slot
+DEFAULT_STRIPES = 16
+
+HEADER = struct.Struct("<q")
+
+# The directory entry of the extra slots of a wide key, like a histogram
+CONTINUATION = b"\x01"
+
+
+class SharedCounters(object):
+    '''
+    Named int and float slots in a shared memory region.
+
+    Make one before forking, or attach to an existing region by name with
+    create=False. slot() returns a slot number for a key, or None once the region
+    is full. Locks can't be passed by name, so only processes forked from the one
+    that made the SharedCounters can update it safely at the same time.
+    '''
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, stripes=DEFAULT_STRIPES, name=None, create=True):
+        size = HEADER.size + capacity * (KEY_BYTES + 8)
+        self.memory = shared_memory.SharedMemory(name=name, create=create, size=size if create else 0)
+        # The region outlives a graceful reload, so it is unlinked by hand, see unlink()
+        resource_tracker.unregister(self.memory._name, "shared_memory")
+
+        self.capacity = (self.memory.size - HEADER.size) // (KEY_BYTES + 8)
+        self.buffer = self.memory.buf
+        values_start = HEADER.size + self.capacity * KEY_BYTES
+        self.ints = self.buffer[values_start:values_start + self.capacity * 8].cast("q")
+        self.floats = self.buffer[values_start:values_start + self.capacity * 8].cast("d")
+
+        self.directory_lock = multiprocessing.Lock()
+        self.locks = [multiprocessing.Lock() for stripe in range(stripes)]
+        self.slots = {}
+        self.scanned = 0
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def used(self):
+        return HEADER.unpack_from(self.buffer, 0)[0]
+
+    def key_at(self, slot):
+        start = HEADER.size + slot * KEY_BYTES
+        return bytes(self.buffer[start:start + KEY_BYTES]).rstrip(b"\x00")
+
+    def scan(self):
+        '''
+        Learns the slots other processes handed out since the last scan.
+        Must be called holding the directory lock.
+        '''
+
+        used = self.used()
+        for slot in range(self.scanned, used):
+            key = self.key_at(slot)
+            if key != CONTINUATION:
+                self.slots[key.decode("utf-8")] = slot
+        self.scanned = used
+
+    def slot(self, key, width=1):
+        '''
+        Returns the first of width slots for key, handing them out the first time
+        any process asks. Returns None if the key is too long or the region is full.
+        '''
+
+        slot = self.slots.get(key)
+        if slot is not None:
+            return slot
+
+        encoded = key.encode("utf-8")
+        if len(encoded) > KEY_BYTES or encoded == CONTINUATION:
+            return None
+
+        with self.directory_lock:
+            self.scan()
+            slot = self.slots.get(key)
+            if slot is not None:
+                return slot
+
+            used = self.used()
+            if used + width > self.capacity:
+                return None
+            for offset in range(width):
+                start = HEADER.size + (used + offset) * KEY_BYTES
+                entry = encoded if offset == 0 else CONTINUATION
+                self.buffer[start:start + len(entry)] = entry
+            HEADER.pack_into(self.buffer, 0, used + width)
+            self.scanned = used + width
+            self.slots[key] = used
+            return used
+
+    def lock(self, slot):
+        return self.locks[slot % len(self.locks)]
+
+    def add(self, slot, amount=1):
+        with self.lock(slot):
+            self.ints[slot] += amount
+
+    def items(self):
+        '''
+        Returns a list of (key, slot) for every key handed out by any process.
+        '''
+
+        with self.directory_lock:
+            self.scan()
+            return list(self.slots.items())
+
+    def close(self):
+        self.ints.release()
+        self.floats.release()
+        self.buffer = None
+        self.memory.close()
+
+    def unlink(self):
+        # unlink() tells the resource tracker too, which expects to know the region
+        resource_tracker.register(self.memory._name, "shared_memory")
+        self.memory.unlink()
+
+
+class SharedRegistry(metrics.Registry):
+    '''
+    A metrics.Registry whose counters and histograms live in a SharedCounters.
+
+    Metrics that don't fit in the region are counted in this process, like a
+    plain Registry.
+    '''
+
+    def __init__(self, counters, buckets=metrics.DEFAULT_BUCKETS):
+        metrics.Registry.__init__(self, buckets=buckets)
+        self.shared = counters
+        self.keys = {}
+
+    def shared_slot(self, kind, name, labels):
+        '''
+        Returns the slot of a counter ("c") or histogram ("h"), or None if it is full.
+        '''
+
+        key = (kind, name, labels)
+        slot = self.keys.get(key)
+        if slot is None:
+            width = 1 if kind == "c" else len(self.buckets) + 2
+            slot = self.shared.slot(json.dumps([kind, name, [list(label) for label in labels]]), width)
+            if slot is not None:
+                self.keys[key] = slot
+        return slot
+
+    def inc(self, name, labels=(), amount=1):
+        slot = self.shared_slot("c", name, labels)
+        if slot is None:
+            metrics.Registry.inc(self, name, labels, amount)
+        else:
+            self.shared.add(slot, amount)
+
+    def observe(self, name, value, labels=()):
+        slot = self.shared_slot("h", name, labels)
+        if slot is None:
+            metrics.Registry.observe(self, name, value, labels)
+            return
+
+        position = bisect.bisect_left(self.buckets, value)
+        # One count per bucket, then +Inf, then the running sum as a float
+        total = slot + len(self.buckets) + 1
+        with self.shared.lock(slot):
+            self.shared.ints[slot + position] += 1
+            self.shared.floats[total] += value
+
+    def snapshot(self):
+        '''
+        Returns the totals of every process, see metrics.Registry.snapshot().
+        '''
+
+        snapshot = metrics.Registry.snapshot(self)
+        width = len(self.buckets) + 1
+        for key, slot in self.shared.items():
+            kind, name, labels = json.loads(key)
+            if kind == "c":
+                snapshot["counters"].append([name, labels, self.shared.ints[slot]])
+            else:
+                snapshot["histograms"].append([name, labels, list(self.shared.ints[slot:slot + width]) +
+                                               [self.shared.floats[slot + width]]])
+        return snapshot
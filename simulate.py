@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+import math
+import os
+import random
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import dice_pool
+import odds
+import rng_backends
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+'''
+Monte Carlo simulation of dice rolls, for /simulate.
+
+/odds works out exact distributions, but rolls with rerolls, exploding dice or
+success counting are simpler to simulate. simulate() rolls the plan many times
+and returns a histogram of the totals with its mean, standard deviation and
+percentiles.
+
+Trials run in batches. With NumPy a batch is one matrix of faces with a row per
+trial, otherwise every trial is rolled in pure Python. Batches can be spread over
+a pool of worker processes. Each batch is seeded from the simulation seed and
+its batch number, so a seeded simulation that runs all its trials gives the same
+histogram however many workers run it.
+
+The simulation stops at the first of:
+ - the requested number of trials,
+ - the time budget running out,
+ - the 95% confidence intervals of the mean (and the chance, if a target was
+   given) being narrower than the tolerance. The mean's tolerance is a fraction
+   of the roll's standard deviation, so every roll converges in the same number
+   of trials however large its totals are.
+
+Terms are passed as DiceTerm-like tuples of
+(sign, num_dice, die, keep, keep_count, reroll, explode, target) so this module
+has no Slack or Flask code.
+'''
+
+DEFAULT_TRIALS = 1000000
+
+# Seconds a simulation may run for
+DEFAULT_TIME_BUDGET = 2.0
+
+# Half widths of the 95% confidence intervals to stop at: the mean's in standard
+# deviations of the roll, and the chance's as a fraction. Every roll gets there in
+# about 40000 trials for the mean and at most about 150000 for the chance.
+MEAN_TOLERANCE = 0.01
+CHANCE_TOLERANCE = 0.0025
+
+# Confidence intervals are not trusted before this many trials
+MIN_TRIALS = 10000
+
+# Trials per batch. Batches are made smaller so a NumPy batch holds at most
+# MAX_BATCH_CELLS faces, counting the dice exploding dice are expected to add.
+BATCH_SIZE = 100000 if numpy is not None else 2000
+MAX_BATCH_CELLS = 4000000
+
+# Pure Python batches check the time budget after every this many trials
+BUDGET_CHECK_TRIALS = 64
+
+# 95% of a normal distribution is within this many standard deviations
+Z_95 = 1.96
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# The process pool, created the first time more than one worker is asked for
+executor = None
+executor_workers = 0
+
+
+def batch_seed(seed, index):
+    '''
+    Returns the seed for batch number index of a simulation.
+    '''
+
+    return rng_backends.derive_key(seed, 0, index)
+
+
+def simulate_term_numpy(rng, term, size):
+    '''
+    Rolls one term size times with NumPy and returns an array of signed values, one per trial.
+    '''
+
+    sign, num_dice, die, keep, keep_count, reroll, explode, target = term
+
+    faces = rng.integers(1, die + 1, size=(size, num_dice), dtype=numpy.int32)
+
+    if reroll:
+        rerolled = faces <= reroll
+        faces[rerolled] = rng.integers(1, die + 1, size=int(rerolled.sum()), dtype=numpy.int32)
+
+    if not explode:
+        return kept_values_numpy(faces, keep, keep_count, target) * sign
+
+    # Only the dice that exploded are rolled again. The new dice are kept as a flat
+    # list of (trial, face) instead of a column for every trial.
+    extra_trials = []
+    extra_faces = []
+    trials = numpy.nonzero(faces == die)[0]
+    for rounds in range(dice_pool.MAX_EXPLODE_ROUNDS):
+        if not len(trials):
+            break
+        new_faces = rng.integers(1, die + 1, size=len(trials), dtype=numpy.int32)
+        extra_trials.append(trials)
+        extra_faces.append(new_faces)
+        trials = trials[new_faces == die]
+
+    values = kept_values_numpy(faces, keep, keep_count, target)
+    if not extra_trials:
+        return values * sign
+    extra_trials = numpy.concatenate(extra_trials)
+    extra_faces = numpy.concatenate(extra_faces)
+
+    if keep is None:
+        weights = extra_faces >= target if target else extra_faces
+        values += numpy.bincount(extra_trials, weights=weights, minlength=size).astype(numpy.int64)
+        return values * sign
+
+    # Keeping needs every die of a trial side by side, so only the trials that
+    # exploded get a wider row. The padding is never kept: 0 when keeping high,
+    # above the die when keeping low.
+    order = numpy.argsort(extra_trials, kind="stable")
+    extra_trials = extra_trials[order]
+    extra_faces = extra_faces[order]
+    exploded, first, counts = numpy.unique(extra_trials, return_index=True, return_counts=True)
+    rows = numpy.repeat(numpy.arange(len(exploded)), counts)
+    columns = num_dice + numpy.arange(len(extra_trials)) - numpy.repeat(first, counts)
+
+    wide = numpy.full((len(exploded), num_dice + int(counts.max())), die + 1 if keep == "low" else 0,
+                      dtype=numpy.int32)
+    wide[:, :num_dice] = faces[exploded]
+    wide[rows, columns] = extra_faces
+
+    values[exploded] = kept_values_numpy(wide, keep, keep_count, target)
+    return values * sign
+
+
+def kept_values_numpy(faces, keep, keep_count, target):
+    '''
+    Returns the value of each row of a matrix of faces, keeping and counting like a DiceTerm.
+    '''
+
+    if keep == "high":
+        split = faces.shape[1] - keep_count
+        faces = numpy.partition(faces, split, axis=1)[:, split:]
+    elif keep == "low":
+        faces = numpy.partition(faces, keep_count - 1, axis=1)[:, :keep_count]
+
+    if target:
+        return (faces >= target).sum(axis=1, dtype=numpy.int64)
+    return faces.sum(axis=1, dtype=numpy.int64)
+
+
+def roll_term(rng, term):
+    '''
+    Rolls one term once in pure Python and returns its signed value.
+    '''
+
+    sign, num_dice, die, keep, keep_count, reroll, explode, target = term
+    faces = range(1, die + 1)
+
+    dice = rng.choices(faces, k=num_dice)
+
+    if reroll:
+        dice = [rng.choice(faces) if face <= reroll else face for face in dice]
+
+    if explode:
+        exploded = dice.count(die)
+        for rounds in range(dice_pool.MAX_EXPLODE_ROUNDS):
+            if not exploded:
+                break
+            extra = rng.choices(faces, k=exploded)
+            dice.extend(extra)
+            exploded = extra.count(die)
+
+    if keep is None and not target:
+        return sign * sum(dice)
+    return sign * dice_pool.pool_value(dice_pool.kept_counts(dice_pool.count_faces(dice), keep, keep_count), target)
+
+
+def run_batch(terms, modifier, size, seed, deadline=None):
+    '''
+    Rolls size trials and returns a Counter of {total: times rolled}.
+
+    Without NumPy the batch stops early once time.time() passes deadline, after
+    at least BUDGET_CHECK_TRIALS trials. A NumPy batch always finishes, its size
+    is bounded by MAX_BATCH_CELLS.
+
+    This runs in the worker processes, so it only takes plain tuples and ints.
+    '''
+
+    if numpy is not None:
+        rng = numpy.random.default_rng(seed)
+        totals = numpy.full(size, modifier, dtype=numpy.int64)
+        for term in terms:
+            totals += simulate_term_numpy(rng, term, size)
+        values, counts = numpy.unique(totals, return_counts=True)
+        return Counter(dict(zip(values.tolist(), counts.tolist())))
+
+    rng = random.Random(seed)
+    histogram = Counter()
+    for start in range(0, size, BUDGET_CHECK_TRIALS):
+        histogram.update(modifier + sum(roll_term(rng, term) for term in terms)
+                         for trial in range(min(BUDGET_CHECK_TRIALS, size - start)))
+        if deadline is not None and time.time() > deadline:
+            break
+    return histogram
+
+
+def expected_dice(term):
+    '''
+    Returns how many dice a term rolls on average, counting the ones exploding dice add.
+    '''
+
+    sign, num_dice, die, keep, keep_count, reroll, explode, target = term
+    if explode and die > 1:
+        return num_dice * die / (die - 1.0)
+    return num_dice
+
+
+def get_executor(workers):
+    '''
+    Returns the shared process pool, made again if the number of workers changed.
+    '''
+
+    global executor, executor_workers
+
+    if executor is None or executor_workers != workers:
+        if executor is not None:
+            executor.shutdown(wait=False)
+        executor = ProcessPoolExecutor(max_workers=workers)
+        executor_workers = workers
+
+    return executor
+
+
+def histogram_distribution(histogram, trials):
+    '''
+    Turns a histogram into a distribution tuple of (low, probabilities) like odds.py uses.
+    '''
+
+    low = min(histogram)
+    high = max(histogram)
+    return (low, tuple(histogram.get(value, 0) / trials for value in range(low, high + 1)))
+
+
+def histogram_percentile(sorted_values, histogram, trials, percent):
+    '''
+    Returns the nearest-rank percentile of a histogram.
+    '''
+
+    rank = max(int(math.ceil(percent / 100.0 * trials)), 1)
+    seen = 0
+    for value in sorted_values:
+        seen += histogram[value]
+        if seen >= rank:
+            return value
+    return sorted_values[-1]
+
+
+def summarize(histogram, comparison=None, target=None):
+    '''
+    Returns the statistics of a histogram as a dict, see simulate().
+    '''
+
+    trials = sum(histogram.values())
+    total = sum(value * count for value, count in histogram.items())
+    mean = total / trials
+    variance = sum(count * (value - mean) ** 2 for value, count in histogram.items()) / trials
+    sorted_values = sorted(histogram)
+
+    result = {"trials": trials,
+              "histogram": histogram,
+              "low": sorted_values[0],
+              "high": sorted_values[-1],
+              "mean": mean,
+              "std": math.sqrt(variance),
+              "percentiles": dict((percent, histogram_percentile(sorted_values, histogram, trials, percent))
+                                  for percent in PERCENTILES),
+              "chance": None}
+
+    if comparison is not None:
+        result["chance"] = odds.chance(histogram_distribution(histogram, trials), comparison, target)
+
+    return result
+
+
+def precise_enough(result, mean_tolerance, chance_tolerance):
+    '''
+    True once the 95% confidence intervals of the mean and chance are inside the
+    tolerances. mean_tolerance is in standard deviations of the roll.
+    '''
+
+    trials = result["trials"]
+    if trials < MIN_TRIALS:
+        return False
+
+    if Z_95 / math.sqrt(trials) > mean_tolerance:
+        return False
+
+    chance = result["chance"]
+    if chance is not None and Z_95 * math.sqrt(chance * (1 - chance) / trials) > chance_tolerance:
+        return False
+
+    return True
+
+
+def simulate(terms, modifier=0, trials=DEFAULT_TRIALS, time_budget=DEFAULT_TIME_BUDGET,
+             comparison=None, target=None, workers=1, seed=None,
+             mean_tolerance=MEAN_TOLERANCE, chance_tolerance=CHANCE_TOLERANCE):
+    '''
+    Rolls terms + modifier up to trials times and returns a dict containing
+    {"trials": <int>, "histogram": Counter, "low": <int>, "high": <int>, "mean": <float>,
+     "std": <float>, "percentiles": {<percent>: <int>}, "chance": <float or None>,
+     "stopped": "trials", "time" or "converged", "seconds": <float>}
+
+    comparison and target work like odds.chance(). workers above 1 runs batches
+    in a process pool. mean_tolerance is in standard deviations, see precise_enough().
+    Raises ValueError for bad arguments.
+    '''
+
+    if trials <= 0:
+        raise ValueError("Number of trials must be more than 0")
+    if workers <= 0:
+        raise ValueError("Number of workers must be more than 0")
+    if not terms:
+        raise ValueError("Nothing to simulate")
+
+    terms = [tuple(term) for term in terms]
+    if seed is None:
+        seed = int.from_bytes(os.urandom(8), "little")
+
+    dice_per_trial = max(sum(expected_dice(term) for term in terms), 1)
+    size = max(min(BATCH_SIZE, int(MAX_BATCH_CELLS // dice_per_trial)), 1)
+
+    start = time.perf_counter()
+    deadline = time.time() + time_budget
+    histogram = Counter()
+    scheduled = 0
+    batch_index = 0
+    stopped = "trials"
+
+    def next_batch():
+        nonlocal scheduled, batch_index
+        batch = min(size, trials - scheduled)
+        scheduled += batch
+        batch_index += 1
+        return (terms, modifier, batch, batch_seed(seed, batch_index), deadline)
+
+    if workers == 1:
+        while scheduled < trials:
+            histogram.update(run_batch(*next_batch()))
+            if time.perf_counter() - start > time_budget:
+                stopped = "time"
+                break
+            if precise_enough(summarize(histogram, comparison, target), mean_tolerance, chance_tolerance):
+                stopped = "converged"
+                break
+    else:
+        pool = get_executor(workers)
+        running = set()
+        while True:
+            while scheduled < trials and len(running) < workers and stopped == "trials":
+                running.add(pool.submit(run_batch, *next_batch()))
+            if not running:
+                break
+
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                histogram.update(future.result())
+
+            if stopped != "trials":
+                continue
+            if time.perf_counter() - start > time_budget:
+                stopped = "time"
+            elif precise_enough(summarize(histogram, comparison, target), mean_tolerance, chance_tolerance):
+                stopped = "converged"
+
+    result = summarize(histogram, comparison, target)
+    result["stopped"] = stopped
+    result["seconds"] = time.perf_counter() - start
+    return result
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+
+'''
+Checks that requests really come from Slack.
+
+Slack signs every request with the app's signing secret: the X-Slack-Signature
+header is "v0=" and the hex HMAC-SHA256 of "v0:<timestamp>:<body>", and the
+timestamp is sent in X-Slack-Request-Timestamp. See
+https://api.slack.com/authentication/verifying-requests-from-slack
+
+The HMAC key schedule is worked out once and copied for every request, and
+signatures are compared in constant time.
+
+A captured request could be sent again, so requests older than the window are
+refused and every signature seen inside the window is remembered. The set of
+remembered signatures is bounded, the oldest are forgotten first.
+'''
+
+# Slack's recommended limit on the age of a request, in seconds
+DEFAULT_WINDOW = 300
+
+# How many recent signatures to remember for the replay guard
+DEFAULT_MAX_SEEN = 100000
+
+SIGNATURE_VERSION = b"v0"
+
+
+class SignatureVerifier(object):
+    '''
+    Verifies X-Slack-Signature headers for one signing secret.
+
+    verify() returns None for a good request, or the reason it was refused:
+    "missing", "stale", "bad_signature" or "replayed".
+    '''
+
+    def __init__(self, secret, window=DEFAULT_WINDOW, max_seen=DEFAULT_MAX_SEEN):
+        if isinstance(secret, str):
+            secret = secret.encode("utf-8")
+        if not secret:
+            raise ValueError("A signing secret is needed to verify requests")
+
+        self.key = hmac.new(secret, digestmod=hashlib.sha256)
+        self.window = window
+        self.max_seen = max_seen
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+
+    def sign(self, timestamp, body):
+        '''
+        Returns the signature Slack would send for a timestamp string and body bytes.
+        '''
+
+        mac = self.key.copy()
+        mac.update(SIGNATURE_VERSION + b":" + timestamp.encode("ascii") + b":" + body)
+        return "v0=" + mac.hexdigest()
+
+    def verify(self, timestamp, signature, body, now=None):
+        if not timestamp or not signature:
+            return "missing"
+
+        # int() would take other digits and spaces, which sign() can not encode
+        if not (timestamp.isascii() and timestamp.isdigit()):
+            return "missing"
+        request_time = int(timestamp)
+
+        if now is None:
+            now = time.time()
+        if abs(now - request_time) > self.window:
+            return "stale"
+
+        if not signature.isascii() or not hmac.compare_digest(self.sign(timestamp, body), signature):
+            return "bad_signature"
+
+        with self.lock:
+            self.forget(now)
+            if signature in self.seen:
+                return "replayed"
+            self.seen[signature] = request_time
+
+        return None
+
+    def forget(self, now):
+        '''
+        Drops remembered signatures that are too old to replay or over max_seen.
+        Must be called holding the lock.
+        '''
+
+        while self.seen:
+            signature, request_time = next(iter(self.seen.items()))
+            if len(self.seen) < self.max_seen and now - request_time <= self.window:
+                break
+            self.seen.popitem(last=False)
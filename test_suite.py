@@ -1,8 +1,49 @@
 #!/usr/bin/env python3
 
+import os
 import unittest
-from dicebot import parse_roll, DicebotException
+
+# Macros saved by the tests only last as long as the test run
+os.environ["DICEBOT_MACROS_FILE"] = ":memory:"
+
+from dicebot import parse_roll, generate_roll, generate_rolls, DicebotException
+from dicebot import compile_roll, compile_normalized_roll, generate_plan_roll, format_expression_roll
+from dicebot import parse_odds, generate_odds
+import asyncio
+import json
+import random
 import string
+from urllib.parse import parse_qsl, urlencode
+
+import dicebot_asgi
+import dicebot_server
+import dicebot_wsgi
+import fcntl
+import metrics
+import tempfile
+import benchmark
+import load_test
+import dice_pool
+import dicebot
+import odds
+import random_pool
+import rng_backends
+import simulate
+import slack_signature
+import rate_limit
+import roll_journal
+import roll_macros
+import roll_stats
+import shared_counters
+import signal
+import socket
+import subprocess
+import sys
+import time
+import threading
+import urllib.request
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, make_server
 
 
 class ParseRollsTest(unittest.TestCase):
@@ -75,6 +116,1689 @@ class ParseRollsTest(unittest.TestCase):
             with self.assertRaises(DicebotException, msg=value):
                 parse_roll(value)
 
+    def test_modifier_limit(self):
+        self.assertEqual(parse_roll("1d6+1000000")["modifier"], dicebot.MAX_MODIFIER)
+        for value in ["1d6+99999999999999999999999999999", "1d6-1000001", "1d6+600000+600000"]:
+            with self.assertRaises(DicebotException, msg=value):
+                parse_roll(value)
+        with self.assertRaises(DicebotException):
+            dicebot.RollSpec.create(1, 6, dicebot.MAX_MODIFIER + 1)
+
+
+class GenerateRollsTest(unittest.TestCase):
+
+    def test_single_roll(self):
+        result = generate_roll({"num_dice": 3, "die": 8, "modifier": 2})
+
+        self.assertEqual(len(result["rolls"]), 3)
+        self.assertEqual(result["modifier"], 2)
+        self.assertEqual(result["total"], sum(result["rolls"]) + 2)
+        for face in result["rolls"]:
+            self.assertTrue(1 <= face <= 8)
+
+    def test_bulk_rolls(self):
+        roll_list = [{"num_dice": 4, "die": 6, "modifier": 0}] * 6
+        roll_list.append({"num_dice": 10000, "die": 20, "modifier": -3})
+
+        result_list = generate_rolls(roll_list)
+
+        self.assertEqual(len(result_list), 7)
+        for result in result_list[:6]:
+            self.assertEqual(len(result["rolls"]), 4)
+            self.assertTrue(all(1 <= face <= 6 for face in result["rolls"]))
+
+        self.assertEqual(len(result_list[6]["rolls"]), 10000)
+        self.assertTrue(all(isinstance(face, int) for face in result_list[6]["rolls"]))
+        self.assertEqual(result_list[6]["total"], sum(result_list[6]["rolls"]) - 3)
+
+    def test_invalid_roll_dict(self):
+        for value in [None, {}, {"num_dice": 0, "die": 6, "modifier": 0},
+                      {"num_dice": 1, "die": "a", "modifier": 0}]:
+            with self.assertRaises(DicebotException, msg=value):
+                generate_rolls([value])
+
+
+class RollSpecTest(unittest.TestCase):
+
+    def test_parse_roll_spec(self):
+        spec = dicebot.parse_roll_spec("2d6 + 3")
+
+        self.assertEqual(spec, dicebot.RollSpec(2, 6, 3))
+        self.assertEqual(spec["die"], 6)
+        self.assertEqual(spec.to_dict(), parse_roll("2d6 + 3"))
+        with self.assertRaises(AttributeError):
+            spec.extra = 1
+
+    def test_create_checks_values(self):
+        self.assertEqual(dicebot.RollSpec.create("3", 8, "-1"), dicebot.RollSpec(3, 8, -1))
+        for values in [(0, 6, 0), (1, 0, 0), (1, dicebot.MAX_DIE_VALUE + 1, 0),
+                       (dicebot.MAX_NUM_DICE + 1, 6, 0), (1, "a", 0)]:
+            with self.assertRaises(DicebotException, msg=values):
+                dicebot.RollSpec.create(*values)
+
+    def test_roll_results(self):
+        results = dicebot.generate_roll_results([dicebot.RollSpec(4, 6, 1), dicebot.RollSpec(2, 20, -2)])
+
+        self.assertEqual([result.rolls.typecode for result in results], ["H", "H"])
+        self.assertEqual(results[0].total, sum(results[0].rolls) + 1)
+        self.assertEqual(results[1]["total"], sum(results[1]["rolls"]) - 2)
+
+        # Replays match the dict API
+        replayed = generate_rolls([{"num_dice": 4, "die": 6, "modifier": 1},
+                                   {"num_dice": 2, "die": 20, "modifier": -2}], record=results[0].rng)
+        self.assertEqual(replayed, [result.to_dict() for result in results])
+
+        # The formatters take either
+        self.assertEqual(dicebot.format_standard_roll(results[0], "user", dicebot.RollSpec(4, 6, 1)),
+                         dicebot.format_standard_roll(results[0].to_dict(), "user", parse_roll("4d6+1")))
+
+
+class CompileRollTest(unittest.TestCase):
+
+    def test_expression(self):
+        plan = compile_roll("4d6kh3 + 2d8 - 1d4 + 5")
+
+        self.assertEqual(plan.modifier, 5)
+        self.assertEqual(len(plan.dice), 3)
+        self.assertEqual((plan.dice[0].num_dice, plan.dice[0].die), (4, 6))
+        self.assertEqual((plan.dice[0].keep, plan.dice[0].keep_count), ("high", 3))
+        self.assertEqual(plan.dice[2].sign, -1)
+        self.assertEqual(plan.text, "4d6kh3 + 2d8 - 1d4 + 5")
+
+    def test_drop_is_keep(self):
+        self.assertEqual(compile_roll("4d6dl1").dice, compile_roll("4d6kh3").dice)
+        self.assertEqual(compile_roll("4d6dh1").dice, compile_roll("4d6kl3").dice)
+
+    def test_parse_roll_compatibility(self):
+        self.assertEqual(parse_roll("1d20 + 5"), {"num_dice": 1, "die": 20, "modifier": 5})
+        self.assertEqual(parse_roll("-3", adv_or_dis=True), {"num_dice": 2, "die": 20, "modifier": -3})
+        self.assertEqual(parse_roll("2d6+2-3"), {"num_dice": 2, "die": 6, "modifier": -1})
+
+        with self.assertRaises(DicebotException):
+            parse_roll("4d6kh3 + 2d8")
+
+    def test_cache_is_keyed_on_normalized_text(self):
+        compile_normalized_roll.cache_clear()
+        compile_roll("1d20+5")
+        compile_roll(" 1D20 + 5 ")
+
+        self.assertEqual(compile_normalized_roll.cache_info().hits, 1)
+
+    def test_invalid_expression(self):
+        for value in ["4d6kh5", "4d6dl4", "4d6k", "1d20+", "5", "1d6 x 2", "1d6++1", "10001d6"]:
+            with self.assertRaises(DicebotException, msg=value):
+                compile_roll(value)
+
+    def test_generate_plan_roll(self):
+        plan = compile_roll("4d6kh3 - 1d1 + 2")
+        result = generate_plan_roll(plan)
+
+        kept = [face for position, face in enumerate(result["terms"][0]["rolls"])
+                if position not in result["terms"][0]["dropped"]]
+        self.assertEqual(len(result["terms"][0]["dropped"]), 1)
+        self.assertEqual(sorted(kept), sorted(result["terms"][0]["rolls"])[1:])
+        self.assertEqual(result["total"], sum(kept) - 1 + 2)
+
+        output = format_expression_roll(result, "user", plan)
+        self.assertTrue(output.startswith("user rolled 4d6kh3 - 1d1 + 2:\n("))
+        self.assertTrue(output.endswith(" - (1) (+2) = *" + str(result["total"]) + "*\n"))
+
+
+class DicePoolTest(unittest.TestCase):
+
+    def sorted_pool(self, dice, keep, keep_count, target):
+        # What the pool counting must match: a stable sort of the positions
+        order = sorted(range(len(dice)), key=dice.__getitem__)
+        if keep == "high":
+            dropped = set(order[:len(dice) - keep_count])
+        elif keep == "low":
+            dropped = set(order[keep_count:])
+        else:
+            dropped = set()
+        kept = [face for position, face in enumerate(dice) if position not in dropped]
+        value = sum(1 for face in kept if face >= target) if target else sum(kept)
+        return (value, dropped)
+
+    def test_matches_sorting(self):
+        rng = random.Random(3)
+        for trial in range(300):
+            die = rng.choice([2, 6, 10, 20])
+            dice = [rng.randint(1, die) for count in range(rng.randint(1, 40))]
+            keep = rng.choice([None, "high", "low"])
+            keep_count = rng.randint(1, len(dice))
+            target = rng.choice([0, 0, rng.randint(1, die)])
+
+            self.assertEqual(dice_pool.count_pool(dice, keep, keep_count, target),
+                             self.sorted_pool(dice, keep, keep_count, target), (dice, keep, keep_count, target))
+
+    def test_split_kept(self):
+        self.assertEqual(dice_pool.split_kept([3, 6, 1, 4], "high", 3), ([1], [3, 4, 6]))
+        self.assertEqual(dice_pool.split_kept([5, 5, 2, 5], "low", 2), ([5, 5], [2, 5]))
+
+    def test_success_pool(self):
+        plan = compile_roll("500d10t8")
+        result = generate_plan_roll(plan)
+        self.assertEqual(result["total"], sum(1 for face in result["terms"][0]["rolls"] if face >= 8))
+
+        plan = compile_roll("20d10dl5t7")
+        result = generate_plan_roll(plan)
+        self.assertEqual(len(result["terms"][0]["dropped"]), 5)
+        self.assertEqual(result["total"], self.sorted_pool(result["terms"][0]["rolls"], "high", 15, 7)[0])
+
+
+class BatchRollTest(unittest.TestCase):
+
+    def test_parse_batch(self):
+        plans = dicebot.parse_batch("1d20+5; 2d6+3; 2X 4d6kh3;")
+        self.assertEqual([plan.text for plan in plans], ["1d20 + 5", "2d6 + 3", "4d6kh3", "4d6kh3"])
+
+        for text in [";", "0x1d6", "21x1d6", "2x 5000d6; 1d6", "1d20; 2d", "1d20+5;;", "; 1d20", "1d20; ; 2d6"]:
+            with self.assertRaises(DicebotException, msg=text):
+                dicebot.parse_batch(text)
+
+    def test_one_draw(self):
+        plans = dicebot.parse_batch("3x 1d20+5; 4d6r1kh3")
+        record_requests = []
+        rolled_batch = dicebot.generate_batch_roll(plans)
+        self.assertEqual(len(rolled_batch["rolls"]), 4)
+        for rolled_plan, plan in zip(rolled_batch["rolls"], plans):
+            self.assertEqual(rolled_plan["total"], plan.modifier + sum(term["subtotal"] for term in rolled_plan["terms"]))
+            record_requests.append(rolled_plan["rng"])
+
+        # Every roll shares the record of the one bulk draw, and replays from it
+        self.assertEqual(record_requests, [rolled_batch["rng"]] * 4)
+        self.assertEqual(dicebot.generate_batch_roll(plans, rolled_batch["rng"]), rolled_batch)
+
+    def test_roll_command(self):
+        output = dicebot.roll_command({"username": "tester", "channel_name": "general", "text": "1d20+5; 2x 2d6"})
+        lines = output.splitlines()
+        self.assertEqual(lines[0], "tester rolled 3 rolls:")
+        self.assertTrue(lines[1].startswith("1d20 + 5: ("))
+        self.assertTrue(lines[3].startswith("2d6: ("))
+
+        output = dicebot.roll_command({"username": "tester", "channel_name": "general", "text": "1d20+5;"})
+        self.assertTrue(output.startswith("tester rolled 1 roll:\n1d20 + 5: ("))
+
+
+class OddsTest(unittest.TestCase):
+
+    def assertChance(self, text, expected):
+        result = generate_odds(parse_odds(text))
+        self.assertAlmostEqual(result["chance"], expected, places=9, msg=text)
+
+    def test_sums(self):
+        self.assertChance("3d6 = 10", 27 / 216)
+        self.assertChance("3d8+2 >= 15", 0.59375)
+        self.assertChance("1d6 - 1d6 = 0", 1 / 6)
+        self.assertChance("100d100 >= 101", 1.0)
+        self.assertChance("100d100 > 10000", 0.0)
+
+    def test_keep_and_drop(self):
+        # Advantage and disadvantage
+        self.assertChance("2d20kh1 >= 15", 1 - (14 / 20) ** 2)
+        self.assertChance("2d20kl1 + 5 = 6", 39 / 400)
+        # A /character stat
+        self.assertChance("4d6dl1 = 18", 21 / 1296)
+        self.assertChance("4d6dl1 = 3", 1 / 1296)
+
+    def test_distribution_sums_to_one(self):
+        for text in ["100d100", "5d10kh2 - 3d4", "4d6dl1"]:
+            result = generate_odds(parse_odds(text))
+            plan = parse_odds(text)["plan"]
+            self.assertAlmostEqual(sum(odds.plan_distribution(plan.dice, plan.modifier)[1]), 1.0, places=9)
+            self.assertIsNone(result["chance"])
+
+    def test_too_large(self):
+        for text in ["30d6kh3", "20d100kh10", "10000d100"]:
+            with self.assertRaises(DicebotException, msg=text):
+                generate_odds(parse_odds(text))
+
+        self.assertEqual(dicebot.odds_cost({"text": "3d8+2 >= 15"}), dicebot.ODDS_BASE_COST)
+        self.assertTrue(dicebot.odds_cost({"text": "1000d100"}) > dicebot.odds_cost({"text": "100d100"}) >
+                        dicebot.ODDS_BASE_COST)
+
+    def test_cache_is_bounded_by_bytes(self):
+        cache = odds.DistributionCache(max_bytes=8 * 2000)
+        for die in range(2, 12):
+            cache.put((100, die), odds.sum_distribution(100, die))
+        self.assertTrue(cache.size <= 8 * 2000)
+        self.assertIsNone(cache.get((100, 2)))
+        self.assertIsNotNone(cache.get((100, 11)))
+        self.assertEqual(cache.size, sum(len(entry[1]) * 8 for entry in cache.entries.values()))
+
+        cache.put((1000, 100), odds.sum_distribution(1000, 100))
+        self.assertIsNone(cache.get((1000, 100)))
+
+
+class SimulateTest(unittest.TestCase):
+
+    def test_rules_compile(self):
+        plan = compile_roll("4d6 r1 ! dl1 + 6d10t8")
+        self.assertEqual(plan.text, "4d6r1!kh3 + 6d10t8")
+        self.assertEqual(plan.dice[0][5:], (1, True, 0))
+        self.assertEqual(plan.dice[1][5:], (0, False, 8))
+
+        for text in ["1d1!", "1d6r6", "1d6t7", "1d6r1r2", "1d6!!", "1d6r"]:
+            with self.assertRaises(DicebotException, msg=text):
+                compile_roll(text)
+
+        with self.assertRaises(DicebotException):
+            generate_odds(parse_odds("4d6!"))
+
+    def test_plan_roll_rules(self):
+        plan = compile_roll("20d6r2!t5")
+        rolled_plan = generate_plan_roll(plan)
+        faces = rolled_plan["terms"][0]["rolls"]
+        self.assertEqual(len(faces), 20 + faces.count(6))
+        self.assertEqual(rolled_plan["total"], sum(1 for face in faces if face >= 5))
+
+        # Rerolls and explosions replay from the same record
+        self.assertEqual(generate_plan_roll(plan, rolled_plan["rng"])["terms"], rolled_plan["terms"])
+
+    def test_matches_odds(self):
+        for text in ["3d6 >= 12", "4d6kh3 = 18", "2d20kl1 - 1d4 < 5"]:
+            parsed = parse_odds(text)
+            result = simulate.simulate(parsed["plan"].dice, parsed["plan"].modifier, trials=200000,
+                                       comparison=parsed["comparison"], target=parsed["target"], seed=7,
+                                       mean_tolerance=0.0)
+            self.assertEqual(result["trials"], 200000)
+            self.assertAlmostEqual(result["chance"], generate_odds(parsed)["chance"], delta=0.005, msg=text)
+
+    def test_success_counting(self):
+        plan = compile_roll("6d10t8")
+        result = simulate.simulate(plan.dice, trials=100000, comparison="=", target=0, seed=3)
+        self.assertEqual((result["low"], result["high"] <= 6), (0, True))
+        self.assertAlmostEqual(result["chance"], 0.7 ** 6, delta=0.005)
+        self.assertAlmostEqual(result["mean"], 1.8, delta=0.02)
+
+    def test_seeded_and_pure_python(self):
+        plan = compile_roll("3d6r1!kh2 + 2")
+        first = simulate.simulate(plan.dice, plan.modifier, trials=5000, seed=11)
+        second = simulate.simulate(plan.dice, plan.modifier, trials=5000, seed=11)
+        self.assertEqual(first["histogram"], second["histogram"])
+
+        numpy = simulate.numpy
+        simulate.numpy = None
+        try:
+            pure = simulate.simulate(plan.dice, plan.modifier, trials=5000, seed=11)
+        finally:
+            simulate.numpy = numpy
+        self.assertEqual(pure["trials"], 5000)
+        self.assertGreaterEqual(pure["low"], 4)
+
+    def test_exploding_dice(self):
+        for text, mean in [("1d6!", 4.2), ("6d10!t8", 2.0)]:
+            plan = compile_roll(text)
+            result = simulate.simulate(plan.dice, trials=100000, seed=2, mean_tolerance=0.0)
+            self.assertAlmostEqual(result["mean"], mean, delta=0.03, msg=text)
+
+        # Keeping from exploded dice matches the pure Python rolls
+        plan = compile_roll("3d6!kh2")
+        vectorized = simulate.simulate(plan.dice, trials=100000, seed=2, mean_tolerance=0.0)
+        numpy = simulate.numpy
+        simulate.numpy = None
+        try:
+            pure = simulate.simulate(plan.dice, trials=20000, seed=2, mean_tolerance=0.0, time_budget=60)
+        finally:
+            simulate.numpy = numpy
+        self.assertAlmostEqual(vectorized["mean"], pure["mean"], delta=0.06)
+        self.assertEqual((vectorized["low"], vectorized["high"]), (pure["low"], pure["high"]))
+
+        # Exploding dice count towards the faces in a batch
+        self.assertGreater(simulate.expected_dice((1, 10, 6, None, 0, 0, True, 0)), 10)
+
+    def test_pure_python_batch_stops_in_time(self):
+        plan = compile_roll("200d6")
+        numpy = simulate.numpy
+        simulate.numpy = None
+        try:
+            histogram = simulate.run_batch([tuple(term) for term in plan.dice], 0, 10000, 1, deadline=0)
+        finally:
+            simulate.numpy = numpy
+        self.assertEqual(sum(histogram.values()), simulate.BUDGET_CHECK_TRIALS)
+
+    def test_stopping(self):
+        plan = compile_roll("1d6")
+        self.assertEqual(simulate.simulate(plan.dice, trials=10 ** 9, time_budget=0.0)["stopped"], "time")
+        self.assertEqual(simulate.simulate(plan.dice, trials=10 ** 9, mean_tolerance=0.1)["stopped"], "converged")
+
+        # The default tolerances are reached well inside the time budget, even for a chance of one half
+        for text, comparison, target in [("1d20", ">=", 11), ("100d100 + 3d6!", None, None)]:
+            plan = compile_roll(text)
+            result = simulate.simulate(plan.dice, plan.modifier, trials=10 ** 7, comparison=comparison,
+                                       target=target, time_budget=60)
+            self.assertEqual(result["stopped"], "converged", msg=text)
+            self.assertTrue(result["trials"] <= 200000, msg=text)
+
+    def test_worker_pool(self):
+        plan = compile_roll("4d6kh3")
+        trials = simulate.BATCH_SIZE * 3
+        single = simulate.simulate(plan.dice, trials=trials, seed=5, mean_tolerance=0.0, time_budget=60)
+        pooled = simulate.simulate(plan.dice, trials=trials, seed=5, mean_tolerance=0.0, time_budget=60, workers=2)
+        self.assertEqual(single["histogram"], pooled["histogram"])
+
+    def test_command(self):
+        output = dicebot.simulate_command({"username": "tester", "text": "6d10t8 >= 3 20000 trials"})
+        self.assertTrue(output.startswith("tester simulated 6d10t8 20,000 times:\n"))
+        self.assertIn("Chance of >= 3: *", output)
+
+        with self.assertRaises(DicebotException):
+            dicebot.parse_simulate("1d6 0 trials")
+
+
+class AsgiTest(unittest.TestCase):
+
+    def call(self, app, path, form):
+        messages = [{"type": "http.request", "body": urlencode(form).encode("utf-8")}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        async def run():
+            await app({"type": "http", "path": path, "method": "POST"}, receive, send)
+
+        return run(), sent
+
+    def form(self, command, text, response_url=None):
+        form = {"user_name": "user", "command": command, "text": text, "channel_name": "general"}
+        if response_url is not None:
+            form["response_url"] = response_url
+        return form
+
+    def test_immediate_response(self):
+        app = dicebot_asgi.DicebotASGI()
+        call, sent = self.call(app, "/", self.form("/roll", "2d6+1"))
+        asyncio.run(call)
+
+        self.assertEqual(sent[0]["status"], 200)
+        payload = json.loads(sent[1]["body"].decode("utf-8"))
+        self.assertEqual(payload["response_type"], "in_channel")
+        self.assertTrue(payload["text"].startswith("user rolled 2d6:"))
+
+    def test_error_response(self):
+        app = dicebot_asgi.DicebotASGI()
+        call, sent = self.call(app, "/adv", self.form("/adv", "+a"))
+        asyncio.run(call)
+
+        payload = json.loads(sent[1]["body"].decode("utf-8"))
+        self.assertEqual(payload["response_type"], "ephemeral")
+        self.assertTrue(payload["text"].startswith("error: "))
+
+    def test_delayed_response(self):
+        async def run():
+            stub = await dicebot_asgi.ResponseUrlStub().start()
+            app = dicebot_asgi.DicebotASGI(stub.url)
+
+            sent_list = []
+            messages = []
+            for command, text in [("/roll", "2000d6"), ("/odds", "3d8+2 >= 15")]:
+                call, sent = self.call(app, "/", self.form(command, text, stub.url))
+                await call
+                sent_list.append(sent)
+                messages.append(await stub.next_message())
+
+            await app.close()
+            await stub.stop()
+            return sent_list, messages, stub.connections
+
+        sent_list, messages, connections = asyncio.run(run())
+
+        for sent in sent_list:
+            payload = json.loads(sent[1]["body"].decode("utf-8"))
+            self.assertEqual(payload["text"], dicebot_asgi.ACKNOWLEDGE_TEXT)
+
+        self.assertTrue(messages[0]["text"].startswith("user rolled 2000d6:"))
+        self.assertTrue(messages[1]["text"].startswith("user asked for the odds of 3d8 + 2:"))
+        # The second delayed response reuses the pooled connection
+        self.assertEqual(connections, 1)
+
+    def test_same_dispatch_as_flask(self):
+        key = ("dicebot_request_seconds", dicebot.COMMANDS["/roll"].labels)
+        before = dicebot.metrics_registry.histograms.get(key, [0])[:-1]
+
+        # A name given twice keeps its first value, like Flask
+        body = b"user_name=user&command=%2Froll&text=2d6&text=3d8&channel_name=general"
+        status, payload = asyncio.run(dicebot_asgi.DicebotASGI().handle("/", body))
+        self.assertTrue(json.loads(payload.decode("utf-8"))["text"].startswith("user rolled 2d6:"))
+        self.assertEqual(sum(dicebot.metrics_registry.histograms[key][:-1]), sum(before) + 1)
+
+        # A macro of many dice is answered later, like the roll it stands for
+        dicebot.macro_store.set("user", "horde", "2000d6")
+        try:
+            slack_dict = {"username": "user", "text": "horde", "response_url": "https://hooks.slack.com/x"}
+            self.assertTrue(dicebot_asgi.is_delayed("/roll", slack_dict))
+            slack_dict["text"] = "2d6"
+            self.assertFalse(dicebot_asgi.is_delayed("/roll", slack_dict))
+        finally:
+            dicebot.macro_store.delete("user", "horde")
+
+    def test_response_url_origins(self):
+        async def run():
+            stub = await dicebot_asgi.ResponseUrlStub().start()
+            app = dicebot_asgi.DicebotASGI()
+
+            # Not on hooks.slack.com, so answered now and never posted to
+            call, sent = self.call(app, "/", self.form("/roll", "2000d6", stub.url))
+            await call
+            with self.assertRaises(ValueError):
+                await dicebot_asgi.ResponsePoster().post_json(stub.url, b"{}")
+            await app.close()
+            await stub.stop()
+            return sent, stub.received
+
+        sent, received = asyncio.run(run())
+        self.assertTrue(json.loads(sent[1]["body"].decode("utf-8"))["text"].startswith("user rolled 2000d6:"))
+        self.assertEqual(received, [])
+
+        origins = dicebot_asgi.parse_origins("https://hooks.slack.com, http://127.0.0.1:8000/anything")
+        self.assertIn(dicebot_asgi.url_origin("https://HOOKS.slack.com:443/commands/T1/2/x"), origins)
+        for url in ["https://hooks.slack.com.evil.com/", "http://hooks.slack.com/", "https://hooks.slack.com:8443/",
+                    "https://hooks.slack.com@10.0.0.1/", "http://127.0.0.1:8001/", "file:///etc/passwd", None]:
+            self.assertNotIn(dicebot_asgi.url_origin(url), origins, msg=url)
+
+    def test_full_listing(self):
+        async def run():
+            stub = await dicebot_asgi.ResponseUrlStub().start()
+            app = dicebot_asgi.DicebotASGI(stub.url)
+
+            # Answered now, streamed
+            call, sent = self.call(app, "/", self.form("/roll", "300d6 full"))
+            await call
+
+            # Answered later, split into follow ups
+            call, delayed = self.call(app, "/", self.form("/roll", "2000d6 full", stub.url))
+            await call
+            await app.close()
+            await stub.stop()
+            return sent, stub.received
+
+        sent, received = asyncio.run(run())
+
+        payload = json.loads(b"".join(message.get("body", b"") for message in sent[1:]).decode("utf-8"))
+        self.assertTrue(payload["text"].startswith("user rolled 300d6:\n"))
+        self.assertEqual(len(payload["text"].split(" = ")[0].split(" + ")), 300)
+
+        self.assertTrue(2 <= len(received) <= dicebot.MAX_FOLLOW_UPS)
+        self.assertTrue(received[0]["text"].startswith("user rolled 2000d6:\n"))
+        self.assertTrue(all(len(message["text"]) <= dicebot.MESSAGE_CHARS for message in received))
+        self.assertEqual(len("".join(message["text"] for message in received).split(" + ")), 2000)
+
+
+class RandomPoolTest(unittest.TestCase):
+
+    def test_draw_faces_is_in_range(self):
+        faces = random_pool.draw_faces(random.Random(1), 6, 6000)
+
+        self.assertEqual(len(faces), 6000)
+        self.assertEqual(set(faces), {1, 2, 3, 4, 5, 6})
+
+    def test_hits_and_misses(self):
+        pool = random_pool.RandomPool(capacity=100, low_water=50)
+        try:
+            faces = pool.take(20, 10)
+            self.assertEqual(len(faces), 10)
+            self.assertTrue(all(1 <= face <= 20 for face in faces))
+            self.assertEqual(pool.hits, 10)
+
+            self.assertIsNone(pool.take(7, 3))
+            self.assertIsNone(pool.take(6, 101))
+            self.assertEqual(pool.misses, 104)
+        finally:
+            pool.stop()
+
+    def test_concurrent_refills_and_restarts(self):
+        pool = random_pool.RandomPool(capacity=100, low_water=0)
+        pool.stop()
+        pool.take(6, 100)
+        threads = [threading.Thread(target=pool.refill) for count in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(pool.buffers[6]), 100)
+
+        # As if forked: only one thread starts the pool again
+        starts = []
+        start = pool.start
+        pool.start = lambda: (starts.append(1), time.sleep(0.01), start())
+        pool.pid = None
+        threads = [threading.Thread(target=pool.take, args=(6, 1)) for count in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool.stop()
+        self.assertEqual(len(starts), 1)
+        self.assertEqual(len(pool.buffers[6]), 92)
+
+    def test_generate_roll_uses_pool(self):
+        pool = random_pool.RandomPool(capacity=100, low_water=50)
+        counters = dicebot.metrics_registry.counters
+        hits = counters.get(("dicebot_random_pool_hits_total", ()), 0)
+        misses = counters.get(("dicebot_random_pool_misses_total", ()), 0)
+        dicebot.random_pool = pool
+        try:
+            result_list = generate_rolls([{"num_dice": 4, "die": 6, "modifier": 0},
+                                          {"num_dice": 2, "die": 7, "modifier": 0}])
+        finally:
+            dicebot.random_pool = None
+            pool.stop()
+
+        self.assertEqual(pool.hits, 4)
+        self.assertEqual(pool.misses, 2)
+        self.assertEqual(len(result_list[1]["rolls"]), 2)
+
+        # Every worker's pool is counted at /metrics too
+        self.assertEqual(counters[("dicebot_random_pool_hits_total", ())], hits + 4)
+        self.assertEqual(counters[("dicebot_random_pool_misses_total", ())], misses + 2)
+        self.assertIn("# TYPE dicebot_random_pool_hits_total counter", dicebot.metrics_registry.render())
+
+
+class RngBackendsTest(unittest.TestCase):
+
+    spec_list = [(4, 6), (1, 20), (50, 100)]
+
+    def test_replay(self):
+        names = ["shake", "mersenne", "splitmix"]
+        if rng_backends.load_numpy() is not None:
+            names.append("philox")
+
+        for name in names:
+            backend = rng_backends.create_backend(name)
+            rolls, record = backend.draw(self.spec_list)
+
+            self.assertEqual([len(faces) for faces in rolls], [4, 1, 50])
+            self.assertTrue(all(1 <= face <= 100 for face in rolls[2]))
+            # A fresh backend can replay from the record alone
+            self.assertEqual(rng_backends.create_backend(name).replay(record, self.spec_list), rolls)
+
+    def test_requests_differ(self):
+        backend = rng_backends.create_backend("splitmix", seed=1, stream=0)
+        first, first_record = backend.draw([(100, 20)])
+        second, second_record = backend.draw([(100, 20)])
+
+        self.assertNotEqual(first, second)
+        self.assertEqual(second_record["request"], first_record["request"] + 1)
+
+    def test_streams_differ(self):
+        first = rng_backends.create_backend("splitmix", seed=1, stream=0).draw([(100, 20)])[0]
+        second = rng_backends.create_backend("splitmix", seed=1, stream=1).draw([(100, 20)])[0]
+
+        self.assertNotEqual(first, second)
+
+    def test_splitmix_without_numpy(self):
+        key = rng_backends.derive_key(7, 3, 11)
+        vectorized = rng_backends.splitmix_faces(key, self.spec_list)
+
+        numpy_module = rng_backends.numpy
+        rng_backends.numpy = None
+        try:
+            pure = rng_backends.splitmix_faces(key, self.spec_list)
+        finally:
+            rng_backends.numpy = numpy_module
+
+        self.assertEqual(vectorized, pure)
+
+    def test_shake_without_numpy(self):
+        key = rng_backends.derive_key(7, 3, 11)
+        spec_list = self.spec_list + [(100, 6)]
+        vectorized = rng_backends.shake_faces(key, spec_list)
+
+        numpy_module = rng_backends.numpy
+        rng_backends.numpy = None
+        try:
+            pure = rng_backends.shake_faces(key, spec_list)
+        finally:
+            rng_backends.numpy = numpy_module
+
+        self.assertEqual(vectorized, pure)
+        self.assertEqual([len(faces) for faces in pure], [4, 1, 50, 100])
+
+    def test_shake_skips_biased_values(self):
+        # A die this big makes skips common, and skipped draws must still replay
+        die = 3 * 2 ** 62
+        key = rng_backends.derive_key(1, 2, 3)
+        faces = rng_backends.shake_faces(key, [(40, die)])[0]
+
+        self.assertEqual(len(faces), 40)
+        self.assertTrue(all(1 <= face <= die for face in faces))
+        self.assertEqual(rng_backends.shake_faces(key, [(40, die)])[0], faces)
+
+    def test_stream_key_is_cached(self):
+        backend = rng_backends.create_backend("shake", seed=5, stream=9)
+        record = backend.draw([(3, 6)])[1]
+
+        self.assertEqual(rng_backends.derive_key(5, 9, record["request"]),
+                         rng_backends.derive_key(5, 9, record["request"], backend.stream_key))
+
+    def test_system_is_not_replayable(self):
+        backend = rng_backends.create_backend("system")
+        rolls, record = backend.draw(self.spec_list)
+
+        self.assertTrue(all(1 <= face <= 6 for face in rolls[0]))
+        with self.assertRaises(ValueError):
+            backend.replay(record, self.spec_list)
+
+    def test_generate_rolls_replay(self):
+        roll_list = [{"num_dice": 4, "die": 6, "modifier": 0}] * 6
+        result_list = generate_rolls(roll_list)
+
+        self.assertEqual(generate_rolls(roll_list, record=result_list[0]["rng"]), result_list)
+
+        plan = compile_roll("4d6kh3 + 2d8")
+        rolled_plan = generate_plan_roll(plan)
+        self.assertEqual(generate_plan_roll(plan, record=rolled_plan["rng"]), rolled_plan)
+
+
+class RenderTest(unittest.TestCase):
+
+    def test_payload_bytes(self):
+        for text, in_channel in [("user rolled 1d6:\n4 = *4*\n", True), ('error: "bad" \u00e9', False)]:
+            payload = dicebot.render_slack_payload(text, in_channel)
+            self.assertEqual(json.loads(payload.decode("utf-8")), dicebot.build_slack_payload(text, in_channel))
+
+    def test_format_output(self):
+        roll = {"num_dice": 3, "die": 6, "modifier": -2}
+        rolled_dice = {"total": 9, "rolls": [1, 4, 6], "modifier": -2}
+        self.assertEqual(dicebot.format_standard_roll(rolled_dice, "user", roll),
+                         "user rolled 3d6:\n1 + 4 + 6 (-2) = *9*\n")
+
+        roll = {"num_dice": 2, "die": 20, "modifier": 3}
+        rolled_dice = {"total": 25, "rolls": [7, 15], "modifier": 3}
+        self.assertEqual(dicebot.format_adv_dis_roll(rolled_dice, "user", roll, adv=True),
+                         "user rolled at Advantage:\n~7~ *15* (+3) = *18*\n")
+        self.assertEqual(dicebot.format_adv_dis_roll(rolled_dice, "user", roll, dis=True),
+                         "user rolled at Disadvantage:\n*7* ~15~ (+3) = *10*\n")
+
+        roll_list = [{"total": 10, "rolls": [4, 1, 3, 2], "modifier": 0}] * 6
+        self.assertEqual(dicebot.format_character_roll(roll_list, "user"),
+                         "user rolled a stat block:\n" + "~1~ 2 + 3 + 4 = *9*\n" * 6)
+
+    def test_fixed_tables(self):
+        for modifier, modifier_text in [(-4, " - 4"), (0, ""), (7, " + 7")]:
+            for adv in [True, False]:
+                expression, totals, texts = dicebot.adv_dis_table(modifier, adv)
+                self.assertEqual(expression, ("2d20kh1" if adv else "2d20kl1") + modifier_text)
+                for first in range(1, 21):
+                    for second in range(1, 21):
+                        outcome = (first - 1) * 20 + second - 1
+                        rolled_dice = {"rolls": [first, second], "modifier": modifier}
+                        header = (dicebot.ADV_HEADER if adv else dicebot.DIS_HEADER) % "user"
+                        self.assertEqual(header + texts[outcome],
+                                         dicebot.format_adv_dis_roll(rolled_dice, "user", {"num_dice": 2},
+                                                                     adv=adv, dis=not adv))
+                        self.assertEqual(totals[outcome], (max if adv else min)(first, second) + modifier)
+
+        table = dicebot.character_table()
+        self.assertEqual(len(table), 1296)
+        for rolls in [(1, 1, 1, 1), (6, 5, 4, 3), (2, 6, 2, 5), (6, 6, 6, 6)]:
+            a, b, c, d = rolls
+            line, total = table[(a - 1) * 216 + (b - 1) * 36 + (c - 1) * 6 + d - 1]
+            self.assertEqual(line * 6, dicebot.format_character_roll([{"rolls": rolls}] * 6, "")[len(
+                dicebot.CHARACTER_HEADER % ""):])
+            self.assertEqual(total, sum(rolls) - min(rolls))
+
+        slack_dict = {"username": "user", "channel_name": "general", "text": " + 3"}
+        self.assertIs(dicebot.parse_adv_dis(slack_dict), dicebot.parse_adv_dis(dict(slack_dict)))
+        self.assertRegex(dicebot.dis_command(slack_dict),
+                         r"^user rolled at Disadvantage:\n(\*\d+\* ~\d+~|~\d+~ \*\d+\*) \(\+3\) = \*\d+\*\n$")
+        self.assertEqual(len(dicebot.character_command(slack_dict).splitlines()), 7)
+
+    def test_compact(self):
+        roll = {"num_dice": 1000, "die": 6, "modifier": 0}
+        rolled_dice = {"total": 3500, "rolls": [1, 2, 3, 4, 5, 6] * 166 + [6, 6, 6, 6], "modifier": 0}
+
+        output = dicebot.format_standard_roll(rolled_dice, "user", roll)
+        self.assertEqual(output, "user rolled 1000d6:\n1000 dice: 1 x166, 2 x166, 3 x166, 4 x166, 5 x166, 6 x170"
+                                 " = *3500*\n")
+        self.assertEqual(len(dicebot.format_standard_roll(rolled_dice, "user", roll, compact=False)),
+                         len("user rolled 1000d6:\n") + 1000 + 3 * 999 + len(" = *3500*\n"))
+
+    def test_streaming(self):
+        roll = {"num_dice": 1200, "die": 6, "modifier": 2}
+        rolled_dice = {"total": 4202, "rolls": [1, 2, 3, 4, 5, 6] * 200, "modifier": 2}
+        text = dicebot.format_standard_roll(rolled_dice, "user", roll, compact=False)
+
+        pieces = list(dicebot.stream_standard_roll(rolled_dice, "user", roll))
+        self.assertEqual("".join(pieces), text)
+        self.assertTrue(max(len(piece) for piece in pieces) < len(text) / 2)
+        self.assertEqual(b"".join(dicebot.stream_slack_payload(iter(pieces))), dicebot.render_slack_payload(text))
+
+        messages = dicebot.split_slack_messages(pieces, limit=2000)
+        self.assertEqual("".join(messages), text)
+        self.assertTrue(all(len(message) <= 2000 for message in messages))
+
+        # What doesn't fit is cut, but the total is kept
+        messages = dicebot.split_slack_messages(pieces, limit=1000, max_messages=2)
+        self.assertEqual(len(messages), 2)
+        self.assertEqual(messages[1], dicebot.CUT_TEXT + " (+2) = *4202*\n")
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_every_benchmark_runs(self):
+        for name, function in benchmark.build_benchmarks():
+            function()
+
+    def test_results(self):
+        results = benchmark.run_benchmarks(iterations=5, warmup=1, name_filter="parse_roll 1d20")
+
+        self.assertEqual(list(results), ["parse_roll 1d20"])
+        result = results["parse_roll 1d20"]
+        self.assertTrue(result["p50_us"] <= result["p90_us"] <= result["p99_us"])
+        self.assertIn("peak_bytes", result)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_render(self):
+        registry = metrics.Registry(buckets=(0.1, 1.0))
+        registry.describe("requests_total", "counter", "Requests.")
+        registry.describe("stage_seconds", "histogram", "Stages.")
+        registry.inc("requests_total", (("command", "/roll"),))
+        registry.inc("requests_total", (("command", "/roll"),), amount=2)
+        registry.observe("stage_seconds", 0.05, (("stage", "roll"),))
+        registry.observe("stage_seconds", 0.5, (("stage", "roll"),))
+        registry.observe("stage_seconds", 5, (("stage", "roll"),))
+
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE requests_total counter", lines)
+        self.assertIn('requests_total{command="/roll"} 3', lines)
+        self.assertIn('stage_seconds_bucket{stage="roll",le="0.1"} 1', lines)
+        self.assertIn('stage_seconds_bucket{stage="roll",le="1.0"} 2', lines)
+        self.assertIn('stage_seconds_bucket{stage="roll",le="+Inf"} 3', lines)
+        self.assertIn('stage_seconds_sum{stage="roll"} 5.55', lines)
+        self.assertIn('stage_seconds_count{stage="roll"} 3', lines)
+
+    def test_workers_add_up(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # Another worker's totals, as its flush thread would write them
+            worker = metrics.Registry(directory)
+            worker.inc("requests_total", (("command", "/roll"),), amount=5)
+            worker.observe("stage_seconds", 0.001)
+            snapshot = worker.snapshot()
+            with open(os.path.join(directory, "metrics_" + str(os.getpid()) + "_1.json"), "w") as metrics_file:
+                json.dump(snapshot, metrics_file)
+
+            registry = metrics.Registry(directory)
+            registry.inc("requests_total", (("command", "/roll"),), amount=2)
+            registry.observe("stage_seconds", 0.001)
+            lines = registry.render().splitlines()
+
+            # Nothing left to flush at exit once the directory is gone
+            worker.directory = registry.directory = None
+
+        self.assertIn('requests_total{command="/roll"} 7', lines)
+        self.assertIn("stage_seconds_count 2", lines)
+
+    def test_exited_workers_are_retired(self):
+        with tempfile.TemporaryDirectory() as directory:
+            exited = subprocess.Popen([sys.executable, "-c", ""])
+            exited.wait()
+            worker = metrics.Registry(directory)
+            worker.inc("requests_total", amount=5)
+            worker.observe("stage_seconds", 0.001)
+            for name in ["metrics_" + str(exited.pid) + "_1.json", "metrics_" + str(exited.pid) + "_2.json"]:
+                with open(os.path.join(directory, name), "w") as metrics_file:
+                    json.dump(worker.snapshot(), metrics_file)
+
+            registry = metrics.Registry(directory)
+            registry.inc("requests_total", amount=2)
+            self.assertIn("requests_total 12", registry.render().splitlines())
+
+            # Its files are added into the retired file, and the totals stay the same
+            registry.flush()
+            names = os.listdir(directory)
+            self.assertIn(metrics.RETIRED_FILE, names)
+            self.assertFalse(any(name.startswith("metrics_" + str(exited.pid)) for name in names))
+            self.assertIn(os.path.basename(registry.path()), names)
+            registry.flush()
+            lines = registry.render().splitlines()
+            registry.directory = worker.directory = None
+
+        self.assertIn("requests_total 12", lines)
+        self.assertIn("stage_seconds_count 2", lines)
+
+    def test_metrics_route(self):
+        client = dicebot.app.test_client()
+        form = {"user_name": "user", "command": "/roll", "text": "2d6", "channel_name": "general"}
+        client.post("/roll", data=form)
+        form["text"] = "2d"
+        client.post("/roll", data=form)
+
+        text = client.get("/metrics").get_data(as_text=True)
+        self.assertIn('dicebot_requests_total{command="/roll"}', text)
+        self.assertIn('dicebot_errors_total{command="/roll",kind="dicebot"}', text)
+        self.assertIn('dicebot_stage_seconds_count{stage="slack_parse"}', text)
+        self.assertIn('dicebot_stage_seconds_count{stage="serialize"}', text)
+        self.assertIn("dicebot_dice_drawn_total", text)
+
+
+class DispatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = dicebot.app.test_client()
+        self.form = {"user_name": "tester", "command": "/roll", "text": "2d6+1", "channel_name": "general"}
+
+    def post(self, path):
+        response = self.client.post(path, data=self.form)
+        return (response.status_code, json.loads(response.get_data(as_text=True)))
+
+    def test_root_uses_command_field(self):
+        status, payload = self.post("/")
+        self.assertEqual(status, 200)
+        self.assertTrue(payload["text"].startswith("tester rolled 2d6:\n"))
+
+        self.form["command"] = "/character"
+        self.assertTrue(self.post("/")[1]["text"].startswith("tester rolled a stat block:\n"))
+
+    def test_paths_still_work(self):
+        for path in ["/roll", "/adv", "/dis", "/character", "/odds", "/simulate"]:
+            status, payload = self.post(path)
+            self.assertEqual(status, 200, path)
+
+        # The path wins over the command field
+        self.form["text"] = "+1"
+        self.assertTrue(self.post("/adv")[1]["text"].startswith("tester rolled at Advantage:\n"))
+
+    def test_full_listing(self):
+        self.form["text"] = "1500d6 full"
+        status, payload = self.post("/roll")
+        self.assertEqual(status, 200)
+        header, faces = payload["text"].split("\n")[:2]
+        self.assertEqual(header, "tester rolled 1500d6:")
+        self.assertEqual(len(faces.split(" = ")[0].split(" + ")), 1500)
+
+        self.form["text"] = "4d6kh3 full"
+        self.assertTrue(self.post("/roll")[1]["text"].startswith("error: Only a plain roll"))
+
+    def test_errors(self):
+        self.form["command"] = "/nope"
+        status, payload = self.post("/")
+        self.assertEqual(status, 404)
+        self.assertEqual(payload["response_type"], "ephemeral")
+
+        self.form["command"] = "/roll"
+        self.form["text"] = "2d"
+        status, payload = self.post("/")
+        self.assertEqual(status, 200)
+        self.assertTrue(payload["text"].endswith(dicebot.COMMANDS["/roll"].help))
+
+    def test_register_command(self):
+        @dicebot.register_command("/echo", "Please use /echo <text>")
+        def echo_command(slack_dict):
+            return slack_dict["text"]
+
+        try:
+            self.form["command"] = "/echo"
+            self.assertEqual(self.post("/")[1]["text"], "2d6+1")
+            self.assertEqual(self.post("/echo")[1]["text"], "2d6+1")
+        finally:
+            del dicebot.COMMANDS["/echo"]
+
+    def test_streamed_errors(self):
+        def broken_pieces(fail_at):
+            for count in range(4):
+                if count == fail_at:
+                    raise ValueError("broken piece")
+                yield "piece " + str(count) + " "
+
+        @dicebot.register_command("/early", "Please use /early")
+        def early_command(slack_dict):
+            return broken_pieces(1)
+
+        @dicebot.register_command("/late", "Please use /late")
+        def late_command(slack_dict):
+            return broken_pieces(3)
+
+        counters = dicebot.metrics_registry.counters
+        early_key = ("dicebot_errors_total", (("command", "/early"), ("kind", "unhandled")))
+        late_key = ("dicebot_errors_total", (("command", "/late"), ("kind", "unhandled")))
+        slack_dict = {"username": "tester", "channel_name": "general", "text": ""}
+        try:
+            # A failure in the first pieces is an error answer, not a half sent message
+            payload = dicebot.run_command(dicebot.COMMANDS["/early"], slack_dict)
+            self.assertIsInstance(payload, bytes)
+            self.assertEqual(json.loads(payload.decode("utf-8"))["response_type"], "ephemeral")
+            self.assertEqual(counters.get(early_key), 1)
+
+            # A later one still ends the message as valid JSON, and is counted
+            payload = b"".join(dicebot.run_command(dicebot.COMMANDS["/late"], slack_dict))
+            self.assertEqual(json.loads(payload.decode("utf-8"))["text"],
+                             "piece 0 piece 1 piece 2 " + dicebot.STREAM_ERROR_TEXT)
+            self.assertEqual(counters.get(late_key), 1)
+        finally:
+            del dicebot.COMMANDS["/early"]
+            del dicebot.COMMANDS["/late"]
+
+    def test_simple_plan_without_dice(self):
+        self.assertFalse(dicebot.is_simple_plan(dicebot.RollPlan("5", (), 5)))
+
+
+class SignatureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.verifier = slack_signature.SignatureVerifier("8f742231b10e8888abcd99yyyzzz85a5")
+        self.body = urlencode({"user_name": "tester", "command": "/roll", "text": "2d6",
+                               "channel_name": "general"}).encode("utf-8")
+
+    def signed_headers(self, body, timestamp=None):
+        timestamp = str(int(time.time()) if timestamp is None else timestamp)
+        return {"X-Slack-Request-Timestamp": timestamp,
+                "X-Slack-Signature": self.verifier.sign(timestamp, body)}
+
+    def test_verify(self):
+        # The example from slack's documentation
+        body = (b"token=xyzz0WbapA4vBCDEFasx0q6G&team_id=T1DC2JH3J&team_domain=testteamnow&channel_id=G8PSS9T3V"
+                b"&channel_name=foobar&user_id=U2CERLKJA&user_name=roadrunner&command=%2Fwebhook-collect&text="
+                b"&response_url=https%3A%2F%2Fhooks.slack.com%2Fcommands%2FT1DC2JH3J%2F397700885554%2F96rGlfmibIGlgc"
+                b"ZRskXaIFfN&trigger_id=398738663015.47445629121.803a0bc887a14d10d2c447fce8b6703c")
+        signature = "v0=a2114d57b48eac39b9ad189dd8316235a7b4a8d21a10bd27519666489c69b503"
+        self.assertIsNone(self.verifier.verify("1531420618", signature, body, now=1531420618))
+
+        self.assertEqual(self.verifier.verify("1531420618", signature, body, now=1531420618), "replayed")
+        self.assertEqual(self.verifier.verify("1531420618", signature, body + b"x", now=1531420618),
+                         "bad_signature")
+        self.assertEqual(self.verifier.verify("1531420618", signature, body, now=1531420618 + 301), "stale")
+        self.assertEqual(self.verifier.verify(None, signature, body), "missing")
+
+    def test_non_ascii_headers(self):
+        for timestamp in ["\xa01531420618", "\uff11\uff15\uff13\uff11", " 1531420618", "-1"]:
+            self.assertEqual(self.verifier.verify(timestamp, "v0=00", self.body, now=1531420618), "missing",
+                             msg=timestamp)
+        self.assertEqual(self.verifier.verify("1531420618", "v0=\xe9", self.body, now=1531420618), "bad_signature")
+
+    def test_replay_guard_is_bounded(self):
+        verifier = slack_signature.SignatureVerifier("secret", max_seen=3)
+        for count in range(10):
+            timestamp = str(1000 + count)
+            self.assertIsNone(verifier.verify(timestamp, verifier.sign(timestamp, b""), b"", now=1000))
+        self.assertEqual(len(verifier.seen), 3)
+
+    def test_flask_rejects_before_parsing(self):
+        client = dicebot.app.test_client()
+        dicebot.signature_verifier = self.verifier
+        try:
+            content_type = "application/x-www-form-urlencoded"
+            response = client.post("/roll", data=self.body, content_type=content_type)
+            self.assertEqual(response.status_code, 401)
+
+            response = client.post("/roll", data=self.body, content_type=content_type,
+                                   headers=self.signed_headers(self.body))
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("tester rolled 2d6", response.get_data(as_text=True))
+
+            # /metrics is not a slash command
+            text = client.get("/metrics").get_data(as_text=True)
+            self.assertIn('dicebot_rejected_requests_total{reason="missing"}', text)
+        finally:
+            dicebot.signature_verifier = None
+
+    def test_asgi_rejects(self):
+        app = dicebot_asgi.DicebotASGI()
+        dicebot.signature_verifier = self.verifier
+        try:
+            status, payload = asyncio.run(app.handle("/roll", self.body))
+            self.assertEqual(status, 401)
+
+            headers = dict((name.lower(), value) for name, value in self.signed_headers(self.body).items())
+            status, payload = asyncio.run(app.handle("/roll", self.body, headers))
+            self.assertEqual(status, 200)
+        finally:
+            dicebot.signature_verifier = None
+
+
+class WsgiTest(unittest.TestCase):
+
+    def post(self, app, path, form, headers=None):
+        status, headers, body = benchmark.call_wsgi(app, benchmark.wsgi_environ(path, form, headers))
+        return (int(status.split()[0]), dict(headers)["Content-Type"], body)
+
+    def test_same_as_flask(self):
+        form = {"user_name": "tester", "channel_name": "general", "command": "/roll", "text": "3d1+2"}
+        for path, fields in [("/roll", {}), ("/", {}), ("/", {"command": "/nothing"}), ("/nothing", {}),
+                             ("/roll", {"text": "bad"}), ("/adv", {"text": "+1d4"})]:
+            self.assertEqual(self.post(dicebot_wsgi.app, path, dict(form, **fields)),
+                             self.post(dicebot.app, path, dict(form, **fields)), msg=path + " " + str(fields))
+
+        # The error quotes the form, which Flask holds in its own dict type
+        status, content_type, body = self.post(dicebot_wsgi.app, "/roll", {"command": "/roll", "text": "1d6"})
+        self.assertIn("no user_name", json.loads(body.decode("utf-8"))["text"])
+
+        status, content_type, body = self.post(dicebot_wsgi.app, "/roll", form)
+        self.assertEqual(json.loads(body.decode("utf-8"))["text"], "tester rolled 3d1:\n1 + 1 + 1 (+2) = *5*\n")
+
+        # A full listing is streamed
+        status, content_type, body = self.post(dicebot_wsgi.app, "/roll", dict(form, text="2000d6 full"))
+        self.assertEqual(json.loads(body.decode("utf-8"))["text"].count(" + "), 1999)
+
+        for app in (dicebot_wsgi.app, dicebot.app):
+            status, headers, body = benchmark.call_wsgi(app, dict(benchmark.wsgi_environ("/metrics", {}),
+                                                                  REQUEST_METHOD="GET"))
+            self.assertIn(b"dicebot_requests_total", body)
+            self.assertEqual(self.post(app, "/roll/extra", form)[0], 404)
+
+    def test_methods_same_as_flask(self):
+        for method in ["GET", "HEAD", "POST", "PUT", "DELETE", "OPTIONS"]:
+            for path in ["/", "/roll", "/metrics", "/warmup", "/roll/extra"]:
+                answers = []
+                for app in (dicebot_wsgi.app, dicebot.app):
+                    environ = dict(benchmark.wsgi_environ(path, {}), REQUEST_METHOD=method)
+                    status, headers, body = benchmark.call_wsgi(app, environ)
+                    allowed = dict(headers).get("Allow")
+                    answers.append((status.split()[0], allowed and sorted(allowed.split(", ")),
+                                    body if method == "HEAD" else None))
+                self.assertEqual(answers[0], answers[1], msg=method + " " + path)
+                if method == "HEAD":
+                    self.assertEqual(answers[0][2], b"", msg=path)
+
+    def test_rejects_unsigned(self):
+        verifier = slack_signature.SignatureVerifier("8f742231b10e8888abcd99yyyzzz85a5")
+        form = {"user_name": "tester", "channel_name": "general", "command": "/roll", "text": "2d6"}
+        body = urlencode(form).encode("utf-8")
+        timestamp = str(int(time.time()))
+
+        dicebot.signature_verifier = verifier
+        try:
+            self.assertEqual(self.post(dicebot_wsgi.app, "/roll", form)[::2], (401, b"Invalid signature"))
+            status, content_type, payload = self.post(dicebot_wsgi.app, "/roll", form,
+                                                      {"X-Slack-Request-Timestamp": timestamp,
+                                                       "X-Slack-Signature": verifier.sign(timestamp, body)})
+            self.assertEqual(status, 200)
+            self.assertIn("tester rolled 2d6", payload.decode("utf-8"))
+        finally:
+            dicebot.signature_verifier = None
+
+    def test_compare_apps(self):
+        results = benchmark.compare_apps(iterations=3, warmup=1)
+        self.assertEqual(len(results), len(benchmark.APP_REQUESTS))
+        self.assertTrue(all(set(rates) == set(["flask", "minimal"]) for rates in results.values()))
+
+
+class RateLimitTest(unittest.TestCase):
+
+    def check_store(self, store):
+        buckets = [("user:a", 10, 1.0), ("channel:c", 15, 1.0)]
+        self.assertEqual(store.take(buckets, 8, now=100), (True, 0.0, None))
+
+        # 2 tokens left for the user, 7 for the channel
+        allowed, retry_after, limited = store.take(buckets, 5, now=100)
+        self.assertEqual((allowed, limited), (False, 0))
+        self.assertAlmostEqual(retry_after, 3.0)
+
+        # Refused requests are not charged, and buckets refill over time
+        self.assertTrue(store.take(buckets, 5, now=103)[0])
+
+        # Another user in the same channel runs out of channel tokens
+        allowed, retry_after, limited = store.take([("user:b", 10, 1.0), ("channel:c", 15, 1.0)], 9, now=103)
+        self.assertEqual((allowed, limited), (False, 1))
+
+    def test_memory_store(self):
+        store = rate_limit.MemoryStore(idle_ttl=60)
+        self.check_store(store)
+
+        # Idle buckets are dropped
+        store.take([("user:z", 10, 1.0)], 1, now=1000)
+        self.assertEqual(list(store.buckets), ["user:z"])
+
+    def test_shared_memory_store(self):
+        store = rate_limit.SharedMemoryStore(capacity=64, idle_ttl=60)
+        self.addCleanup(store.unlink)
+        self.addCleanup(store.close)
+        self.check_store(store)
+
+        # A forked worker charges the same buckets
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if store.take([("user:a", 10, 1.0)], 9, now=112)[0] else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertFalse(store.take([("user:a", 10, 1.0)], 1, now=112)[0])
+
+    def test_shared_memory_store_reuses_buckets(self):
+        # Every key probes the whole table, so the stalest bucket is taken over
+        store = rate_limit.SharedMemoryStore(capacity=rate_limit.PROBE_LIMIT, idle_ttl=1000)
+        self.addCleanup(store.unlink)
+        self.addCleanup(store.close)
+        for number in range(rate_limit.PROBE_LIMIT):
+            self.assertTrue(store.take([("user:" + str(number), 10, 0.001)], 10, now=number)[0])
+
+        self.assertTrue(store.take([("user:new", 10, 0.001)], 10, now=100)[0])
+        # user:1 still has its own empty bucket, user:0 lost its and starts full
+        self.assertFalse(store.take([("user:1", 10, 0.001)], 10, now=100)[0])
+        self.assertTrue(store.take([("user:0", 10, 0.001)], 10, now=100)[0])
+
+    def test_redis_store(self):
+        client = rate_limit.FakeRedis()
+        self.check_store(rate_limit.RedisStore(client))
+        self.assertIn("dicebot:rate:user:a", client.hashes)
+
+    def test_dispatch(self):
+        client = dicebot.app.test_client()
+        form = {"user_name": "flooder", "command": "/roll", "text": "99d100", "channel_name": "general"}
+        limiter = dicebot.rate_limiter
+        dicebot.rate_limiter = rate_limit.RateLimiter(rate_limit.MemoryStore(), 250, 0.001, 1000, 0.001)
+        try:
+            texts = [json.loads(client.post("/", data=form).get_data(as_text=True))["text"] for count in range(3)]
+        finally:
+            dicebot.rate_limiter = limiter
+
+        self.assertTrue(texts[0].startswith("flooder rolled 99d100"))
+        self.assertTrue(texts[1].startswith("flooder rolled 99d100"))
+        self.assertTrue(texts[2].startswith("Slow down! You are rolling too many dice."))
+        self.assertIn('dicebot_rate_limited_total{scope="user"}', client.get("/metrics").get_data(as_text=True))
+
+    def test_defaults(self):
+        self.assertIsInstance(dicebot.rate_limiter.store, rate_limit.MemoryStore)
+        self.assertEqual(dicebot.simulate_cost({"text": "1d6 1000 trials"}), dicebot.SIMULATE_BASE_COST + 1)
+        self.assertTrue(dicebot.simulate_cost({"text": "1d6 10000000 trials"}) >
+                        dicebot.simulate_cost({"text": "1d6"}) > dicebot.simulate_cost({"text": "1d6 1000 trials"}))
+        self.assertTrue(dicebot.simulate_cost({"text": "1d6 10000000 trials"}) < dicebot.USER_RATE_CAPACITY)
+        self.assertEqual(dicebot.simulate_cost({"text": "bad"}), dicebot.SIMULATE_BASE_COST)
+
+
+class RollJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_write_and_read(self):
+        journal = roll_journal.RollJournal(self.directory.name, segment_bytes=200)
+        record = {"backend": "splitmix", "seed": 2 ** 63, "stream": 7, "request": 3}
+        for count in range(10):
+            journal.append("alice", "general", "2d6 + 1", count, [count % 6 + 1, 1], record, timestamp=1000 + count)
+        journal.append("bob", "general", "1d20", 20, [20], None, timestamp=2000)
+        journal.append("alice", "dungeon", "1d4", 4, [4], None, timestamp=3000)
+        journal.flush()
+
+        # Small segments rotate, and each one is readable on its own
+        self.assertGreater(len(os.listdir(self.directory.name)), 1)
+
+        reader = roll_journal.JournalReader(self.directory.name)
+        history = reader.history(user="alice", channel="general", limit=3)
+        self.assertEqual([roll["total"] for roll in history], [9, 8, 7])
+        self.assertEqual(history[0]["faces"], [4, 1])
+        self.assertEqual(history[0]["expression"], "2d6 + 1")
+        self.assertEqual(history[0]["rng"], record)
+
+        self.assertEqual([roll["user"] for roll in reader.history(channel="general", limit=2)], ["bob", "alice"])
+        self.assertIsNone(reader.history(user="bob")[0]["rng"])
+        self.assertEqual(reader.user_stats("alice"),
+                         {"rolls": 11, "dice": 21, "average": 49 / 11, "highest": 9, "lowest": 0})
+
+        # Only new records are read on the next query
+        journal.append("bob", "general", "1d20", 1, [1], None, timestamp=4000)
+        journal.flush()
+        self.assertEqual(reader.user_stats("bob")["rolls"], 2)
+        reader.close()
+
+    def test_writers_never_share_segments(self):
+        # Like a restarted process that got the same pid, a second writer starts from segment 1 again
+        for user in ["alice", "bob"]:
+            journal = roll_journal.RollJournal(self.directory.name)
+            journal.append(user, user + "-channel", "1d" + str(len(user)), 1, [1], None)
+            journal.flush()
+        self.assertEqual(len(os.listdir(self.directory.name)), 2)
+
+        reader = roll_journal.JournalReader(self.directory.name)
+        alice = reader.history(user="alice")
+        self.assertEqual([(roll["channel"], roll["expression"]) for roll in alice], [("alice-channel", "1d5")])
+        reader.close()
+
+    def test_index_is_bounded(self):
+        journal = roll_journal.RollJournal(self.directory.name, segment_bytes=300)
+        for count in range(60):
+            journal.append("alice", "general", "1d20", count, [count % 20 + 1], None, timestamp=1000 + count)
+        self.assertTrue(journal.append("bob", "general", "1d4", 4, [4], None))
+        journal.flush()
+
+        reader = roll_journal.JournalReader(self.directory.name, max_entries=5, max_mapped=2)
+        self.assertEqual([roll["total"] for roll in reader.history(user="alice", limit=3)], [59, 58, 57])
+        self.assertTrue(len(reader.by_user["alice"]) <= 10)
+        self.assertTrue(len(reader.mapped) <= 2)
+        # Totals still cover every roll
+        self.assertEqual(reader.user_stats("alice")["rolls"], 60)
+        self.assertEqual(reader.user_stats("alice")["lowest"], 0)
+        reader.close()
+
+    def test_half_written_record(self):
+        journal = roll_journal.RollJournal(self.directory.name)
+        journal.append("alice", "general", "1d6", 6, [6], None)
+        journal.flush()
+
+        path = os.path.join(self.directory.name, os.listdir(self.directory.name)[0])
+        with open(path, "ab") as segment_file:
+            segment_file.write(roll_journal.ROLL_STRUCT.pack(roll_journal.ROLL_RECORD, 0, 1, 2, 3, 4, 0, 0, 0, 0, 1)[:10])
+
+        reader = roll_journal.JournalReader(self.directory.name)
+        self.assertEqual(len(reader.history(user="alice")), 1)
+        reader.close()
+
+    def test_unknown_name(self):
+        journal = roll_journal.RollJournal(self.directory.name)
+        journal.append("alice", "general", "1d6", 6, [6], None)
+        journal.flush()
+
+        # A whole roll whose user was never named is skipped, the rolls after it are kept
+        path = os.path.join(self.directory.name, os.listdir(self.directory.name)[0])
+        with open(path, "ab") as segment_file:
+            segment_file.write(roll_journal.ROLL_STRUCT.pack(roll_journal.ROLL_RECORD, 0, 99, 2, 3, 4, 0, 0, 0, 5, 1) +
+                               bytes(roll_journal.FACE_SIZE) +
+                               roll_journal.ROLL_STRUCT.pack(roll_journal.ROLL_RECORD, 1, 1, 2, 3, 4, 0, 0, 0, 6, 0))
+
+        reader = roll_journal.JournalReader(self.directory.name)
+        self.assertEqual([roll["total"] for roll in reader.history(user="alice")], [6, 6])
+        self.assertEqual(reader.user_stats("alice")["rolls"], 2)
+        reader.close()
+
+    def test_history_command(self):
+        dicebot.journal = roll_journal.RollJournal(self.directory.name)
+        try:
+            slack_dict = {"username": "tester", "channel_name": "general", "text": "3d6"}
+            dicebot.roll_command(slack_dict)
+            dicebot.adv_command(dict(slack_dict, text="+2"))
+            dicebot.character_command(slack_dict)
+            dicebot.journal.flush()
+
+            output = dicebot.history_command(dict(slack_dict, text="@tester"))
+            lines = output.splitlines()
+            self.assertEqual(lines[0], "Last 8 rolls by tester in general:")
+            self.assertIn(" 4d6kh3: ", lines[1])
+            self.assertIn(" 2d20kh1 + 2: ", lines[7])
+            self.assertIn(" 3d6: ", lines[8])
+            self.assertTrue(lines[9].startswith("tester has rolled 8 times and 29 dice"))
+
+            self.assertEqual(dicebot.history_command(dict(slack_dict, text="nobody")), "No rolls by nobody in general\n")
+        finally:
+            if dicebot.journal_reader is not None:
+                dicebot.journal_reader.close()
+            dicebot.journal = dicebot.journal_reader = None
+
+        with self.assertRaises(DicebotException):
+            dicebot.history_command(slack_dict)
+
+
+class RollStatsTest(unittest.TestCase):
+
+    def test_aggregates_and_streaks(self):
+        aggregate = roll_stats.Aggregate()
+        aggregate.add([(20, [20, 15, 12]), (6, [1, 6])], 100)
+        aggregate.add([(20, [1, 2, 20, 20])], 200)
+
+        d20 = aggregate.dies[20]
+        self.assertEqual((d20.count, d20.total, d20.squares), (7, 90, 1574))
+        self.assertEqual((d20.faces[20], d20.faces[1]), (3, 1))
+        self.assertEqual((aggregate.best_high, aggregate.best_low), (3, 2))
+        self.assertAlmostEqual(roll_stats.Aggregate().luck() or 0, 0)
+
+        # Merging the halves of a roll sequence gives the same streaks as adding it all
+        halves = [roll_stats.Aggregate(), roll_stats.Aggregate()]
+        faces = [11, 12, 3, 13, 14, 15, 16, 2, 1, 20, 19, 18, 17, 16, 4]
+        whole = roll_stats.Aggregate()
+        whole.add([(20, faces)], 0)
+        for split in range(len(faces) + 1):
+            first, second = roll_stats.Aggregate(), roll_stats.Aggregate()
+            first.add([(20, faces[:split])], 0)
+            second.add([(20, faces[split:])], 1)
+            first.merge(second)
+            self.assertEqual((first.best_high, first.best_low, first.prefix, first.suffix, first.d20s),
+                             (whole.best_high, whole.best_low, whole.prefix, whole.suffix, whole.d20s))
+
+    def test_sessions(self):
+        statistics = roll_stats.Statistics()
+        statistics.add("general", "alice", [(20, [1])], 0)
+        statistics.add("general", "bob", [(20, [20])], 60)
+        self.assertEqual(sorted(statistics.sessions["general"]), ["alice", "bob"])
+
+        statistics.add("general", "bob", [(20, [20])], 60 + roll_stats.SESSION_GAP + 1)
+        self.assertEqual(sorted(statistics.sessions["general"]), ["bob"])
+        self.assertEqual(statistics.totals["general"]["bob"].dies[20].count, 2)
+
+    def test_snapshot_shared_by_workers(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "stats.json")
+
+        first = roll_stats.RollStats(path)
+        second = roll_stats.RollStats(path)
+        first.record("general", "alice", [(20, [20, 19])], 1000)
+        second.record("general", "bob", [(20, [1])], 1001)
+        first.save()
+        second.save()
+
+        # A restart reads both workers' rolls back
+        restarted = roll_stats.RollStats(path)
+        statistics = restarted.current()
+        self.assertEqual(statistics.totals["general"]["alice"].dies[20].total, 39)
+        self.assertEqual(statistics.totals["general"]["bob"].dies[20].faces[1], 1)
+        self.assertEqual(sorted(statistics.sessions["general"]), ["alice", "bob"])
+
+        restarted.record("general", "alice", [(20, [5])], 1002)
+        self.assertEqual(restarted.current().totals["general"]["alice"].dies[20].count, 3)
+
+        # One channel is copied on its own, and the copy doesn't change with new rolls
+        restarted.record("dungeon", "bob", [(6, [3])], 1003)
+        general = restarted.current("general")
+        self.assertEqual(list(general.totals), ["general"])
+        self.assertEqual(general.totals["general"]["alice"].dies[20].count, 3)
+        self.assertEqual(general.totals["general"]["alice"].best_high, 2)
+        restarted.record("general", "alice", [(20, [7])], 1004)
+        self.assertEqual(general.totals["general"]["alice"].dies[20].count, 3)
+
+        for stats in (first, second, restarted):
+            stats.close()
+
+    def test_rolls_are_counted_while_saving(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "stats.json")
+
+        stats = roll_stats.RollStats(path)
+        stats.record("general", "alice", [(20, [20])], 1000)
+
+        # Another worker holds the file, so the save waits with the roll in hand
+        with open(path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            saver = threading.Thread(target=stats.save)
+            saver.start()
+            while stats.saving is None:
+                time.sleep(0.001)
+            stats.record("general", "alice", [(20, [1])], 1001)
+            self.assertEqual(stats.current("general").totals["general"]["alice"].dies[20].count, 2)
+        saver.join()
+
+        self.assertIsNone(stats.saving)
+        self.assertEqual(stats.current().totals["general"]["alice"].dies[20].count, 2)
+        stats.close()
+        self.assertEqual(roll_stats.RollStats(path).current().totals["general"]["alice"].dies[20].count, 2)
+
+    def test_stats_command(self):
+        saved = dicebot.roll_statistics
+        dicebot.roll_statistics = roll_stats.RollStats()
+        try:
+            slack_dict = {"username": "tester", "channel_name": "stats", "text": "3d20"}
+            self.assertEqual(dicebot.stats_command(dict(slack_dict, text="")), "No rolls in stats yet\n")
+
+            dicebot.roll_command(slack_dict)
+            dicebot.adv_command(dict(slack_dict, text="+2"))
+            dicebot.roll_command(dict(slack_dict, username="other", text="1d20; 4d6"))
+
+            lines = dicebot.stats_command(dict(slack_dict, text="")).splitlines()
+            self.assertEqual(lines[0], "d20 stats in stats:")
+            self.assertTrue(lines[1].startswith("tester: 5 d20s, average *"))
+            self.assertTrue(lines[2].startswith("other: 1 d20s, average *"))
+            self.assertTrue(lines[3].startswith("Luckiest this session: "))
+
+            with self.assertRaises(DicebotException):
+                dicebot.stats_command(dict(slack_dict, text="everything"))
+        finally:
+            dicebot.roll_statistics = saved
+
+
+class RollMacrosTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "macros.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_store(self):
+        compiled = []
+        store = roll_macros.MacroStore(self.path, lambda text: compiled.append(text) or text.upper(), max_macros=2)
+        other = roll_macros.MacroStore(self.path, check_interval=0)
+        try:
+            self.assertEqual(store.set("tester", "attack", "1d20+7"), "1D20+7")
+            self.assertEqual(store.get("tester", "attack"), "1D20+7")
+            self.assertIsNone(store.get("other", "attack"))
+
+            # Lookups come from the cache, compiled once
+            store.get("tester", "attack")
+            self.assertEqual(compiled, ["1d20+7"])
+
+            # Another process sees it, and its edits reach this cache
+            self.assertEqual(other.get("tester", "attack"), "1d20+7")
+            other.set("tester", "attack", "1d20+8")
+            store.checked = 0
+            self.assertEqual(store.get("tester", "attack"), "1D20+8")
+
+            store.set("tester", "damage", "1d8+4")
+            with self.assertRaises(ValueError):
+                store.set("tester", "third", "1d6")
+            self.assertEqual(store.list("tester"), [("attack", "1d20+8"), ("damage", "1d8+4")])
+
+            self.assertTrue(store.delete("tester", "damage"))
+            self.assertFalse(store.delete("tester", "damage"))
+            self.assertIsNone(store.get("tester", "damage"))
+        finally:
+            store.close()
+            other.close()
+
+    def test_commands(self):
+        saved = dicebot.macro_store
+        dicebot.macro_store = roll_macros.MacroStore(self.path, dicebot.compile_macro)
+        try:
+            slack_dict = {"username": "tester", "channel_name": "general"}
+            self.assertEqual(dicebot.macro_command(dict(slack_dict, text="Attack = 1d20 +7")),
+                             "Saved attack for tester: 1d20 + 7\n")
+            dicebot.macro_command(dict(slack_dict, text="str-save = +3"))
+            dicebot.macro_command(dict(slack_dict, text="fireball = 8d6"))
+
+            output = dicebot.roll_command(dict(slack_dict, text="attack"))
+            self.assertTrue(output.startswith("tester rolled 1d20:\n"))
+            self.assertIn(" (+7) = *", output)
+
+            output = dicebot.adv_command(dict(slack_dict, text="str-save"))
+            self.assertTrue(output.startswith("tester rolled at Advantage:\n"))
+            self.assertIn(" (+3) = *", output)
+            with self.assertRaises(DicebotException):
+                dicebot.adv_command(dict(slack_dict, text="fireball"))
+
+            # Macros belong to one user
+            with self.assertRaises(DicebotException):
+                dicebot.roll_command(dict(slack_dict, username="other", text="attack"))
+
+            self.assertEqual(dicebot.macro_command(dict(slack_dict, text="")),
+                             "tester's macros:\nattack: 1d20 +7\nfireball: 8d6\nstr-save: +3\n")
+            dicebot.macro_command(dict(slack_dict, text="remove fireball"))
+            self.assertNotIn("fireball", dicebot.macro_command(dict(slack_dict, text="")))
+
+            for text in ["broken = 1d20+", "1d20 = 1d20", "d20 = 1d20", "remove nothing", "attack"]:
+                with self.assertRaises(DicebotException, msg=text):
+                    dicebot.macro_command(dict(slack_dict, text=text))
+
+            # Only the user sees /macro answers, the rolls of a macro go to the channel
+            for text in ["", "ranged = 1d20+4", "remove ranged", "remove nothing"]:
+                payload = dicebot.run_command(dicebot.COMMANDS["/macro"], dict(slack_dict, text=text))
+                self.assertEqual(json.loads(payload.decode("utf-8"))["response_type"], "ephemeral", msg=text)
+            payload = dicebot.run_command(dicebot.COMMANDS["/roll"], dict(slack_dict, text="attack"))
+            self.assertEqual(json.loads(payload.decode("utf-8"))["response_type"], "in_channel")
+
+            # Rolls never reach the macro store
+            dicebot.macro_store.close()
+            for text in ["2d6+3", "d20", "4d6kh3 full"]:
+                self.assertIsNone(dicebot.find_macro(slack_dict, text), msg=text)
+            self.assertIsNone(dicebot.macro_store.connection)
+        finally:
+            dicebot.macro_store.close()
+            dicebot.macro_store = saved
+
+
+class SharedCountersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.counters = shared_counters.SharedCounters(capacity=64)
+        self.addCleanup(self.counters.unlink)
+        self.addCleanup(self.counters.close)
+
+    def test_workers_share_counts(self):
+        registry = shared_counters.SharedRegistry(self.counters)
+        registry.describe("dicebot_requests_total", "counter", "Requests.")
+        registry.inc("dicebot_requests_total", (("command", "/roll"),))
+
+        pid = os.fork()
+        if pid == 0:
+            # A forked worker sees the parent's slots and hands out new ones
+            registry.inc("dicebot_requests_total", (("command", "/roll"),), 2)
+            registry.inc("dicebot_requests_total", (("command", "/adv"),))
+            registry.observe("dicebot_request_seconds", 0.0002)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        text = registry.render()
+        self.assertIn('dicebot_requests_total{command="/roll"} 3', text)
+        self.assertIn('dicebot_requests_total{command="/adv"} 1', text)
+        self.assertIn('dicebot_request_seconds_bucket{le="0.00025"} 1', text)
+        self.assertIn("dicebot_request_seconds_sum 0.0002", text)
+
+    def test_full_region(self):
+        registry = shared_counters.SharedRegistry(self.counters)
+        # Each histogram takes 15 slots, the fifth doesn't fit and is counted in this process
+        for number in range(5):
+            registry.observe("histogram_" + str(number), 0.01)
+        self.assertIn("histogram_4_count 1", registry.render())
+        self.assertIsNone(self.counters.slot("x" * (shared_counters.KEY_BYTES + 1)))
+
+
+class PreforkServerTest(unittest.TestCase):
+
+    def post_roll(self, port):
+        body = urlencode({"user_name": "tester", "command": "/roll", "text": "2d6", "channel_name": "general"})
+        return json.loads(urllib.request.urlopen("http://127.0.0.1:" + str(port) + "/", body.encode("ascii"),
+                                                 timeout=10).read())
+
+    def test_serve_reload_and_stop(self):
+        free = socket.socket()
+        free.bind(("127.0.0.1", 0))
+        port = free.getsockname()[1]
+        free.close()
+
+        server = subprocess.Popen([sys.executable, "dicebot_server.py"], stdout=subprocess.PIPE, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  env=dict(os.environ, PORT=str(port), DICEBOT_WORKERS="2"))
+        try:
+            self.assertIn("with 2 workers", server.stdout.readline())
+            for count in range(4):
+                self.assertTrue(self.post_roll(port)["text"].startswith("tester rolled 2d6"))
+
+            # Requests keep being answered through a reload, and the counts carry over
+            server.send_signal(signal.SIGHUP)
+            self.assertTrue(self.post_roll(port)["text"].startswith("tester rolled 2d6"))
+            self.assertEqual(server.stdout.readline().strip(), "dicebot reloading")
+            self.assertIn("with 2 workers", server.stdout.readline())
+            self.post_roll(port)
+
+            metrics_text = urllib.request.urlopen("http://127.0.0.1:" + str(port) + "/metrics", timeout=10).read()
+            self.assertIn(b'dicebot_requests_total{command="/roll"} 6', metrics_text)
+
+            server.send_signal(signal.SIGTERM)
+            self.assertEqual(server.wait(10), 0)
+        finally:
+            if server.poll() is None:
+                server.kill()
+                server.wait()
+            server.stdout.close()
+
+
+class LoadTestTest(unittest.TestCase):
+
+    def test_simulator(self):
+        simulator = load_test.SlackSimulator(load_test.parse_mix("adv=1,big=1"), "http://127.0.0.1/stub", seed=1)
+        forms = [simulator.form() for count in range(50)]
+
+        self.assertEqual(set(kind for kind, form in forms), {"adv", "big"})
+        for kind, form in forms:
+            slack_dict = dicebot.parse_slack_message(form)
+            self.assertEqual(slack_dict["command"], "/adv" if kind == "adv" else "/roll")
+            self.assertEqual(slack_dict["response_url"], "http://127.0.0.1/stub/" + form["trigger_id"])
+
+        for mix in ["roll=0", "everything=1", "roll=a"]:
+            with self.assertRaises(ValueError, msg=mix):
+                load_test.parse_mix(mix)
+
+    def test_run_load(self):
+        server = make_server("127.0.0.1", 0, dicebot.app, ThreadingWSGIServer, dicebot_server.QuietHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            simulator = load_test.SlackSimulator(load_test.parse_mix("roll=5,character=1,big=1"), seed=2)
+            report = asyncio.run(load_test.run_load("http://127.0.0.1:" + str(server.server_port) + "/",
+                                                    50, 1, simulator))
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+        self.assertEqual(report["requests"], 50)
+        self.assertEqual(report["outcomes"], {"ok": 50})
+        self.assertEqual(report["error_rate"], 0.0)
+        self.assertTrue(0 < report["p50_ms"] <= report["p99_ms"] <= report["max_ms"])
+
+    def test_delayed_answer_before_ack(self):
+        def answer_first(environ, start_response):
+            # Posts the delayed answer before acknowledging, the order a fast server can manage
+            form = dict(parse_qsl(environ["wsgi.input"].read(int(environ["CONTENT_LENGTH"])).decode("utf-8")))
+            request = urllib.request.Request(form["response_url"], b'{"text": "late"}',
+                                             {"Content-Type": "application/json"})
+            urllib.request.urlopen(request, timeout=10).read()
+            start_response("200 OK", [("Content-Type", "application/json")])
+            return [json.dumps({"text": dicebot_asgi.ACKNOWLEDGE_TEXT}).encode("utf-8")]
+
+        server = make_server("127.0.0.1", 0, answer_first, ThreadingWSGIServer, dicebot_server.QuietHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+
+        async def run():
+            stub = await dicebot_asgi.ResponseUrlStub(keep=False).start()
+            simulator = load_test.SlackSimulator(load_test.parse_mix("roll=1"), stub.url, seed=3)
+            try:
+                return await load_test.run_load("http://127.0.0.1:" + str(server.server_port) + "/",
+                                                 20, 1, simulator, stub, timeout=5)
+            finally:
+                await stub.stop()
+
+        try:
+            report = asyncio.run(run())
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+        self.assertEqual(report["outcomes"], {"delayed": 20})
+        self.assertEqual(report["delayed_missing"], 0)
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class ColdStartTest(unittest.TestCase):
+
+    def test_warmup_endpoint(self):
+        response = dicebot.app.test_client().get("/warmup")
+        self.assertEqual(response.status_code, 200)
+        payload = response.get_json()
+        self.assertTrue(payload["warm"])
+        self.assertEqual(sorted(payload["boot"]), ["first_response_seconds", "import_seconds", "warm_seconds"])
+
+    def test_boot_skips_heavy_imports(self):
+        script = ("import sys, json, dicebot_boot; "
+                  "print(json.dumps([sorted(name for name in ('numpy', 'odds', 'simulate') if name in sys.modules), "
+                  "dicebot_boot.dicebot.boot_timings]))")
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        heavy, timings = json.loads(output.splitlines()[-1])
+
+        self.assertEqual(heavy, [])
+        self.assertGreater(timings["import_seconds"], 0)
+        self.assertGreater(timings["warm_seconds"], 0)
+        self.assertIsNone(timings["first_response_seconds"])
+
 
 if __name__ == '__main__':
     unittest.main()